@@ -0,0 +1,74 @@
+"""
+Benchmarks memory per key and absent-key lookups of the processed-email stores.
+usage: python bench_bloom.py [--keys 1000000] [--lookups 100000] [--error-rate 0.01]
+"""
+import argparse
+import os
+import tempfile
+import time
+import tracemalloc
+from bloom_filter import BloomFilter
+from db import BloomFilteredDB, FileDB, SQLiteDB
+
+
+def _message_ids(start: int, n: int) -> list[str]:
+    # gmail message ids are 16 hex digits
+    return [f"{i:016x}" for i in range(start, start + n)]
+
+
+def _traced_bytes(build) -> int:
+    """ bytes still allocated by build() once it returns, with the result kept alive """
+    tracemalloc.start()
+    result = build()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return size
+
+
+def _timed(fn) -> float:
+    start = time.perf_counter()
+    fn()
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark processed-email store memory and lookups")
+    parser.add_argument("--keys", type=int, default=1_000_000)
+    parser.add_argument("--lookups", type=int, default=100_000, help="Absent keys looked up in one contains_many call")
+    parser.add_argument("--error-rate", type=float, default=0.01)
+    args = parser.parse_args()
+
+    keys = _message_ids(0, args.keys)
+    absent = _message_ids(args.keys, args.lookups)
+
+    print(f"memory per key, {args.keys:,} keys")
+    dict_bytes = _traced_bytes(lambda: {key: "True" for key in _message_ids(0, args.keys)}) # FileDB.store
+    set_bytes = _traced_bytes(lambda: set(_message_ids(0, args.keys)))
+    bloom = BloomFilter(args.keys, args.error_rate)
+    bloom.add_many(keys)
+    print(f"{'dict of str (FileDB)':<26} {dict_bytes / args.keys:8.1f} B")
+    print(f"{'set of str':<26} {set_bytes / args.keys:8.1f} B")
+    print(f"{f'bloom filter, {args.error_rate:.0%} fp':<26} {bloom.nbytes() / args.keys:8.1f} B  ({bloom.n_hashes} hashes)")
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        log_filename = os.path.join(tmp_dir, "db.txt")
+        with open(log_filename, "w") as f: # FileDB.put per key would dominate the setup
+            f.writelines(f"PUT {key} True\n" for key in keys)
+        file_db = FileDB(log_filename, compaction_garbage_ratio=None)
+        file_db.connect()
+        sqlite_db = SQLiteDB(os.path.join(tmp_dir, "db.sqlite"))
+        sqlite_db.connect()
+        sqlite_db.put_many((key, True) for key in keys)
+        filtered_db = BloomFilteredDB(sqlite_db, capacity=args.keys, error_rate=args.error_rate)
+        filtered_db.filter = bloom # already holds every key
+
+        print(f"\ncontains_many of {args.lookups:,} absent keys")
+        for name, db in [("FileDB", file_db), ("SQLiteDB", sqlite_db), ("BloomFilteredDB(SQLiteDB)", filtered_db)]:
+            seconds = _timed(lambda: db.contains_many(absent))
+            print(f"{name:<26} {seconds:8.3f}s  ({seconds / args.lookups * 1e6:.2f} us/key)")
+        print(f"{'':<26} {filtered_db.filtered_lookups / args.lookups:.1%} answered by the filter alone")
+
+
+if __name__ == "__main__":
+    main()
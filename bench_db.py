@@ -0,0 +1,63 @@
+"""
+Benchmarks FileDB load time with and without compaction.
+usage: python bench_db.py [--keys 1000000] [--tail-fraction 0.1]
+"""
+import argparse
+import os
+import tempfile
+import time
+from db import FileDB
+
+
+def _timed(fn) -> float:
+    start = time.perf_counter()
+    fn()
+    return time.perf_counter() - start
+
+
+def _write_log(filename: str, n_keys: int, overwrites: int) -> None:
+    """ writes the log directly, a FileDB would also hold every key in memory just to produce the file """
+    with open(filename, "w") as f:
+        for i in range(n_keys):
+            f.write(f"PUT msg{i:08d} True\n")
+        for i in range(overwrites):
+            f.write(f"PUT msg{i:08d} False\n")
+
+
+def _load(filename: str) -> FileDB:
+    db = FileDB(filename, compaction_garbage_ratio=None)
+    db.connect()
+    return db
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark FileDB load time")
+    parser.add_argument("--keys", type=int, default=1_000_000)
+    parser.add_argument("--tail-fraction", type=float, default=0.1, help="Writes after the last compaction, as a fraction of keys")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        filename = os.path.join(tmp_dir, "bench_db.txt")
+        _write_log(filename, args.keys, overwrites=args.keys) # every key written twice, garbage ratio 0.5
+        print(f"{args.keys:,} keys, {2 * args.keys:,} log records, {os.path.getsize(filename) / 1e6:.1f} MB")
+
+        load_log = _timed(lambda: _load(filename))
+        db = _load(filename)
+        compact = _timed(db.compact)
+        snapshot_mb = os.path.getsize(db.snapshot_filename) / 1e6
+        load_snapshot = _timed(lambda: _load(filename))
+
+        tail = int(args.keys * args.tail_fraction)
+        with open(filename, "a") as f:
+            for i in range(tail):
+                f.write(f"PUT msg{i:08d} True\n")
+        load_snapshot_tail = _timed(lambda: _load(filename))
+
+        print(f"{'load, full log replay':<38} {load_log:8.2f}s")
+        print(f"{'compact':<38} {compact:8.2f}s  (snapshot {snapshot_mb:.1f} MB)")
+        print(f"{'load, snapshot only':<38} {load_snapshot:8.2f}s")
+        print(f"{'load, snapshot + ' + f'{tail:,} record tail':<38} {load_snapshot_tail:8.2f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,192 @@
+"""
+Offline benchmark of EmailSummarizer and EmailToEventService against in-memory Gmail and Calendar fakes and a
+fake LLM with seeded latency and rate limits, so performance changes can be compared without spending tokens.
+Reports throughput, per-email latency percentiles and peak traced memory for each email count and concurrency.
+usage: python bench_pipeline.py [--emails 100,1000,10000,100000] [--concurrency 1,8,32] [--stage both]
+    [--latency lognormal] [--median-latency-ms 20] [--rate-limit-probability 0.01] [--output results.json]
+"""
+import argparse
+import asyncio
+import json
+import os
+import tempfile
+import time
+import tracemalloc
+from calendar_service import CalendarService, event_id_for_message
+from email_service import Email, EmailService
+from email_summarizer import EmailSummarizer
+from email_to_event_service import EmailToEventService
+from logger import flush_logs, set_log_directory
+from fakes import LATENCY_DISTRIBUTIONS, FakeCalendarClient, FakeGmailService, FakeSummarizerAgent, make_fake_message, make_latency_sampler
+from metrics import metrics
+from rate_limiter import AdaptiveConcurrencyLimiter
+
+STAGES = ("summarizer", "service")
+
+
+def _is_important(i: int, important_every: int) -> bool:
+    return i % important_every == 0
+
+
+def _subject(i: int, important_every: int) -> str:
+    # the fake llm decides importance from the text, so the verdict is known up front
+    return f"Meeting {i}" if _is_important(i, important_every) else f"Newsletter {i}"
+
+
+def _body(i: int) -> str:
+    return f"Hi,\n\nThis is email {i}. " + "Some ordinary email text. " * 20
+
+
+def _percentiles(latencies: list[float]) -> dict[str, float]:
+    """ exact p50/p95/p99 in ms, the metrics histograms only interpolate within buckets """
+    if not latencies:
+        return {"p50_ms": 0.0, "p95_ms": 0.0, "p99_ms": 0.0}
+    ordered = sorted(latencies)
+    at = lambda q: ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000
+    return {"p50_ms": at(0.5), "p95_ms": at(0.95), "p99_ms": at(0.99)}
+
+
+def _fixed_limiter(concurrency: int) -> AdaptiveConcurrencyLimiter:
+    return AdaptiveConcurrencyLimiter(initial_limit=concurrency, min_limit=concurrency, max_limit=concurrency)
+
+
+def _make_agent(args) -> FakeSummarizerAgent:
+    return FakeSummarizerAgent(
+        is_important=lambda text: "Meeting" in text,
+        latency_seconds=make_latency_sampler(args.latency, args.median_latency_ms / 1000, sigma=args.sigma, seed=args.seed),
+        rate_limit_probability=args.rate_limit_probability,
+        retry_after=args.retry_after_ms / 1000,
+        seed=args.seed,
+    )
+
+
+async def _run_summarizer(n: int, concurrency: int, args) -> dict:
+    """ streams n emails into EmailSummarizer, latency is from an email entering the stream to its summary """
+    agent = _make_agent(args)
+    summarizer = EmailSummarizer(agent, email_service=None, concurrency_limiter=_fixed_limiter(concurrency))
+    emails = [Email(subject=_subject(i, args.important_every), body=_body(i), message_id=f"m{i}") for i in range(n)]
+    fed_at = []
+
+    async def stream():
+        for email in emails:
+            fed_at.append(time.perf_counter())
+            yield email
+
+    latencies = []
+    async for idx, _ in summarizer._summarize_emails_stream_async(stream()):
+        latencies.append(time.perf_counter() - fed_at[idx])
+    return {"completed": len(latencies), "latencies": latencies, "llm_calls": len(agent.calls), "rate_limited": agent.rate_limited}
+
+
+async def _run_service(n: int, concurrency: int, args) -> dict:
+    """
+    runs EmailToEventService.process_emails over n messages in a fake inbox, latency is from a message's first
+    gmail get to its calendar event being inserted (important emails only, the others never reach the calendar)
+    """
+    now_ms = int(time.time() * 1000)
+    gmail = FakeGmailService([
+        make_fake_message(f"m{i}", _subject(i, args.important_every), _body(i), internal_date_ms=now_ms)
+        for i in range(n)
+    ])
+    calendar = FakeCalendarClient()
+    agent = _make_agent(args)
+    summarizer = EmailSummarizer(agent, email_service=EmailService(creds=None, service=gmail), concurrency_limiter=_fixed_limiter(concurrency))
+    service = EmailToEventService(calendar_service=CalendarService(calendar_client=calendar), email_summarizer=summarizer, dry_run=False)
+
+    created = await service.process_emails()
+    latencies = [
+        calendar.inserted_at[event_id_for_message(f"m{i}")] - gmail.fetched_at[f"m{i}"]
+        for i in range(n) if _is_important(i, args.important_every)
+    ]
+    return {"completed": len(created), "latencies": latencies, "llm_calls": len(agent.calls), "rate_limited": agent.rate_limited}
+
+
+def _run(stage: str, n: int, concurrency: int, args, trace_memory: bool) -> tuple[float, dict, int]:
+    """ seconds, result, peak traced bytes. the service keeps its dbs in the working directory, so each run gets a fresh one """
+    run = _run_summarizer if stage == "summarizer" else _run_service
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        os.chdir(tmp_dir)
+        metrics.reset()
+        if trace_memory:
+            tracemalloc.start()
+        try:
+            start = time.perf_counter()
+            result = asyncio.run(run(n, concurrency, args))
+            seconds = time.perf_counter() - start
+            peak = tracemalloc.get_traced_memory()[1] if trace_memory else 0
+        finally:
+            if trace_memory:
+                tracemalloc.stop()
+            os.chdir(cwd)
+    return seconds, result, peak
+
+
+def _parse_ints(value: str) -> list[int]:
+    return [int(part) for part in value.split(",")]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the summarizer and the email to event pipeline offline")
+    parser.add_argument("--emails", type=_parse_ints, default=[100, 1000, 10_000, 100_000], help="Comma separated email counts")
+    parser.add_argument("--concurrency", type=_parse_ints, default=[1, 8, 32], help="Comma separated fixed llm concurrency limits")
+    parser.add_argument("--stage", choices=STAGES + ("both",), default="both", help="EmailSummarizer alone, the whole EmailToEventService, or both")
+    parser.add_argument("--latency", choices=LATENCY_DISTRIBUTIONS, default="lognormal", help="Distribution of fake llm call latency")
+    parser.add_argument("--median-latency-ms", type=float, default=20.0)
+    parser.add_argument("--sigma", type=float, default=0.5, help="Shape of the lognormal latency distribution")
+    parser.add_argument("--rate-limit-probability", type=float, default=0.0, help="Chance each fake llm call fails with a 429")
+    parser.add_argument("--retry-after-ms", type=float, default=50.0, help="retry-after sent with injected 429s")
+    parser.add_argument("--important-every", type=int, default=5, help="Every nth email is important and gets a calendar event")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--no-memory", action="store_true", help="Skip the second, tracemalloc-ed pass that measures peak memory")
+    parser.add_argument("--output", type=str, default=None, help="Also write the results as JSON, to compare runs across changes")
+    args = parser.parse_args()
+
+    # the pipeline logs every email, keep that out of the repo's logs/ (and the runs' own dirs, removed after each run)
+    log_dir = tempfile.TemporaryDirectory(prefix="bench_pipeline_logs_")
+    set_log_directory(log_dir.name)
+    try:
+        _run_all(args)
+    finally:
+        flush_logs()
+        set_log_directory(None)
+        log_dir.cleanup()
+
+
+def _run_all(args) -> None:
+    stages = STAGES if args.stage == "both" else (args.stage,)
+    print(f"fake llm: {args.latency} latency, median {args.median_latency_ms:g}ms, {args.rate_limit_probability:.1%} rate limited")
+    print(f"{'stage':<11} {'emails':>7} {'conc':>5} {'seconds':>8} {'emails/s':>9} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'llm calls':>9} {'429s':>5} {'peak MB':>8}")
+    results = []
+    for stage in stages:
+        for n in args.emails:
+            for concurrency in args.concurrency:
+                seconds, result, _ = _run(stage, n, concurrency, args, trace_memory=False)
+                # tracemalloc slows allocations down a lot, so memory gets its own pass instead of skewing the timings
+                peak = 0 if args.no_memory else _run(stage, n, concurrency, args, trace_memory=True)[2]
+                row = {
+                    "stage": stage,
+                    "emails": n,
+                    "concurrency": concurrency,
+                    "seconds": seconds,
+                    "emails_per_second": n / seconds,
+                    **_percentiles(result["latencies"]),
+                    "llm_calls": result["llm_calls"],
+                    "rate_limited": result["rate_limited"],
+                    "peak_mb": peak / 1e6,
+                    "completed": result["completed"],
+                }
+                results.append(row)
+                print(
+                    f"{stage:<11} {n:>7} {concurrency:>5} {seconds:>8.2f} {row['emails_per_second']:>9.1f} "
+                    f"{row['p50_ms']:>8.1f} {row['p95_ms']:>8.1f} {row['p99_ms']:>8.1f} {row['llm_calls']:>9} {row['rate_limited']:>5} "
+                    + (f"{row['peak_mb']:>8.1f}" if not args.no_memory else f"{'-':>8}")
+                )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"args": {k: v for k, v in vars(args).items() if k != "output"}, "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+"""Bloom filter for cheap negative membership checks in front of a slower store"""
+from typing import Iterable
+import math
+import numpy as np
+
+DEFAULT_CAPACITY = 100_000
+DEFAULT_ERROR_RATE = 0.01 # ~9.6 bits (1.2 bytes) per key
+
+
+def _hash_pairs(keys: list[str]) -> tuple[np.ndarray, np.ndarray]:
+    """
+    two 64-bit hashes per key: python's own str hash (cached on the string, and salted per process, which is fine
+    for a filter that is never persisted), and a splitmix64 scramble of it for the double hashing step
+    """
+    h1 = np.fromiter(map(hash, keys), dtype=np.int64, count=len(keys)).view(np.uint64)
+    h2 = h1 + np.uint64(0x9E3779B97F4A7C15)
+    h2 = (h2 ^ (h2 >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    h2 = (h2 ^ (h2 >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    h2 = h2 ^ (h2 >> np.uint64(31))
+    return h1, h2 | np.uint64(1) # an odd step never cycles back to the same bit early
+
+
+class BloomFilter:
+    """
+    Bit array with n_hashes bits set per key (double hashing). Never says a present key is absent, and says an
+    absent key is present with probability error_rate while it holds at most capacity keys.
+    add_many and contains_many hash a whole batch of keys and set/test their bits with a few NumPy calls.
+    """
+
+    def __init__(self, capacity: int = DEFAULT_CAPACITY, error_rate: float = DEFAULT_ERROR_RATE):
+        self.capacity = max(capacity, 1)
+        self.error_rate = error_rate
+        self.n_bits = math.ceil(-self.capacity * math.log(error_rate) / math.log(2) ** 2)
+        self.n_hashes = max(1, round(self.n_bits / self.capacity * math.log(2)))
+        self.bits = np.zeros((self.n_bits + 7) // 8, dtype=np.uint8)
+        self.count = 0 # keys added, counting repeats
+
+    def _bit_indices(self, keys: list[str]) -> np.ndarray:
+        h1, h2 = _hash_pairs(keys)
+        steps = np.arange(self.n_hashes, dtype=np.uint64)
+        return (h1[:, None] + steps * h2[:, None]) % np.uint64(self.n_bits) # (len(keys), n_hashes), wraps around mod 2**64
+
+    def add_many(self, keys: Iterable[str]) -> None:
+        keys = list(keys)
+        if not keys:
+            return
+        indices = self._bit_indices(keys).ravel()
+        np.bitwise_or.at(self.bits, (indices >> np.uint64(3)).astype(np.int64), (np.uint8(1) << (indices & np.uint64(7)).astype(np.uint8)))
+        self.count += len(keys)
+
+    def add(self, key: str) -> None:
+        self.add_many([key])
+
+    def contains_many(self, keys: Iterable[str]) -> list[bool]:
+        """ whether each key may be present """
+        keys = list(keys)
+        if not keys:
+            return []
+        indices = self._bit_indices(keys)
+        set_bits = (self.bits[(indices >> np.uint64(3)).astype(np.int64)] >> (indices & np.uint64(7)).astype(np.uint8)) & 1
+        return set_bits.all(axis=1).tolist()
+
+    def __contains__(self, key: str) -> bool:
+        return self.contains_many([key])[0]
+
+    def is_full(self) -> bool:
+        """ past capacity the false positive rate climbs above error_rate """
+        return self.count > self.capacity
+
+    def nbytes(self) -> int:
+        return self.bits.nbytes
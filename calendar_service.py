@@ -9,12 +9,47 @@ from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
 from google_creds import get_google_client_creds
+from email_service import is_throttled
+from metrics import metrics
+import hashlib
+import random
+import time
+
+DEFAULT_BATCH_SIZE = 50 # requests per google batch request
+MAX_BATCH_RETRIES = 5
+
+calendar_request_seconds = metrics.histogram("calendar_request_seconds", "Calendar API request latency, by call: insert or insert_batch")
+calendar_events = metrics.counter("calendar_events_total", "Calendar inserts by result: created, existing (409) or error")
+calendar_throttled = metrics.counter("calendar_throttled_total", "Calendar inserts retried after being throttled")
+
 @dataclass
 class CalendarEvent:
     title: str
     description: str = ""
     event_time_info : EventTimeInfo | None = None
+    message_id : str | None = None # gmail message the event was made from, makes the event id deterministic
+
+
+@dataclass
+class EventResult:
+    """ outcome of creating one event with CalendarService.create_events """
+    event_id: str | None
+    created: bool = False # False if the event already existed, or on error
+    error: Exception | None = None
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+def event_id_for_message(message_id: str) -> str:
+    """
+    Deterministic calendar event id for a gmail message, so retried inserts hit "409 already exists" instead of
+    creating duplicates. Event ids only allow base32hex characters (0-9, a-v), which hex digests are a subset of.
+    """
+    return hashlib.sha256(message_id.encode("utf-8")).hexdigest()[:32]
 
 
 CALENDAR_ID = "6f5d5b2a13964e30d423ef619b4bdb33d81b9abd9cf1d523b4d723e317b187a4@group.calendar.google.com"
@@ -30,24 +65,21 @@ class CalendarService:
         calendar_id: str = CALENDAR_ID,
         #tasklist_id: str = "@default",
         default_timezone: Timezone = Timezone.PST,
+        calendar_client=None,
     ):
+        """ calendar_client can be a pre-built calendar v3 client (e.g. a fake for tests) """
         self.calendar_id = calendar_id
         #self.tasklist_id = tasklist_id
         self.default_timezone = default_timezone
 
-        creds = get_google_client_creds()
         # Cache service clients
-        self._calendar = build("calendar", "v3", credentials=creds)
-        self._tasks = build("tasks", "v1", credentials=creds)
-
-    def create_event(self, event: CalendarEvent) -> str:
-        """
-        Creates a calendar event or a Google Task.
-        Returns the created resource ID (event id or task id).
-        """
-        # if event.is_task:
-        #     return self._create_task(event)
+        if calendar_client is None:
+            creds = get_google_client_creds()
+            calendar_client = build("calendar", "v3", credentials=creds)
+            self._tasks = build("tasks", "v1", credentials=creds)
+        self._calendar = calendar_client
 
+    def _event_body(self, event: CalendarEvent) -> dict:
         # Calendar events: need start/end; if missing, make a 30-min event "now"
         if not event.event_time_info:
             event.event_time_info = _create_default_event_time_info()
@@ -59,10 +91,78 @@ class CalendarService:
             "start": {"dateTime": start.isoformat(), "timeZone": self.default_timezone.value},
             "end": {"dateTime": end.isoformat(), "timeZone": self.default_timezone.value},
         }
+        if event.message_id:
+            body["id"] = event_id_for_message(event.message_id)
+        return body
 
-        created = self._calendar.events().insert(calendarId=self.calendar_id, body=body).execute()
+    def create_event(self, event: CalendarEvent) -> str:
+        """
+        Creates a calendar event or a Google Task.
+        Returns the created resource ID (event id or task id).
+        Events made from an email are idempotent: if one already exists for the email, its id is returned.
+        """
+        # if event.is_task:
+        #     return self._create_task(event)
+        body = self._event_body(event)
+        try:
+            with calendar_request_seconds.time(call="insert"):
+                created = self._calendar.events().insert(calendarId=self.calendar_id, body=body).execute()
+        except HttpError as e:
+            if e.status_code == 409 and "id" in body:
+                calendar_events.inc(result="existing")
+                return body["id"]
+            calendar_events.inc(result="error")
+            raise
+        calendar_events.inc(result="created")
         return created["id"]
 
+    def create_events(self, events: list[CalendarEvent], batch_size: int = DEFAULT_BATCH_SIZE) -> list[EventResult]:
+        """
+        Creates events with google batch requests, retrying only the inserts that got throttled.
+        Returns one result per event, in order. An event that already exists (409) counts as success,
+        other errors are reported in its result instead of failing the rest.
+        """
+        results = []
+        for start in range(0, len(events), batch_size):
+            results += self._execute_batch([self._event_body(event) for event in events[start:start + batch_size]])
+        return results
+
+    def _execute_batch(self, bodies: list[dict]) -> list[EventResult]:
+        results = {}
+        pending = list(range(len(bodies)))
+        for n in range(MAX_BATCH_RETRIES):
+            throttled = []
+
+            def callback(request_id, response, exception):
+                idx = int(request_id)
+                if exception is None:
+                    results[idx] = EventResult(event_id=response["id"], created=True)
+                elif isinstance(exception, HttpError) and exception.status_code == 409 and "id" in bodies[idx]:
+                    results[idx] = EventResult(event_id=bodies[idx]["id"])
+                elif is_throttled(exception):
+                    throttled.append(idx)
+                else:
+                    results[idx] = EventResult(event_id=bodies[idx].get("id"), error=exception)
+
+            batch = self._calendar.new_batch_http_request(callback=callback)
+            for idx in pending:
+                batch.add(self._calendar.events().insert(calendarId=self.calendar_id, body=bodies[idx]), request_id=str(idx))
+            with calendar_request_seconds.time(call="insert_batch"):
+                batch.execute()
+            calendar_throttled.inc(len(throttled))
+
+            if not throttled:
+                break
+            pending = sorted(throttled)
+            #randomly wait between 2^n and 2^(n+1) seconds
+            time.sleep(random.uniform(2**n, 2**(n+1)))
+        else:
+            for idx in pending:
+                results[idx] = EventResult(event_id=bodies[idx].get("id"), error=Exception("Max retries exceeded due to rate limiting."))
+        for result in results.values():
+            calendar_events.inc(result="error" if not result.ok else "created" if result.created else "existing")
+        return [results[idx] for idx in range(len(bodies))]
+
     # ----------------- internal helpers -----------------
 
     # def _create_task(self, event: CalendarEvent) -> str:
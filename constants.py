@@ -1,2 +1,8 @@
 DEBUG = True
-TIMEOUTS_SECONDS = 30
\ No newline at end of file
+TIMEOUTS_SECONDS = 30
+# what @logged_class does with method calls: "trace" records sampled span timings (with the args only for calls
+# that raise), "verbose" logs every call with its args and result, "off" leaves classes untouched
+LOGGED_CLASS_MODE = "trace"
+TRACE_SAMPLE_RATE = 1.0 # fraction of top-level calls traced, nested calls follow their parent
+TRACE_INCLUDE = [] # "Class" or "Class.method" fnmatch patterns to trace, empty traces everything not excluded
+TRACE_EXCLUDE = []
@@ -1,7 +1,25 @@
 """DB Layer interfaces and implementations"""
 from abc import ABC, abstractmethod
-from typing import Any
+from contextlib import contextmanager
+from enum import Enum
+from typing import Any, Callable, Iterable, Iterator
 import json
+import os
+import sqlite3
+import threading
+import time
+from bloom_filter import BloomFilter, DEFAULT_CAPACITY as DEFAULT_BLOOM_CAPACITY, DEFAULT_ERROR_RATE as DEFAULT_BLOOM_ERROR_RATE
+
+DEFAULT_COMPACTION_GARBAGE_RATIO = 0.5 # compact once over half the records on disk are overwritten or deleted
+DEFAULT_COMPACTION_MIN_RECORDS = 1000 # not worth compacting tiny files
+DEFAULT_FSYNC_INTERVAL_MS = 100
+SQLITE_MAX_VARIABLES = 500 # keys per query in get_many, safely under sqlite's bound parameter limit
+
+
+class FsyncPolicy(Enum):
+    ALWAYS = "always" # fsync every commit, a committed write survives a power loss
+    INTERVAL = "interval" # fsync within fsync_interval_ms of a commit (SQLiteDB: at WAL checkpoints), a power loss can drop the writes since the last fsync
+    NEVER = "never" # leave it to the OS, committed writes still survive the process crashing
 
 class DB(ABC):
     """
@@ -29,103 +47,512 @@ class DB(ABC):
     def delete(self, key: str) -> None:
         pass
 
+    @abstractmethod
+    def keys(self) -> list[str]:
+        """All keys currently stored, oldest first"""
+        pass
+
+    def put_many(self, items: dict[str, Any] | Iterable[tuple[str, Any]]) -> None:
+        items = items.items() if isinstance(items, dict) else items
+        for key, value in items:
+            self.put(key, value)
+
+    def get_many(self, keys: Iterable[str]) -> dict[str, Any]:
+        """The stored value of each of keys that is present"""
+        values = {}
+        for key in keys:
+            value = self.get(key)
+            if value is not None:
+                values[key] = value
+        return values
+
+    def contains_many(self, keys: Iterable[str]) -> set[str]:
+        """Those of keys that are present"""
+        return set(self.get_many(keys))
+
+    def flush(self) -> None:
+        """Makes every write so far durable, a no-op for implementations that write through"""
+        pass
+
+    @contextmanager
+    def batch(self) -> Iterator["DB"]:
+        """Groups the writes made inside it into one commit, for implementations that support it"""
+        yield self
+
+    def __enter__(self):
+        self.connect()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.disconnect()
+
     
     def __del__(self):
         self.disconnect()
 
+# module-level rather than FileDB methods, so replaying a large log doesn't go through the logging middleware per line
+def _escape(s: Any) -> str:
+    """
+    we use space and newline as delimiters, so escape them
+    """
+    s = str(s)
+
+    return (
+        s
+        .replace("\\", "\\\\")   # escape backslash FIRST
+        .replace(" ", "\\s")     # escape space
+        .replace("\n", "\\n")    # escape newline
+    )
+
+def _unescape(s: str) -> str:
+    return (
+        s
+        .replace("\\n", "\n")    # unescape newline FIRST
+        .replace("\\s", " ")      # unescape space
+        .replace("\\\\", "\\")    # unescape backslash
+    )
+
+def _parse_log_line(line: str) -> tuple[str, str, Any | None]:
+    """
+    Parses a log line into (action, key, value)
+    """
+    parts = line.split(" ")
+    action = parts[0]
+
+    if action == "DELETE":
+        if len(parts) != 2:
+            raise ValueError(f"Invalid DELETE log line: {line}")
+
+        return action, _unescape(parts[1]), None
+
+    if action == "PUT":
+        if len(parts) != 3:
+            raise ValueError(f"Invalid PUT log line: {line}")
+        return action, _unescape(parts[1]), _unescape(parts[2])
+
+
 from logger import logged_class
 @logged_class
 class FileDB(DB):
     """
     Simple log-based append-only file-based key-value DB implementation.
-    Stores all values in a single file.
+    Writes are appended to a log file. Compaction writes the live keys to a JSON snapshot next to it
+    (filename + ".snapshot") and truncates the log, so loading reads the snapshot and replays only the tail.
+    Compaction runs on demand, and automatically once the fraction of records on disk that are overwritten or
+    deleted reaches compaction_garbage_ratio (None disables it).
+
+    The log is kept open between writes. Each put/delete is committed on its own: written to the OS in one call
+    and fsynced according to fsync_policy. Inside a batch() (or a put_many) writes are buffered and group-committed
+    when it exits, with one write and at most one fsync. A batch isn't atomic: a crash mid-commit can keep a prefix
+    of it, and a torn last line is ignored on load.
+    With FsyncPolicy.INTERVAL a commit fsyncs if the last fsync is older than fsync_interval_ms, and otherwise a
+    background timer fsyncs when the interval is up, so a commit is never left unsynced for longer, even if the db
+    goes idle. File operations are serialized by a lock shared with the timer, the db is otherwise single threaded.
     """
 
-    def __init__(self, filename: str):
+    def __init__(
+        self,
+        filename: str,
+        compaction_garbage_ratio: float | None = DEFAULT_COMPACTION_GARBAGE_RATIO,
+        compaction_min_records: int = DEFAULT_COMPACTION_MIN_RECORDS,
+        fsync_policy: FsyncPolicy = FsyncPolicy.INTERVAL,
+        fsync_interval_ms: float = DEFAULT_FSYNC_INTERVAL_MS,
+    ):
         self.filename = filename
+        self.snapshot_filename = filename + ".snapshot"
+        self.compaction_garbage_ratio = compaction_garbage_ratio
+        self.compaction_min_records = compaction_min_records
+        self.fsync_policy = FsyncPolicy(fsync_policy)
+        self.fsync_interval_ms = fsync_interval_ms
         self.store = {}
+        self.disk_records = 0 # snapshot entries + log lines, live or not
+        self.compactions = 0
+        self.commits = 0
+        self.fsyncs = 0
+        self._file = None
+        self._batch_depth = 0
+        self._uncommitted = 0 # lines written to the buffer since the last commit
+        self._unsynced = False # committed writes not fsynced yet
+        self._last_fsync = time.monotonic()
+        self._fsync_timer: threading.Timer | None = None # pending background fsync, with FsyncPolicy.INTERVAL
+        self._lock = threading.RLock() # the background fsync mustn't race a write or a close
 
     def _load_state(self) -> None:
-        """ Loads the log from file and reconstructs the in-memory store """
+        """ Loads the snapshot and replays the log tail on top to reconstruct the in-memory store """
+        self.store = {}
+        try:
+            with open(self.snapshot_filename, 'r') as f:
+                self.store = json.load(f)
+        except FileNotFoundError:
+            pass
+        self.disk_records = len(self.store)
+
         try:
             with open(self.filename, 'r') as f:
                 store_data = f.read()
         except FileNotFoundError:
             store_data = ""
 
-        for event in store_data.splitlines():
-            action, key, value = self._parse_log_line(event)
+        events = store_data.splitlines()
+        if store_data and not store_data.endswith("\n"):
+            # torn by a crash mid-write, it was never committed. cut it off so the next append starts a fresh line
+            events.pop()
+            os.truncate(self.filename, len(store_data[:store_data.rfind("\n") + 1].encode()))
+        # after a crash between writing the snapshot and truncating the log, the log replays onto a snapshot
+        # that already contains it, which is harmless: the last record for each key still wins
+        for event in events:
+            action, key, value = _parse_log_line(event)
+            self.disk_records += 1
             if action == "PUT":
                 self.store[key] = value
             elif action == "DELETE" and key in self.store:
                 del self.store[key]
 
+    def garbage_ratio(self) -> float:
+        """ fraction of the records on disk that don't hold a live key """
+        if not self.disk_records:
+            return 0.0
+        return 1 - len(self.store) / self.disk_records
+
+    def _write_atomically(self, filename: str, content: str) -> None:
+        tmp_filename = filename + ".tmp"
+        with open(tmp_filename, 'w') as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_filename, filename) # readers see either the old or the new file, never a partial one
+
+    def compact(self) -> None:
+        """ Writes the live keys to a new snapshot, then truncates the log """
+        self._close()
+        # values are stored as strings in the log, keep the snapshot consistent with what a replay would give
+        self._write_atomically(self.snapshot_filename, json.dumps({key: str(value) for key, value in self.store.items()}))
+        self._write_atomically(self.filename, "")
+        self.disk_records = len(self.store)
+        self.compactions += 1
+
+    def _maybe_compact(self) -> None:
+        if (
+            self.compaction_garbage_ratio is not None
+            and self.disk_records >= self.compaction_min_records
+            and self.garbage_ratio() >= self.compaction_garbage_ratio
+        ):
+            self.compact()
+
 
     def connect(self, **kwargs) -> None:
         self._load_state()
 
 
     def disconnect(self) -> None:
-        return
-
-    def _escape(self, s: Any) -> str:
-        """
-        we use space and newline as delimiters, so escape them
-        """
-        s = str(s)
-
-        return (
-            s
-            .replace("\\", "\\\\")   # escape backslash FIRST
-            .replace(" ", "\\s")     # escape space
-            .replace("\n", "\\n")    # escape newline
-        )
-    def _unescape(self, s: str) -> str:
-        return (
-            s
-            .replace("\\n", "\n")    # unescape newline FIRST
-            .replace("\\s", " ")      # unescape space
-            .replace("\\\\", "\\")    # unescape backslash
-        )
+        self._close()
 
-    def put(self, key: str, value: Any) -> None:
-        # Append the PUT operation to the log file
-        with open(self.filename, 'a') as f:
-            f.write(f"PUT {self._escape(key)} {self._escape(value)}\n")
+    def _close(self) -> None:
+        with self._lock:
+            if self._fsync_timer:
+                self._fsync_timer.cancel()
+                self._fsync_timer = None
+            if self._file:
+                self.flush()
+                self._file.close()
+                self._file = None
+                # flush committed them, e.g. a compaction or disconnect in the middle of a batch leaves nothing for its exit
+                self._uncommitted = 0
+
+    def _append(self, line: str) -> None:
+        with self._lock:
+            if self._file is None:
+                # a big buffer, so a whole batch reaches the OS in one write
+                self._file = open(self.filename, 'a', buffering=1 << 20)
+            self._file.write(line)
+            self._uncommitted += 1
+            self._unsynced = True
+            if not self._batch_depth:
+                self._commit()
+
+    def _commit(self) -> None:
+        with self._lock:
+            self._file.flush()
+            self._uncommitted = 0
+            self.commits += 1
+            if self.fsync_policy is FsyncPolicy.ALWAYS:
+                self._fsync()
+            elif self.fsync_policy is FsyncPolicy.INTERVAL:
+                remaining_ms = self.fsync_interval_ms - (time.monotonic() - self._last_fsync) * 1000
+                if remaining_ms <= 0:
+                    self._fsync()
+                elif self._fsync_timer is None:
+                    self._fsync_timer = threading.Timer(remaining_ms / 1000, self._fsync_in_background)
+                    self._fsync_timer.daemon = True # an exit without disconnect still leaves the writes with the OS
+                    self._fsync_timer.start()
+            self._maybe_compact()
 
+    def _fsync_in_background(self) -> None:
+        with self._lock:
+            self._fsync_timer = None
+            # writes of an open batch aren't with the OS yet, its commit fsyncs or schedules another timer
+            if self._file is not None and self._unsynced and not self._uncommitted:
+                self._fsync()
+
+    def _fsync(self) -> None:
+        os.fsync(self._file.fileno())
+        self.fsyncs += 1
+        self._unsynced = False
+        self._last_fsync = time.monotonic()
+
+    def flush(self) -> None:
+        """ Commits any buffered writes and fsyncs them, whatever the policy """
+        with self._lock:
+            if self._file is None:
+                return
+            self._file.flush()
+            if self._unsynced:
+                self._fsync()
+
+    @contextmanager
+    def batch(self) -> Iterator["FileDB"]:
+        """ Buffers the writes made inside it and group-commits them on exit, batches can nest """
+        self._batch_depth += 1
+        try:
+            yield self
+        finally:
+            self._batch_depth -= 1
+            if not self._batch_depth and self._uncommitted:
+                self._commit()
+
+    def put_many(self, items: dict[str, Any] | Iterable[tuple[str, Any]]) -> None:
+        with self.batch():
+            super().put_many(items)
+
+    def put(self, key: str, value: Any) -> None:
+        # update the store first, committing may compact it to a snapshot
         self.store[key] = value
+        self.disk_records += 1
+        # Append the PUT operation to the log file
+        self._append(f"PUT {_escape(key)} {_escape(value)}\n")
 
 
     def delete(self, key: str) -> None:
         if key in self.store:
-            # Append the DELETE operation to the log file
-            with open(self.filename, 'a') as f:
-                f.write(f"DELETE {self._escape(key)}\n")
             del self.store[key]
+            self.disk_records += 1
+            # Append the DELETE operation to the log file
+            self._append(f"DELETE {_escape(key)}\n")
 
 
-    def _parse_log_line(self, line: str) -> tuple[str, str, Any | None]:
-        """
-        Parses a log line into (action, key, value)
-        """
-        parts = line.split(" ")
-        action = parts[0]
-        
-        if action == "DELETE":
-            if len(parts) != 2:
-                raise ValueError(f"Invalid DELETE log line: {line}")
-
-            return action, self._unescape(parts[1]), None
-        
-        if action == "PUT":
-            if len(parts) != 3:
-                raise ValueError(f"Invalid PUT log line: {line}")
-            return action, self._unescape(parts[1]), self._unescape(parts[2])
-        
-
     def get(self, key: str) -> Any:
         return self.store.get(key)
 
+    def get_many(self, keys: Iterable[str]) -> dict[str, Any]:
+        return {key: self.store[key] for key in keys if key in self.store}
+
+    def contains_many(self, keys: Iterable[str]) -> set[str]:
+        return {key for key in keys if key in self.store}
+
+    def keys(self) -> list[str]:
+        return list(self.store.keys())
+
+
+_SQLITE_SYNCHRONOUS = {
+    FsyncPolicy.ALWAYS: "FULL", # every commit is synced to disk
+    # in WAL mode, synced at checkpoints (every ~1000 pages written, and on disconnect) rather than on a timer:
+    # a power loss can drop every commit since the last one
+    FsyncPolicy.INTERVAL: "NORMAL",
+    FsyncPolicy.NEVER: "OFF",
+}
+
+
+from logger import logged_class
+@logged_class
+class SQLiteDB(DB):
+    """
+    Key-value DB in a single SQLite table, in WAL mode so readers never block the writer.
+    Unlike FileDB only the keys that are read are loaded, and keys can expire: put takes a ttl_seconds
+    (default_ttl_seconds if not given, None never expires). Expired keys are invisible to reads right away and
+    removed by expire(), which runs on connect and scans an index on the expiry time rather than the whole table.
+    Values are stored as strings, like FileDB returns them after a reload.
+    """
+
+    def __init__(
+        self,
+        filename: str,
+        default_ttl_seconds: float | None = None,
+        fsync_policy: FsyncPolicy = FsyncPolicy.INTERVAL,
+        clock: Callable[[], float] = time.time,
+    ):
+        self.filename = filename
+        self.default_ttl_seconds = default_ttl_seconds
+        self.fsync_policy = FsyncPolicy(fsync_policy)
+        self.clock = clock
+        self.expired = 0
+        self._conn: sqlite3.Connection | None = None
+        self._batch_depth = 0
+
+    def connect(self, **kwargs) -> None:
+        # autocommit, batch() opens explicit transactions. the gmail fetch thread checks known ids through this connection too
+        self._conn = sqlite3.connect(self.filename, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(f"PRAGMA synchronous={_SQLITE_SYNCHRONOUS[self.fsync_policy]}")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS kv_expires_at ON kv (expires_at) WHERE expires_at IS NOT NULL")
+        self.expire()
+
+    def disconnect(self) -> None:
+        if self._conn:
+            self._conn.close()
+            self._conn = None
+
+    def _expires_at(self, ttl_seconds: float | None) -> float | None:
+        return self.clock() + ttl_seconds if ttl_seconds is not None else None
+
+    @contextmanager
+    def batch(self) -> Iterator["SQLiteDB"]:
+        """ Runs the writes made inside it in one transaction, committed on exit or rolled back on an error """
+        self._batch_depth += 1
+        if self._batch_depth == 1:
+            self._conn.execute("BEGIN")
+        try:
+            yield self
+        except BaseException:
+            if self._batch_depth == 1:
+                self._conn.execute("ROLLBACK")
+            raise
+        else:
+            if self._batch_depth == 1:
+                self._conn.execute("COMMIT")
+        finally:
+            self._batch_depth -= 1
+
+    def put(self, key: str, value: Any, ttl_seconds: float | None = None) -> None:
+        self.put_many([(key, value)], ttl_seconds=ttl_seconds)
+
+    def put_many(self, items: dict[str, Any] | Iterable[tuple[str, Any]], ttl_seconds: float | None = None) -> None:
+        items = items.items() if isinstance(items, dict) else items
+        expires_at = self._expires_at(ttl_seconds if ttl_seconds is not None else self.default_ttl_seconds)
+        with self.batch():
+            # an upsert keeps the row (and so the key's position in keys()) of an overwritten key, like FileDB
+            self._conn.executemany(
+                "INSERT INTO kv (key, value, expires_at) VALUES (?, ?, ?) "
+                "ON CONFLICT (key) DO UPDATE SET value = excluded.value, expires_at = excluded.expires_at",
+                [(key, str(value), expires_at) for key, value in items],
+            )
+
+    def get(self, key: str) -> Any:
+        row = self._conn.execute(
+            "SELECT value FROM kv WHERE key = ? AND (expires_at IS NULL OR expires_at > ?)", (key, self.clock())
+        ).fetchone()
+        return row[0] if row else None
+
+    def _select_many(self, columns: str, keys: Iterable[str]) -> Iterator[tuple]:
+        """ one query per SQLITE_MAX_VARIABLES keys """
+        keys = list(keys)
+        for start in range(0, len(keys), SQLITE_MAX_VARIABLES):
+            chunk = keys[start:start + SQLITE_MAX_VARIABLES]
+            yield from self._conn.execute(
+                f"SELECT {columns} FROM kv WHERE key IN ({', '.join('?' * len(chunk))}) AND (expires_at IS NULL OR expires_at > ?)",
+                (*chunk, self.clock()),
+            )
+
+    def get_many(self, keys: Iterable[str]) -> dict[str, Any]:
+        return dict(self._select_many("key, value", keys))
+
+    def contains_many(self, keys: Iterable[str]) -> set[str]:
+        # answered from the primary key index alone, values are never read
+        return {key for key, in self._select_many("key", keys)}
+
+    def delete(self, key: str) -> None:
+        self._conn.execute("DELETE FROM kv WHERE key = ?", (key,))
+
+    def keys(self) -> list[str]:
+        rows = self._conn.execute("SELECT key FROM kv WHERE expires_at IS NULL OR expires_at > ? ORDER BY rowid", (self.clock(),))
+        return [key for key, in rows]
+
+    def expire(self) -> int:
+        """ Deletes the expired keys, returns how many there were """
+        deleted = self._conn.execute("DELETE FROM kv WHERE expires_at <= ?", (self.clock(),)).rowcount
+        self.expired += deleted
+        return deleted
+
+
+from logger import logged_class
+@logged_class
+class BloomFilteredDB(DB):
+    """
+    Wraps a DB with an in-memory BloomFilter of its keys, so lookups of absent keys (most of them, when checking
+    which of a page of new message ids are already processed) are answered without touching the store.
+    Keys that may be present are looked up in the store as usual. Deleted or expired keys stay in the filter,
+    which only costs a store lookup. Once past capacity the filter is rebuilt from the store at twice the size.
+    """
+
+    def __init__(self, db: DB, capacity: int = DEFAULT_BLOOM_CAPACITY, error_rate: float = DEFAULT_BLOOM_ERROR_RATE):
+        self.db = db
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.filter = BloomFilter(capacity, error_rate)
+        self.filtered_lookups = 0 # lookups answered by the filter alone
+
+    def _rebuild_filter(self) -> None:
+        keys = self.db.keys()
+        while len(keys) > self.capacity // 2:
+            self.capacity *= 2
+        self.filter = BloomFilter(self.capacity, self.error_rate)
+        self.filter.add_many(keys)
+
+    def _add(self, keys: list[str]) -> None:
+        self.filter.add_many(keys)
+        if self.filter.is_full():
+            self._rebuild_filter()
+
+    def connect(self, **kwargs) -> None:
+        self.db.connect(**kwargs)
+        self._rebuild_filter()
+
+    def disconnect(self) -> None:
+        self.db.disconnect()
+
+    def put(self, key: str, value: Any) -> None:
+        self.db.put(key, value)
+        self._add([key])
+
+    def put_many(self, items: dict[str, Any] | Iterable[tuple[str, Any]]) -> None:
+        items = list(items.items() if isinstance(items, dict) else items)
+        self.db.put_many(items)
+        self._add([key for key, _ in items])
+
+    def _maybe_present(self, keys: Iterable[str]) -> list[str]:
+        keys = list(keys)
+        maybe_present = [key for key, present in zip(keys, self.filter.contains_many(keys)) if present]
+        self.filtered_lookups += len(keys) - len(maybe_present)
+        return maybe_present
+
+    def get(self, key: str) -> Any:
+        return self.db.get(key) if self._maybe_present([key]) else None
+
+    def get_many(self, keys: Iterable[str]) -> dict[str, Any]:
+        maybe_present = self._maybe_present(keys)
+        return self.db.get_many(maybe_present) if maybe_present else {}
+
+    def contains_many(self, keys: Iterable[str]) -> set[str]:
+        maybe_present = self._maybe_present(keys)
+        return self.db.contains_many(maybe_present) if maybe_present else set()
+
+    def delete(self, key: str) -> None:
+        self.db.delete(key)
+
+    def keys(self) -> list[str]:
+        return self.db.keys()
+
+    def flush(self) -> None:
+        self.db.flush()
 
+    @contextmanager
+    def batch(self) -> Iterator["BloomFilteredDB"]:
+        with self.db.batch():
+            yield self
 
 
+def migrate(source: DB, destination: DB) -> int:
+    """ Copies every key of a connected source DB into a connected destination in one batch, returns how many """
+    keys = source.keys()
+    destination.put_many((key, source.get(key)) for key in keys)
+    return len(keys)
@@ -1,38 +1,336 @@
 from google_auth_oauthlib.flow import InstalledAppFlow
 from google.oauth2.credentials import Credentials
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
 import base64
-from dataclasses import  dataclass
-from typing import Generator
+from dataclasses import  dataclass, field
+from typing import Callable, Container, Generator, Iterator
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import threading
 import os,json
 from google_creds import get_google_client_creds
 import datetime
+import random
+import time
+import asyncio
+from collections import deque
+from typing import AsyncGenerator
+import httpx
+from google.auth.transport.requests import Request
+from constants import TIMEOUTS_SECONDS
+from metrics import metrics
+
+DEFAULT_BATCH_SIZE = 50 # gmail recommends at most 50 requests per batch to avoid rate limiting
+MAX_BATCH_RETRIES = 5
+DEFAULT_PAGE_SIZE = 500 # max page size allowed by messages().list
+THROTTLED_REASONS = ("rateLimitExceeded", "userRateLimitExceeded")
+GMAIL_API_BASE_URL = "https://gmail.googleapis.com/gmail/v1/users/me/"
+DEFAULT_FETCH_CONCURRENCY = 10
+
+METADATA_HEADERS = ["Subject", "From", "List-Unsubscribe"] # headers requested in metadata-first mode
 
 @dataclass
-class Email:
+class KnownIdsLookup:
+    """Checks a whole page of message ids at once, e.g. with one db query, returning the known ones"""
+    known_among: Callable[[list[str]], Container[str]]
+
+gmail_request_seconds = metrics.histogram("gmail_request_seconds", "Gmail API request latency, by call: list, history, get (one message) or get_batch")
+gmail_throttled = metrics.counter("gmail_throttled_total", "Gmail requests (or batch sub-requests) retried after being throttled")
+
+# message ids to skip before fetching their details: a set-like container, a predicate or a page-at-a-time lookup
+KnownIds = Container[str] | Callable[[str], bool] | KnownIdsLookup
+
+def is_throttled(exception: Exception) -> bool:
+    """ whether a google api error is a rate limit, worth retrying after a backoff """
+    if not isinstance(exception, HttpError):
+        return False
+    if exception.status_code == 429:
+        return True
+    return exception.status_code == 403 and any(
+        reason in str(exception.content) for reason in THROTTLED_REASONS
+    )
+
+class HistoryExpiredError(Exception):
+    """Raised when a stored gmail historyId is too old to sync from, so a full window scan is needed."""
+    pass
+
+@dataclass
+class EmailContent:
+    """ the part of an email the llm reads and echoes back in its structured output """
     subject : str # Subject of the email. Exactly as in the email.
     body : str # A brief summary of the email body text. Containing key points and action items.
     message_id : str | None =  None # Unique identifier for the email message.
 
     def __str__(self):
         return f"Subject: {self.subject}\nBody: {self.body}"
-    
+
+
+@dataclass
+class Email(EmailContent):
+    """ an EmailContent plus header metadata, for rules and local models only (kept out of the llm's output schema) """
+    sender : str | None = None # The From header, if fetched.
+    list_unsubscribe : str | None = None # The List-Unsubscribe header, if present. Usually means bulk mail.
+    label_ids : list[str] = field(default_factory=list) # Gmail label ids, e.g. CATEGORY_PROMOTIONS.
+
+
 from logger import logged_class
 @logged_class
 class EmailService:
     """For reading emails from a personal Gmail account using Gmail API."""
 
-    def __init__(self, creds):
-        """token for Gmail API access."""
+    def __init__(self, creds, service=None):
+        """token for Gmail API access. service can be a pre-built gmail client (e.g. a fake for tests)."""
         self.creds = creds
+        self.service = service
+        self._idle_services = [] # built clients no thread is using, building one costs a discovery doc parse
+        self._services_lock = threading.Lock()
 
+    @contextmanager
+    def _borrow_service(self):
+        """
+        A gmail client for the calling thread's exclusive use (the underlying http clients are not thread safe).
+        Clients are built once and handed back for reuse, a new one is only built when all the others are in use.
+        """
+        if self.service is not None:
+            yield self.service
+            return
+        with self._services_lock:
+            service = self._idle_services.pop() if self._idle_services else None
+        if service is None:
+            service = build("gmail", "v1", credentials=self.creds)
+        try:
+            yield service
+        finally:
+            with self._services_lock:
+                self._idle_services.append(service)
 
-    def _get_subject(self, msg):
-        headers = msg["payload"]["headers"]
-        for header in headers:
-            if header["name"] == "Subject":
+    def _get_message_request(self, service, message_id: str, format: str = "full"):
+        if format == "metadata":
+            return service.users().messages().get(userId="me", id=message_id, format=format, metadataHeaders=METADATA_HEADERS)
+        return service.users().messages().get(userId="me", id=message_id, format=format)
+
+    def _execute_batch(self, service, message_ids: list[str], format: str = "full") -> list[dict]:
+        """
+        Fetches the given messages in a single batch request, retrying only the sub-requests that got throttled.
+        Returns the message details in the same order as message_ids.
+        """
+        results = {}
+        pending = list(range(len(message_ids)))
+        for n in range(MAX_BATCH_RETRIES):
+            throttled = []
+            errors = []
+
+            def callback(request_id, response, exception):
+                idx = int(request_id)
+                if exception is None:
+                    results[idx] = response
+                elif is_throttled(exception):
+                    throttled.append(idx)
+                else:
+                    errors.append(exception)
+
+            batch = service.new_batch_http_request(callback=callback)
+            for idx in pending:
+                batch.add(
+                    self._get_message_request(service, message_ids[idx], format=format),
+                    request_id=str(idx),
+                )
+            with gmail_request_seconds.time(call="get_batch"):
+                batch.execute()
+            gmail_throttled.inc(len(throttled))
+
+            if errors:
+                raise errors[0]
+            if not throttled:
+                return [results[idx] for idx in range(len(message_ids))]
+
+            pending = sorted(throttled)
+            #randomly wait between 2^n and 2^(n+1) seconds
+            time.sleep(random.uniform(2**n, 2**(n+1)))
+        raise Exception("Max retries exceeded due to rate limiting.")
+
+    def _fetch_message_details(self, service, message_ids: list[str], batch_size: int | None = DEFAULT_BATCH_SIZE, format: str = "full") -> Generator[dict, None, None]:
+        """
+        Yields message details for message_ids, in order. format is "full" or "metadata" (headers and labels only).
+        If batch_size is None, falls back to one request per message.
+        """
+        if not batch_size:
+            for message_id in message_ids:
+                with gmail_request_seconds.time(call="get"):
+                    message = self._get_message_request(service, message_id, format=format).execute()
+                yield message
+            return
+
+        for start in range(0, len(message_ids), batch_size):
+            yield from self._execute_batch(service, message_ids[start:start + batch_size], format=format)
+
+    def _list_message_pages(self, service, max_results: int | None = None, page_size: int = DEFAULT_PAGE_SIZE, **list_kwargs) -> Generator[list[str], None, None]:
+        """
+        Lazily follows nextPageToken, yielding the message ids of one page at a time.
+        Stops after max_results ids if given.
+        """
+        page_token = None
+        remaining = max_results
+        while remaining is None or remaining > 0:
+            with gmail_request_seconds.time(call="list"):
+                results = (
+                    service.users()
+                    .messages()
+                    .list(
+                        userId="me",
+                        maxResults=page_size if remaining is None else min(page_size, remaining),
+                        pageToken=page_token,
+                        **list_kwargs,
+                    )
+                    .execute()
+                )
+            message_ids = [msg["id"] for msg in results.get("messages", [])]
+            if remaining is not None:
+                message_ids = message_ids[:remaining]
+                remaining -= len(message_ids)
+            if message_ids:
+                yield message_ids
+
+            page_token = results.get("nextPageToken")
+            if not page_token:
+                return
+
+    def _prefetch_pages(self, pages: Iterator[list[str]]) -> Generator[list[str], None, None]:
+        """
+        Pulls pages from a background thread one page ahead, so listing page N+1 overlaps with
+        fetching the details of page N.
+        """
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            next_page = executor.submit(next, pages, None)
+            while True:
+                page = next_page.result()
+                if page is None:
+                    return
+                next_page = executor.submit(next, pages, None)
+                yield page
+
+    def _filter_known(self, message_ids: list[str], known_ids: KnownIds | None) -> list[str]:
+        if known_ids is None:
+            return message_ids
+        if isinstance(known_ids, KnownIdsLookup):
+            known = known_ids.known_among(message_ids)
+            return [message_id for message_id in message_ids if message_id not in known]
+        is_known = known_ids if callable(known_ids) else known_ids.__contains__
+        return [message_id for message_id in message_ids if not is_known(message_id)]
+
+    def _iter_emails(
+        self,
+        max_results: int | None,
+        page_size: int,
+        batch_size: int | None,
+        known_ids: KnownIds | None = None,
+        email_filter: Callable[[Email], bool] | None = None,
+        **list_kwargs,
+    ) -> Generator[Email, None, None]:
+        # the lister thread gets its own client since the underlying http clients are not thread safe
+        with self._borrow_service() as lister_service, self._borrow_service() as service:
+            pages = self._list_message_pages(lister_service, max_results=max_results, page_size=page_size, **list_kwargs)
+            yield from self._iter_page_emails(service, self._prefetch_pages(pages), batch_size, known_ids, email_filter)
+
+    def _iter_page_emails(
+        self,
+        service,
+        pages: Iterator[list[str]],
+        batch_size: int | None,
+        known_ids: KnownIds | None,
+        email_filter: Callable[[Email], bool] | None,
+    ) -> Generator[Email, None, None]:
+        for message_ids in pages:
+            message_ids = self._filter_known(message_ids, known_ids)
+            if email_filter is None:
+                for msg_detail in self._fetch_message_details(service, message_ids, batch_size=batch_size):
+                    yield self._to_email(msg_detail)
+                continue
+
+            # metadata first, then bodies only for the emails that pass the filter
+            emails = [
+                self._to_metadata_email(msg_detail)
+                for msg_detail in self._fetch_message_details(service, message_ids, batch_size=batch_size, format="metadata")
+            ]
+            emails = [email for email in emails if email_filter(email)]
+            self._load_bodies(service, emails, batch_size=batch_size)
+            yield from emails
+
+    def _list_history_message_ids(self, service, start_history_id: str) -> list[str]:
+        """
+        Returns the ids of messages added since start_history_id (and not deleted since), newest first.
+        """
+        added = {} # dict as an ordered set
+        deleted = set()
+        page_token = None
+        while True:
+            try:
+                with gmail_request_seconds.time(call="history"):
+                    results = (
+                        service.users()
+                        .history()
+                        .list(
+                            userId="me",
+                            startHistoryId=start_history_id,
+                            historyTypes=["messageAdded", "messageDeleted"],
+                            maxResults=DEFAULT_PAGE_SIZE,
+                            pageToken=page_token,
+                        )
+                        .execute()
+                    )
+            except HttpError as e:
+                if e.status_code == 404: # gmail returns 404 once the history id has expired
+                    raise HistoryExpiredError(f"History id {start_history_id} has expired") from e
+                raise
+
+            for record in results.get("history", []):
+                for added_msg in record.get("messagesAdded", []):
+                    added[added_msg["message"]["id"]] = None
+                for deleted_msg in record.get("messagesDeleted", []):
+                    deleted.add(deleted_msg["message"]["id"])
+
+            page_token = results.get("nextPageToken")
+            if not page_token:
+                break
+
+        # history records are oldest first, flip to match messages().list ordering
+        return [message_id for message_id in reversed(added) if message_id not in deleted]
+
+    def _to_email(self, msg_detail) -> Email:
+        return Email(
+            message_id= msg_detail["id"],
+            subject=self._get_subject(msg_detail),
+            body=self._get_body(msg_detail),
+            sender=self._get_header(msg_detail, "From"),
+            list_unsubscribe=self._get_header(msg_detail, "List-Unsubscribe"),
+            label_ids=msg_detail.get("labelIds", []),
+        )
+
+    def _to_metadata_email(self, msg_detail) -> Email:
+        """ an email from a format=metadata message, without its body until _load_bodies fills it in """
+        return Email(
+            message_id=msg_detail["id"],
+            subject=self._get_subject(msg_detail),
+            body=None,
+            sender=self._get_header(msg_detail, "From"),
+            list_unsubscribe=self._get_header(msg_detail, "List-Unsubscribe"),
+            label_ids=msg_detail.get("labelIds", []),
+        )
+
+    def _load_bodies(self, service, emails: list[Email], batch_size: int | None) -> None:
+        message_ids = [email.message_id for email in emails]
+        for email, msg_detail in zip(emails, self._fetch_message_details(service, message_ids, batch_size=batch_size)):
+            email.body = self._get_body(msg_detail)
+
+    def _get_header(self, msg, name: str, default: str | None = None) -> str | None:
+        for header in msg["payload"].get("headers", []):
+            if header["name"].lower() == name.lower():
                 return header["value"]
-        return "No Subject"
+        return default
+
+    def _get_subject(self, msg):
+        return self._get_header(msg, "Subject", default="No Subject")
 
     def _get_snippet(self, msg):
         return msg.get("snippet", "No Snippet")
@@ -48,65 +346,207 @@ class EmailService:
             return base64.urlsafe_b64decode(msg["payload"]["body"]["data"]).decode("utf-8")
         return "No Body"
 
-    def get_last_n_emails(self, n=5) -> Generator[Email, None, None]:
-        # generator for the last n emails
-        
-        # read last 5 email
-        service = build("gmail", "v1", credentials=self.creds)
-        results = (
-            service.users().messages()
-            .list(userId="me", maxResults=n)
-            .execute()
+    def get_last_n_emails(
+        self,
+        n=5,
+        batch_size: int | None = DEFAULT_BATCH_SIZE,
+        page_size: int = DEFAULT_PAGE_SIZE,
+        known_ids: KnownIds | None = None,
+        email_filter: Callable[[Email], bool] | None = None,
+    ) -> Generator[Email, None, None]:
+        # generator for the last n emails, minus any known_ids. See get_recent_emails for email_filter.
+        yield from self._iter_emails(
+            max_results=n,
+            page_size=page_size,
+            batch_size=batch_size,
+            known_ids=known_ids,
+            email_filter=email_filter,
         )
-        messages = results.get("messages", [])
-        for msg in messages:
-            msg_detail = (
-                service.users()
-                .messages()
-                .get(userId="me", id=msg["id"])
-                .execute()
-            )
-            yield Email(
-                subject=self._get_subject(msg_detail),
-                message_id= msg_detail["id"],
-                body=self._get_body(msg_detail),
-            )
 
 
-    def get_recent_emails(self, cutoff_time: datetime) -> Generator[Email, None, None]:
-        # generator for emails since cutoff_time
-        service = build("gmail", "v1", credentials=self.creds)
-        after_ts = int(cutoff_time.timestamp())
+    def get_recent_emails(
+        self,
+        cutoff_time: datetime,
+        batch_size: int | None = DEFAULT_BATCH_SIZE,
+        page_size: int = DEFAULT_PAGE_SIZE,
+        max_results: int | None = None,
+        known_ids: KnownIds | None = None,
+        email_filter: Callable[[Email], bool] | None = None,
+    ) -> Generator[Email, None, None]:
+        """
+        generator for emails since cutoff_time, following result pages until max_results (if given) is reached.
+        Emails from the first page are yielded while later pages are still being listed.
+        Ids matching known_ids are dropped right after listing, so their bodies are never downloaded.
 
-        results = (
-            service.users()
-            .messages()
-            .list(
-                userId="me",
-                q=f"after:{after_ts}",
-                maxResults=1000, # TODO: implement pagination to handle more than this amount if even possible
-            )
-            .execute()
+        Metadata-first mode: if email_filter is given, only headers and labels are fetched up front, and the filter
+        sees emails without a body (None). Emails it rejects are dropped, and the bodies of the rest are batch-downloaded
+        before they are yielded, so a consumer never triggers a download.
+        """
+        after_ts = int(cutoff_time.timestamp())
+        yield from self._iter_emails(
+            max_results=max_results,
+            page_size=page_size,
+            batch_size=batch_size,
+            known_ids=known_ids,
+            email_filter=email_filter,
+            q=f"after:{after_ts}",
         )
 
-        messages = results.get("messages", [])
-        for msg in messages:
-            msg_detail = (  # TODO: implement batching of these calls to reduce network roundtrips
-                service.users()
-                .messages()
-                .get(userId="me", id=msg["id"])
-                .execute()
-            )
+    def get_current_history_id(self) -> str:
+        """ the mailbox's latest historyId, to be stored and passed to get_emails_since_history on the next sync """
+        with self._borrow_service() as service:
+            profile = service.users().getProfile(userId="me").execute()
+        return str(profile["historyId"])
 
-            yield Email(
-                message_id= msg_detail["id"],
-                subject=self._get_subject(msg_detail),
-                body=self._get_body(msg_detail),
-            )
+    def get_emails_since_history(
+        self,
+        start_history_id: str,
+        batch_size: int | None = DEFAULT_BATCH_SIZE,
+        known_ids: KnownIds | None = None,
+        email_filter: Callable[[Email], bool] | None = None,
+    ) -> Generator[Email, None, None]:
+        """
+        Incremental sync: generator for emails added since start_history_id, minus any known_ids.
+        See get_recent_emails for email_filter.
+        Raises HistoryExpiredError right away (not on first iteration) if the history id is too old.
+        """
+        with self._borrow_service() as service:
+            message_ids = self._filter_known(self._list_history_message_ids(service, start_history_id), known_ids)
+        return self._iter_message_emails(message_ids, batch_size=batch_size, email_filter=email_filter)
+
+    def _iter_message_emails(self, message_ids: list[str], batch_size: int | None, email_filter: Callable[[Email], bool] | None = None) -> Generator[Email, None, None]:
+        with self._borrow_service() as service:
+            yield from self._iter_page_emails(service, iter([message_ids]), batch_size, None, email_filter)
 
     @staticmethod   
     def create_email_service():
 
         creds = get_google_client_creds()
         return EmailService(creds)
-    
+
+
+@logged_class
+class AsyncEmailService(EmailService):
+    """
+    Async variant of EmailService. Talks to the Gmail REST API through one cached, pooled http client
+    and fetches message details with bounded concurrency, so consumers can start on the first email
+    while the rest are still downloading.
+    """
+
+    def __init__(self, creds, client: httpx.AsyncClient | None = None, concurrency: int = DEFAULT_FETCH_CONCURRENCY):
+        """client can be a pre-built httpx client (e.g. with a mock transport for tests)."""
+        super().__init__(creds)
+        self.concurrency = concurrency
+        self._client = client
+
+    def _get_client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                base_url=GMAIL_API_BASE_URL,
+                limits=httpx.Limits(max_connections=self.concurrency, max_keepalive_connections=self.concurrency),
+                timeout=TIMEOUTS_SECONDS,
+            )
+        return self._client
+
+    async def _auth_headers(self) -> dict[str, str]:
+        if self.creds is None:
+            return {}
+        if not self.creds.valid:
+            await asyncio.to_thread(self.creds.refresh, Request())
+        return {"Authorization": f"Bearer {self.creds.token}"}
+
+    def _is_throttled_response(self, response: httpx.Response) -> bool:
+        if response.status_code == 429:
+            return True
+        return response.status_code == 403 and any(reason in response.text for reason in THROTTLED_REASONS)
+
+    async def _get_json(self, path: str, params: dict | None = None) -> dict:
+        for n in range(MAX_BATCH_RETRIES):
+            headers = await self._auth_headers()
+            with gmail_request_seconds.time(call="list" if path == "messages" else "get"):
+                response = await self._get_client().get(path, params=params, headers=headers)
+            if not self._is_throttled_response(response):
+                response.raise_for_status()
+                return response.json()
+            gmail_throttled.inc()
+            #randomly wait between 2^n and 2^(n+1) seconds
+            await asyncio.sleep(random.uniform(2**n, 2**(n+1)))
+        raise Exception("Max retries exceeded due to rate limiting.")
+
+    async def _list_message_pages_async(self, max_results: int | None = None, page_size: int = DEFAULT_PAGE_SIZE, **list_params) -> AsyncGenerator[list[str], None]:
+        """ async version of _list_message_pages """
+        page_token = None
+        remaining = max_results
+        while remaining is None or remaining > 0:
+            params = {
+                "maxResults": page_size if remaining is None else min(page_size, remaining),
+                **list_params,
+            }
+            if page_token:
+                params["pageToken"] = page_token
+            results = await self._get_json("messages", params=params)
+
+            message_ids = [msg["id"] for msg in results.get("messages", [])]
+            if remaining is not None:
+                message_ids = message_ids[:remaining]
+                remaining -= len(message_ids)
+            if message_ids:
+                yield message_ids
+
+            page_token = results.get("nextPageToken")
+            if not page_token:
+                return
+
+    async def _iter_emails_async(self, max_results: int | None, page_size: int, known_ids: KnownIds | None = None, **list_params) -> AsyncGenerator[Email, None]:
+        """
+        Yields emails in list order while keeping up to self.concurrency detail fetches in flight.
+        The next page is listed concurrently with fetching the current one.
+        """
+        pages = self._list_message_pages_async(max_results=max_results, page_size=page_size, **list_params)
+        next_page = asyncio.ensure_future(anext(pages, None))
+        in_flight = deque()
+        try:
+            while True:
+                message_ids = await next_page
+                if message_ids is None:
+                    break
+                next_page = asyncio.ensure_future(anext(pages, None))
+
+                for message_id in self._filter_known(message_ids, known_ids):
+                    if len(in_flight) >= self.concurrency:
+                        yield self._to_email(await in_flight.popleft())
+                    in_flight.append(asyncio.ensure_future(self._get_json(f"messages/{message_id}")))
+
+            while in_flight:
+                yield self._to_email(await in_flight.popleft())
+        finally:
+            next_page.cancel()
+            for task in in_flight:
+                task.cancel()
+
+    async def get_last_n_emails_async(self, n=5, page_size: int = DEFAULT_PAGE_SIZE, known_ids: KnownIds | None = None) -> AsyncGenerator[Email, None]:
+        # async generator for the last n emails, minus any known_ids
+        async for email in self._iter_emails_async(max_results=n, page_size=page_size, known_ids=known_ids):
+            yield email
+
+    async def get_recent_emails_async(
+        self,
+        cutoff_time: datetime,
+        page_size: int = DEFAULT_PAGE_SIZE,
+        max_results: int | None = None,
+        known_ids: KnownIds | None = None,
+    ) -> AsyncGenerator[Email, None]:
+        """ async generator for emails since cutoff_time, see get_recent_emails """
+        after_ts = int(cutoff_time.timestamp())
+        async for email in self._iter_emails_async(max_results=max_results, page_size=page_size, known_ids=known_ids, q=f"after:{after_ts}"):
+            yield email
+
+    async def aclose(self) -> None:
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    @staticmethod
+    def create_email_service(concurrency: int = DEFAULT_FETCH_CONCURRENCY):
+        creds = get_google_client_creds()
+        return AsyncEmailService(creds, concurrency=concurrency)
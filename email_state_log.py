@@ -0,0 +1,95 @@
+"""Write-ahead log of each email's progress through EmailToEventService.process_emails"""
+from enum import Enum
+import json
+from db import DB
+
+
+class EmailState(Enum):
+    FETCHED = "fetched" # about to be summarized
+    SUMMARIZED = "summarized" # summary stored in the log, no llm call needed to finish
+    EVENT_CREATED = "event_created" # calendar event exists, only marking the email processed is left
+    DONE = "done" # finished emails are deleted from the log now, this is only found in logs of older versions
+
+
+# states whose llm work is already paid for, so the email must never be summarized again
+SUMMARIZED_STATES = (EmailState.SUMMARIZED, EmailState.EVENT_CREATED, EmailState.DONE)
+
+
+from logger import logged_class
+@logged_class
+class EmailStateLog:
+    """
+    Records each email's state transitions through a DB before moving on, so a crashed run can resume
+    from the last recorded state instead of repeating llm or calendar work.
+    Values are JSON records with the state, the summary (as a dict) once summarized and the event id once created.
+    Finished emails are deleted, the log only holds the ones still in flight.
+    """
+
+    def __init__(self, db: DB):
+        self.db = db
+
+    def get(self, message_id: str) -> dict | None:
+        record = self.db.get(message_id)
+        return json.loads(record) if record else None
+
+    def state(self, message_id: str) -> EmailState | None:
+        record = self.get(message_id)
+        return EmailState(record["state"]) if record else None
+
+    def is_summarized(self, message_id: str) -> bool:
+        return self.state(message_id) in SUMMARIZED_STATES
+
+    def summarized_among(self, message_ids: list[str]) -> set[str]:
+        """ is_summarized for a whole page of message ids, with one db call """
+        records = self.db.get_many(message_ids)
+        return {message_id for message_id, record in records.items() if EmailState(json.loads(record)["state"]) in SUMMARIZED_STATES}
+
+    def _put(self, message_id: str, record: dict) -> None:
+        self.db.put(message_id, json.dumps(record))
+
+    def mark_fetched(self, message_id: str) -> None:
+        self.mark_fetched_many([message_id])
+
+    def mark_fetched_many(self, message_ids: list[str]) -> None:
+        """ with one lookup and one commit """
+        known = self.db.get_many(message_ids) # never move an email back to an earlier state
+        with self.db.batch():
+            self.db.put_many((message_id, json.dumps({"state": EmailState.FETCHED.value})) for message_id in message_ids if message_id not in known)
+
+    def mark_summarized(self, message_id: str, summary: dict) -> None:
+        self._put(message_id, {"state": EmailState.SUMMARIZED.value, "summary": summary})
+
+    def mark_event_created(self, message_id: str, event_id: str) -> None:
+        record = self.get(message_id) or {}
+        self._put(message_id, {"state": EmailState.EVENT_CREATED.value, "summary": record.get("summary"), "event_id": event_id})
+
+    def mark_done(self, message_id: str) -> None:
+        # the caller records the email as processed elsewhere first, the log only keeps emails in flight
+        self.db.delete(message_id)
+
+    def _records(self) -> list[tuple[str, dict]]:
+        """ every (message_id, record), oldest first """
+        keys = list(self.db.keys())
+        records = self.db.get_many(keys)
+        return [(message_id, json.loads(records[message_id])) for message_id in keys if message_id in records]
+
+    def pending(self) -> list[tuple[str, dict]]:
+        """ (message_id, record) of emails a previous run summarized but didn't finish, oldest first """
+        return [(message_id, record) for message_id, record in self._records() if EmailState(record["state"]) in (EmailState.SUMMARIZED, EmailState.EVENT_CREATED)]
+
+    def stats(self) -> dict[str, int]:
+        counts = {state.value: 0 for state in EmailState}
+        for _, record in self._records():
+            counts[record["state"]] += 1
+        return counts
+
+    def import_legacy(self, legacy_db: DB, processed_db: DB) -> int:
+        """
+        copies the records of a log from before finished emails were deleted: done emails go to processed_db
+        (where finished emails are recorded now), the rest to this log. Returns the number of records copied.
+        """
+        legacy = EmailStateLog(legacy_db)._records()
+        with self.db.batch(), processed_db.batch():
+            processed_db.put_many((message_id, True) for message_id, record in legacy if record["state"] == EmailState.DONE.value)
+            self.db.put_many((message_id, json.dumps(record)) for message_id, record in legacy if record["state"] != EmailState.DONE.value)
+        return len(legacy)
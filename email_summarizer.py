@@ -5,7 +5,7 @@ from logger import logged_class
 from db import FileDB
 from anthropic import RateLimitError
 import random
-from email_service import EmailService, Email
+from email_service import EmailService, Email, EmailContent
 from langgraph.graph.state import CompiledStateGraph
 from dataclasses import dataclass
 from langchain.chat_models.base import BaseChatModel
@@ -20,15 +20,38 @@ from langchain_core.callbacks import BaseCallbackHandler
 from datetime import datetime, timedelta, timezone
 from logger import logged_class, Logger
 from constants import TIMEOUTS_SECONDS
+from typing import AsyncIterable, AsyncGenerator, Callable, Iterable, Any
+from summary_cache import SummaryCache
+from rate_limiter import AdaptiveConcurrencyLimiter, TokenBucketRateLimiter
+from pre_classifier import RuleBasedPreClassifier, Verdict
+from local_classifier import LocalClassifier, Prediction
+from micro_batcher import MicroBatcher
+from metrics import metrics
+import collections
+import dataclasses
+import hashlib
+import time
 
 MAX_CHARS_PER_EMAIL = 1000
 DEFAULT_CONCURRENCY = 5
+SUMMARIZER_PROMPT_PATH = "prompts/single_email_summarizer_system_prompt.txt"
+CRITIC_PROMPT_PATH = "prompts/critic_prompt.txt"
+SUMMARY_CACHE_DB_PATH = "summary_cache_db.txt"
+BATCH_INSTRUCTIONS_PATH = "prompts/batch_email_summarizer_instructions.txt"
+DEFAULT_BATCH_SIZE = 1 # emails per summarizer request, 1 disables batching
+DEFAULT_BATCH_TOKEN_BUDGET = 4000 # max estimated tokens (emails in + summaries out) per batched request
+CHARS_PER_TOKEN = 4 # rough estimate for english text
+OUTPUT_TOKENS_PER_SUMMARY = 150
+DEFAULT_CRITIC_CONFIDENCE_THRESHOLD = 0.8 # "not important" verdicts at least this confident skip the critic, 1.0 reviews them all
+DEFAULT_CRITIC_BATCH_SIZE = 1 # summaries per critic request, 1 disables batching
+DEFAULT_MAX_BUFFERED_EMAILS = 500 # emails taken from a stream but not yet handed to the consumer
+LOCAL_CLASSIFIER_CHUNK_SIZE = 256 # max queued emails the local classifier vectorizes together
 
 def _init_summarizer_prompt() -> str:
     """
     loads and initializes the email summarizer system prompt with dynamic policy information.
     """
-    base_prompt = open("prompts/single_email_summarizer_system_prompt.txt").read()
+    base_prompt = open(SUMMARIZER_PROMPT_PATH).read()
     
     policy_text_lines = []
     # add current timestamp
@@ -40,7 +63,8 @@ def _init_summarizer_prompt() -> str:
 
 DEBUG = False
 SUMMARIZER_SYSTEM_PROMPT_TEMPLATE =_init_summarizer_prompt()
-CRITIC_SYSTEM_PROMPT = open("prompts/critic_prompt.txt").read()
+CRITIC_SYSTEM_PROMPT = open(CRITIC_PROMPT_PATH).read()
+BATCH_INSTRUCTIONS = open(BATCH_INSTRUCTIONS_PATH).read()
 logger = Logger(context = "EmailSummarizer", debug=DEBUG)
 
 
@@ -91,9 +115,10 @@ class EventTimeInfo():
 class EmailSummaryResponseFormat:
     """ Summary for a single email.  """
     
-    email : Email | None  # The email being summarized. Leave none if is_important is false.
+    email : EmailContent | None  # The email being summarized. Leave none if is_important is false.
     is_important: bool #Whether the email is important and should be included in the summary.
     event_time_info: EventTimeInfo | None  # If the email is about a time-bounded event, the event time info.
+    confidence: float  # How sure you are about is_important, from 0.0 (a guess) to 1.0 (certain).
 
 
 @dataclass 
@@ -113,14 +138,122 @@ CACHED_EMAIL_SUMMARIZER_SYSTEM_MESSAGE = SystemMessage(
     ]
 )
 
-def init_email_summarizer(model : BaseChatModel, with_critic: bool = False, response_format : type[EmailSummaryResponseFormat] = EmailSummaryResponseFormat) -> CompiledStateGraph:
+def make_batch_response_format(response_format : type[EmailSummaryResponseFormat]) -> type:
+    """
+    Builds the structured output type for batched requests: a list of response_format items, each tagged with
+    the id of the email it summarizes so results can be mapped back.
+    """
+    item_format = dataclasses.make_dataclass(
+        response_format.__name__ + "Item",
+        [("email_id", str)],
+        bases=(response_format,),
+    )
+    item_format.__doc__ = "Summary for one email in a batch. email_id is the id attribute of the <email> tag it summarizes."
+    batch_format = dataclasses.make_dataclass(
+        response_format.__name__ + "Batch",
+        [("summaries", list[item_format])],
+    )
+    batch_format.__doc__ = "Summaries for every email in the batch, exactly one per email."
+    return batch_format
+
+def estimate_tokens(text: str) -> int:
+    return len(text) // CHARS_PER_TOKEN + 1
+
+# resent with every request (cache reads still count towards the per-minute token budget)
+SUMMARIZER_PROMPT_TOKENS = estimate_tokens(SUMMARIZER_SYSTEM_PROMPT_TEMPLATE)
+CRITIC_PROMPT_TOKENS = estimate_tokens(CRITIC_SYSTEM_PROMPT)
+
+RESPONSE_FORMATS = {cls.__name__: cls for cls in (EmailSummaryResponseFormat, EmailSummaryResponseFormatDebug)}
+
+def _to_jsonable(obj: Any) -> Any:
+    if isinstance(obj, datetime):
+        return obj.isoformat()
+    if isinstance(obj, Enum):
+        return obj.value
+    if isinstance(obj, dict):
+        return {k: _to_jsonable(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [_to_jsonable(v) for v in obj]
+    return obj
+
+def summary_to_dict(summary: EmailSummaryResponseFormat) -> dict:
+    """ JSON-serializable form of a summary, for caching """
+    data = _to_jsonable(dataclasses.asdict(summary))
+    data["response_format"] = type(summary).__name__
+    return data
+
+def summary_from_dict(data: dict) -> EmailSummaryResponseFormat:
+    """ inverse of summary_to_dict """
+    data = dict(data)
+    response_format = RESPONSE_FORMATS[data.pop("response_format")]
+    email = data.pop("email", None)
+    if email:
+        # summaries cached by older versions may carry the email's header metadata too
+        email = EmailContent(**{f.name: email[f.name] for f in dataclasses.fields(EmailContent) if f.name in email})
+    event_time_info = data.pop("event_time_info", None)
+    if event_time_info:
+        event_time_info = EventTimeInfo(
+            start_time=datetime.fromisoformat(event_time_info["start_time"]),
+            end_time=datetime.fromisoformat(event_time_info["end_time"]),
+            timezone=Timezone(event_time_info["timezone"]),
+        )
+    return response_format(email=email, event_time_info=event_time_info, **data)
+
+def _get_model_id(model : BaseChatModel) -> str:
+    return getattr(model, "model", None) or getattr(model, "model_name", None) or type(model).__name__
+
+def _get_prompt_version(with_critic: bool, response_format : type[EmailSummaryResponseFormat], critic_confidence_threshold: float = DEFAULT_CRITIC_CONFIDENCE_THRESHOLD, max_chars_per_email: int = MAX_CHARS_PER_EMAIL) -> str:
+    """ changes whenever anything that affects the summary for a given email text changes """
+    parts = [open(SUMMARIZER_PROMPT_PATH).read(), response_format.__name__, str(max_chars_per_email)]
+    if with_critic:
+        parts += [open(CRITIC_PROMPT_PATH).read(), str(critic_confidence_threshold)]
+    return hashlib.sha256("\0".join(parts).encode("utf-8")).hexdigest()[:16]
+
+def _init_summary_cache(model : BaseChatModel, with_critic: bool, response_format : type[EmailSummaryResponseFormat], critic_confidence_threshold: float, max_chars_per_email: int = MAX_CHARS_PER_EMAIL) -> SummaryCache:
+    db = FileDB(SUMMARY_CACHE_DB_PATH)
+    db.connect()
+    return SummaryCache(db, model_id=_get_model_id(model), prompt_version=_get_prompt_version(with_critic, response_format, critic_confidence_threshold, max_chars_per_email))
+
+def init_email_summarizer(
+    model : BaseChatModel,
+    with_critic: bool = False,
+    response_format : type[EmailSummaryResponseFormat] = EmailSummaryResponseFormat,
+    use_summary_cache: bool = False,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    batch_token_budget: int = DEFAULT_BATCH_TOKEN_BUDGET,
+    rate_limiter: TokenBucketRateLimiter | None = None,
+    pre_classifier: RuleBasedPreClassifier | None = None,
+    local_classifier: LocalClassifier | None = None,
+    critic_confidence_threshold: float = DEFAULT_CRITIC_CONFIDENCE_THRESHOLD,
+    critic_batch_size: int = DEFAULT_CRITIC_BATCH_SIZE,
+    max_chars_per_email: int = MAX_CHARS_PER_EMAIL,
+) -> CompiledStateGraph:
     agent = _init_email_summarizer_agent(model, response_format=response_format)
+    batch_agent = _init_email_summarizer_agent(model, response_format=make_batch_response_format(response_format)) if batch_size > 1 else None
     critic_agent = _init_critic_agent(model) if with_critic else None
+    batch_critic_agent = _init_critic_agent(model, response_format=make_batch_response_format(EmailSummaryResponseFormat)) if with_critic and critic_batch_size > 1 else None
     email_service = EmailService.create_email_service()
-    return EmailSummarizer(agent, email_service, critic_agent= critic_agent)
+    summary_cache = _init_summary_cache(model, with_critic, response_format, critic_confidence_threshold, max_chars_per_email) if use_summary_cache else None
+    return EmailSummarizer(
+        agent,
+        email_service,
+        critic_agent= critic_agent,
+        summary_cache= summary_cache,
+        response_format= response_format,
+        batch_summarizer_agent= batch_agent,
+        batch_size= batch_size,
+        batch_token_budget= batch_token_budget,
+        rate_limiter= rate_limiter,
+        pre_classifier= pre_classifier,
+        local_classifier= local_classifier,
+        batch_critic_agent= batch_critic_agent,
+        critic_batch_size= critic_batch_size,
+        critic_confidence_threshold= critic_confidence_threshold,
+        max_chars_per_email= max_chars_per_email,
+    )
 
 
-def _init_email_summarizer_agent(model : BaseChatModel, response_format : type[EmailSummaryResponseFormat] = EmailSummaryResponseFormat) -> CompiledStateGraph:
+def _init_email_summarizer_agent(model : BaseChatModel, response_format : type = EmailSummaryResponseFormat) -> CompiledStateGraph:
     return create_agent(
         model=model,
         system_prompt = CACHED_EMAIL_SUMMARIZER_SYSTEM_MESSAGE,
@@ -146,11 +279,11 @@ def _create_default_event_time_info() -> EventTimeInfo:
     )
 
 
-def _init_critic_agent(model : BaseChatModel) -> CompiledStateGraph:
+def _init_critic_agent(model : BaseChatModel, response_format : type = EmailSummaryResponseFormat) -> CompiledStateGraph:
     return create_agent(
         model=model,
         system_prompt = CACHED_CRITIC_SYSTEM_MESSAGE,
-        response_format=ToolStrategy(EmailSummaryResponseFormat),
+        response_format=ToolStrategy(response_format),
 
     )
 
@@ -159,103 +292,518 @@ def _init_critic_agent(model : BaseChatModel) -> CompiledStateGraph:
 
 INVOKE_CONFIG=  {"configurable": {"max_tokens": 100}}
 
+async def _aiter_emails(emails: Iterable[Email] | AsyncIterable[Email]) -> AsyncGenerator[Email, None]:
+    """ iterates over a list or an async stream of emails (e.g. from AsyncEmailService) """
+    if isinstance(emails, AsyncIterable):
+        async for email in emails:
+            yield email
+    else:
+        for email in emails:
+            yield email
+
 log = Logger(context = "EmailSummarizer", debug=DEBUG)
 
+llm_request_seconds = metrics.histogram("llm_request_seconds", "LLM request latency, by agent")
+llm_requests = metrics.counter("llm_requests_total", "LLM requests, by agent")
+llm_tokens = metrics.counter("llm_tokens_total", "LLM tokens by agent and kind: input (including cached), output, cache_read, cache_creation")
+llm_cache_hit_requests = metrics.counter("llm_cache_hit_requests_total", "LLM requests that read from the prompt cache, by agent")
+llm_retries = metrics.counter("llm_retries_total", "LLM requests retried after a rate limit error")
+llm_timeouts = metrics.counter("llm_timeouts_total", "Emails whose summary timed out")
+llm_queue_wait_seconds = metrics.histogram("llm_queue_wait_seconds", "Time summarizer workers waited for a concurrency slot")
+
+
+TOKEN_KINDS = ("input", "output", "cache_read", "cache_creation") # input includes the cache reads and writes
+
+def llm_usage(resp: dict) -> dict[str, int]:
+    """ tokens by kind, added up over the usage metadata langchain attaches to each model message of an agent response """
+    tokens = dict.fromkeys(TOKEN_KINDS, 0)
+    for message in resp.get("messages", []):
+        usage = getattr(message, "usage_metadata", None)
+        if not usage:
+            continue
+        details = usage.get("input_token_details") or {}
+        tokens["input"] += usage.get("input_tokens", 0)
+        tokens["output"] += usage.get("output_tokens", 0)
+        tokens["cache_read"] += details.get("cache_read") or 0
+        tokens["cache_creation"] += details.get("cache_creation") or 0
+    return tokens
+
+def _record_llm_usage(agent: str, resp: dict) -> None:
+    llm_requests.inc(agent=agent)
+    tokens = llm_usage(resp)
+    for kind, count in tokens.items():
+        llm_tokens.inc(count, agent=agent, kind=kind)
+    if tokens["cache_read"]:
+        llm_cache_hit_requests.inc(agent=agent)
+
+def _get_retry_after(error: RateLimitError) -> float | None:
+    """ seconds the provider asked us to wait, from the retry-after(-ms) response headers """
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    try:
+        if "retry-after-ms" in headers:
+            return float(headers["retry-after-ms"]) / 1000
+        if "retry-after" in headers:
+            return float(headers["retry-after"])
+    except ValueError: # retry-after can also be an http date, fall back to exponential backoff
+        pass
+    return None
+
 @logged_class
 class EmailSummarizer:
-    async def _invoke_with_exp_backoff_retries(self, call):
+    async def _invoke_with_exp_backoff_retries(self, call, limiter : AdaptiveConcurrencyLimiter | None = None):
+        limiter = limiter or self.concurrency_limiter
         for n in range(8): # max of up to 4 minutes
             try:
-                return await call()
+                result = await call()
+                limiter.on_success()
+                return result
             except RateLimitError as e:
-                #randomly wait between 2^n and 2^(n+1) seconds
-                wait_time = random.uniform(2**n, 2**(n+1))
-                log.log(f"Rate limit error encountered in attempt {n}. Retrying in {wait_time} seconds...")
+                llm_retries.inc()
+                # tell the shared limiter so the other workers back off too
+                retry_after = _get_retry_after(e)
+                limiter.on_overload(retry_after=retry_after)
+                #randomly wait between 2^n and 2^(n+1) seconds, unless the provider told us how long to wait
+                wait_time = retry_after or random.uniform(2**n, 2**(n+1))
+                log.log("Rate limit error encountered in attempt %d. Retrying in %s seconds, concurrency limit now %d...", n, wait_time, limiter.current_limit)
                 await asyncio.sleep(wait_time)
         raise Exception("Max retries exceeded due to rate limiting.")
     
 
-    def __init__(self,  email_summarizer_agent : CompiledStateGraph,  email_service: EmailService, critic_agent : CompiledStateGraph | None = None):
+    def __init__(
+        self,
+        email_summarizer_agent : CompiledStateGraph,
+        email_service: EmailService,
+        critic_agent : CompiledStateGraph | None = None,
+        summary_cache : SummaryCache | None = None,
+        response_format : type[EmailSummaryResponseFormat] = EmailSummaryResponseFormat,
+        batch_summarizer_agent : CompiledStateGraph | None = None,
+        batch_size : int = DEFAULT_BATCH_SIZE,
+        batch_token_budget : int = DEFAULT_BATCH_TOKEN_BUDGET,
+        concurrency_limiter : AdaptiveConcurrencyLimiter | None = None,
+        rate_limiter : TokenBucketRateLimiter | None = None,
+        pre_classifier : RuleBasedPreClassifier | None = None,
+        local_classifier : LocalClassifier | None = None,
+        batch_critic_agent : CompiledStateGraph | None = None,
+        critic_batch_size : int = DEFAULT_CRITIC_BATCH_SIZE,
+        critic_confidence_threshold : float = DEFAULT_CRITIC_CONFIDENCE_THRESHOLD,
+        max_chars_per_email : int = MAX_CHARS_PER_EMAIL,
+        request_timeout_seconds : float = TIMEOUTS_SECONDS,
+    ):
         self.email_summarizer_agent = email_summarizer_agent
         self.email_service = email_service
         self.critic_agent = critic_agent
+        self.summary_cache = summary_cache # if set, identical emails are only sent to the llm once
+        self.response_format = response_format
+        self.batch_summarizer_agent = batch_summarizer_agent # agent with make_batch_response_format(response_format) output
+        self.batch_size = batch_size if batch_summarizer_agent else 1
+        self.batch_token_budget = batch_token_budget
+        # shared by all workers (and runs), adapts how many llm calls are in flight to the provider's rate limits
+        self.concurrency_limiter = concurrency_limiter or AdaptiveConcurrencyLimiter(initial_limit=DEFAULT_CONCURRENCY)
+        # if set, paces summarizer and critic requests to stay under the provider's requests/tokens per minute
+        self.rate_limiter = rate_limiter
+        # per llm request (times the emails in it for batches). waiting on the rate limiter or a retry backoff doesn't count
+        self.request_timeout_seconds = request_timeout_seconds
+        # if set, emails it is sure about skip the llm entirely
+        self.pre_classifier = pre_classifier
+        # if set, emails it is confident about skip the llm, and it learns from the llm's decisions on the rest
+        self.local_classifier = local_classifier
+        self.critic_confidence_threshold = critic_confidence_threshold
+        self.max_chars_per_email = max_chars_per_email # emails are truncated to this many characters before going to the llm
+        # agent with make_batch_response_format(EmailSummaryResponseFormat) output, reviews summaries from concurrent workers together
+        self.batch_critic_agent = batch_critic_agent
+        self.critic_batcher = MicroBatcher(self._review_batch_async, max_batch_size=critic_batch_size) if batch_critic_agent and critic_batch_size > 1 else None
+        self.critic_reviews = 0
+        self.critic_skipped = 0 # confident enough to skip the critic
+        self.critic_flips = 0 # verdicts the critic changed
+        self.critic_requests = 0
+
+    def _make_local_summary(self, email: Email, is_important: bool, confidence: float, justification: str) -> EmailSummaryResponseFormat:
+        """ summary for an email decided without the llm """
+        fields = {
+            "email": EmailContent(subject=email.subject, body=email.body, message_id=email.message_id),
+            "is_important": is_important,
+            "event_time_info": None, # no llm to extract it, the calendar service falls back to a default time
+            "confidence": confidence,
+        }
+        if "justification" in {f.name for f in dataclasses.fields(self.response_format)}:
+            fields["justification"] = justification
+        return self.response_format(**fields)
+
+    def _decide_locally(self, email: Email, prediction: Prediction | None) -> EmailSummaryResponseFormat | None:
+        """ summary from the pre-classifier or local classifier, or None if the email needs the llm """
+        if self.pre_classifier:
+            verdict, rule_name = self.pre_classifier.classify(email)
+            if verdict is not Verdict.ASK_LLM:
+                return self._make_local_summary(email, verdict is Verdict.IMPORTANT, 1.0, f"Decided by pre-classifier rule '{rule_name}'")
+        if self.local_classifier:
+            prediction = prediction or self.local_classifier.predict([email])[0]
+            if self.local_classifier.decide(prediction):
+                return self._make_local_summary(email, prediction.is_important, prediction.confidence, f"Decided by local classifier with confidence {prediction.confidence:.2f}")
+        return None
+
+    def _learn_from_llm(self, emails: list[Email], summaries: list[EmailSummaryResponseFormat]) -> None:
+        learned = self.local_classifier.learn(emails, [summary.is_important for summary in summaries])
+        if learned and self.local_classifier.path:
+            self.local_classifier.save()
+        log.log("Local classifier learned %d new llm decisions. Stats: %s", learned, self.local_classifier.stats())
+
+    async def _pace(self, input_tokens: int, output_tokens: int) -> None:
+        if self.rate_limiter:
+            await self.rate_limiter.acquire(input_tokens + output_tokens)
+
+    def _email_to_prompt_text(self, email: Email) -> str:
+        return strip_html_and_urls(str(email))[:self.max_chars_per_email]
+
+    def _get_cached_summary(self, email: Email, email_str: str) -> EmailSummaryResponseFormat | None:
+        if not self.summary_cache:
+            return None
+        cached = self.summary_cache.get(email_str)
+        if cached is None:
+            return None
+        logger.log("Summary cache hit for Email with Subject: %s", email.subject)
+        structured = summary_from_dict(cached)
+        if structured.email:
+            # the cached entry may come from a copy of this email with different casing/whitespace
+            structured.email.subject = email.subject
+        return structured
 
-    async def _summarize_single_email_async(self, email: Email) -> EmailSummaryResponseFormat:
-        email_str = strip_html_and_urls(str(email))[:MAX_CHARS_PER_EMAIL]
-        logger.log("Summarizing Email with Subject: " + email.subject)
-
-        resp = await self.email_summarizer_agent.ainvoke(
-            {"messages": [{"role": "user", "content": email_str}]},
-            config=INVOKE_CONFIG,
+    def _needs_review(self, structured : EmailSummaryResponseFormat) -> bool:
+        # only invoke critic if email marked not important, to prevent false negatives, and the summarizer wasn't sure
+        if not self.critic_agent or structured.is_important:
+            return False
+        if getattr(structured, "confidence", 0.0) >= self.critic_confidence_threshold:
+            self.critic_skipped += 1
+            return False
+        return True
+
+    async def _review_single_async(self, structured : EmailSummaryResponseFormat) -> EmailSummaryResponseFormat:
+        self.critic_requests += 1
+        await self._pace(CRITIC_PROMPT_TOKENS + estimate_tokens(str(structured)), OUTPUT_TOKENS_PER_SUMMARY)
+        critic_resp = await self._invoke_agent("critic", self.critic_agent, str(structured))
+        return critic_resp["structured_response"]
+
+    async def _review_batch_async(self, summaries : list[EmailSummaryResponseFormat]) -> list[EmailSummaryResponseFormat]:
+        """
+        Reviews several summaries with one request to the batch critic agent.
+        Summaries missing or malformed in the response fall back to single critic requests.
+        """
+        if len(summaries) == 1:
+            return [await self._review_single_async(summaries[0])]
+
+        email_ids = [str(i) for i in range(len(summaries))]
+        content = BATCH_INSTRUCTIONS + "\n\n" + "\n\n".join(
+            f'<email id="{email_id}">\n{structured}\n</email>' for email_id, structured in zip(email_ids, summaries)
         )
-        logger.log("Completed invocation for Email with Subject: " + email.subject)
+        logger.log("Reviewing batch of %d summaries", len(summaries))
+        self.critic_requests += 1
+        await self._pace(CRITIC_PROMPT_TOKENS + estimate_tokens(content), OUTPUT_TOKENS_PER_SUMMARY * len(summaries))
+        try:
+            resp = await self._invoke_agent("critic_batch", self.batch_critic_agent, content, n_emails=len(summaries))
+            parsed = self._parse_batch_response(resp, email_ids, response_format=EmailSummaryResponseFormat)
+        except (RateLimitError, asyncio.TimeoutError):
+            raise
+        except Exception as e: # malformed structured output, fall back to single requests for the whole batch
+            logger.log("Batch critic review failed, falling back to single requests: %s", repr(e))
+            parsed = {}
+
+        async def finish(email_id: str, structured: EmailSummaryResponseFormat) -> EmailSummaryResponseFormat:
+            if email_id in parsed:
+                return parsed[email_id]
+            # retried on its own, a rate limit here mustn't fail (and so re-review) the whole batch
+            return await self._invoke_with_exp_backoff_retries(lambda: self._review_single_async(structured))
+
+        return list(await asyncio.gather(*(finish(email_id, structured) for email_id, structured in zip(email_ids, summaries))))
+
+    async def _apply_critic_async(self, structured : EmailSummaryResponseFormat, limiter : AdaptiveConcurrencyLimiter | None = None) -> EmailSummaryResponseFormat:
+        if not self._needs_review(structured):
+            return structured
+        self.critic_reviews += 1
+        review = self.critic_batcher.submit if self.critic_batcher else self._review_single_async
+        # retried on its own, a rate limited review mustn't redo the summary it reviews
+        reviewed = await self._invoke_with_exp_backoff_retries(lambda: review(structured), limiter=limiter)
+        if reviewed.is_important != structured.is_important:
+            self.critic_flips += 1
+        return reviewed
+
+    def critic_stats(self) -> dict[str, float]:
+        return {
+            "reviews": self.critic_reviews,
+            "skipped": self.critic_skipped,
+            "flips": self.critic_flips,
+            "requests": self.critic_requests,
+        }
 
-        # log message history for debugging
-        logger.log("LLM Message History:\n" + str(resp))
+    async def _invoke_agent(self, agent_name: str, agent : CompiledStateGraph, content: str, n_emails: int = 1) -> dict:
+        """
+        sends one user message (about n_emails emails) to an agent, recording the request's latency and token usage
+        under agent_name. raises asyncio.TimeoutError if the request takes longer than its share of the timeout
+        """
+        with llm_request_seconds.time(agent=agent_name):
+            resp = await asyncio.wait_for(
+                agent.ainvoke({"messages": [{"role": "user", "content": content}]}, config=INVOKE_CONFIG),
+                timeout=self.request_timeout_seconds * n_emails, # output, and so generation time, grows with the batch
+            )
+        _record_llm_usage(agent_name, resp)
+        return resp
 
-        # usage = resp.get("usage") or resp.get("llm_output", {}).get("usage")
+    async def _summarize_single_email_async(self, email: Email) -> EmailSummaryResponseFormat:
+        email_str = self._email_to_prompt_text(email)
+        cached = self._get_cached_summary(email, email_str)
+        if cached is not None:
+            return cached
 
-        # # log token usage
-        # logger.log(f"Token usage for summarizing email '{email.subject}': {usage}")
+        logger.log("Summarizing Email with Subject: %s", email.subject)
 
-        structured : EmailSummaryResponseFormat = resp["structured_response"]
+        await self._pace(SUMMARIZER_PROMPT_TOKENS + estimate_tokens(email_str), OUTPUT_TOKENS_PER_SUMMARY)
+        resp = await self._invoke_agent("summarizer", self.email_summarizer_agent, email_str)
+        logger.log("Completed invocation for Email with Subject: %s", email.subject)
 
-        # only invoke critic if email marked not important, to prevent false negatives
-        if not structured.is_important and self.critic_agent:
-            critic_resp = await self.critic_agent.ainvoke(
-                {"messages": [{"role": "user", "content": str(structured)}]},
-                config=INVOKE_CONFIG,
-            )
-            # usage = resp.get("usage") or resp.get("llm_output", {}).get("usage")
-            # logger.log(f"Token usage for critic on email '{email.subject}': {usage}")
-            structured = critic_resp["structured_response"]
+        structured : EmailSummaryResponseFormat = resp["structured_response"]
+        # just the verdict: the whole message history would be rendered on the event loop for every email (it's mutable)
+        logger.debug("LLM verdict for Email with Subject: %s: important=%s confidence=%s", email.subject, structured.is_important, getattr(structured, "confidence", None))
+        structured = await self._apply_critic_async(structured)
 
+        if self.summary_cache:
+            self.summary_cache.put(email_str, summary_to_dict(structured))
         return structured
-    
-    async def _summarize_emails_async(self, emails: list[Email], concurrency: int = DEFAULT_CONCURRENCY):
-        log.log(f"Summarizing {len(emails)} emails with concurrency {concurrency}...")
-        sem = asyncio.Semaphore(concurrency) # limits how many tasks can actively make llm calls at once
 
-        async def worker(idx: int, email: Email):
-            log.log(f"Entering critical section for email {idx}, subject: {email.subject}")
-            async with sem:
+    def _parse_batch_response(self, resp: dict, email_ids: list[str], response_format : type[EmailSummaryResponseFormat] | None = None) -> dict[str, EmailSummaryResponseFormat]:
+        """ maps batch items back to email ids, dropping malformed items, unknown ids and duplicates """
+        response_format = response_format or self.response_format
+        summaries = getattr(resp.get("structured_response"), "summaries", None) or []
+        field_names = [f.name for f in dataclasses.fields(response_format)]
+        results = {}
+        for item in summaries:
+            email_id = getattr(item, "email_id", None)
+            if email_id not in email_ids or email_id in results:
+                continue
+            try:
+                results[email_id] = response_format(**{name: getattr(item, name) for name in field_names})
+            except (AttributeError, TypeError):
+                continue
+        return results
+
+    async def _summarize_batch_async(self, emails: list[Email], limiter : AdaptiveConcurrencyLimiter | None = None) -> list[EmailSummaryResponseFormat]:
+        """
+        Summarizes several emails with one request to the batch agent.
+        Emails whose summary is missing or malformed in the response fall back to single-email requests.
+        Only the batch request itself raises RateLimitError, the follow-up requests are retried on their own (through
+        limiter) so the summaries already parsed aren't requested again.
+        """
+        if len(emails) == 1 or not self.batch_summarizer_agent:
+            return [await self._summarize_single_email_async(email) for email in emails]
+
+        email_strs = [self._email_to_prompt_text(email) for email in emails]
+        results = [self._get_cached_summary(email, email_str) for email, email_str in zip(emails, email_strs)]
+        # short positional ids are cheaper and harder for the model to garble than gmail message ids
+        pending = {str(i): i for i, result in enumerate(results) if result is None}
+        if not pending:
+            return results
+
+        content = BATCH_INSTRUCTIONS + "\n\n" + "\n\n".join(
+            f'<email id="{email_id}">\n{email_strs[i]}\n</email>' for email_id, i in pending.items()
+        )
+        logger.log("Summarizing batch of %d emails", len(pending))
+        await self._pace(SUMMARIZER_PROMPT_TOKENS + estimate_tokens(content), OUTPUT_TOKENS_PER_SUMMARY * len(pending))
+        try:
+            resp = await self._invoke_agent("summarizer_batch", self.batch_summarizer_agent, content, n_emails=len(pending))
+            parsed = self._parse_batch_response(resp, list(pending))
+        except (RateLimitError, asyncio.TimeoutError):
+            raise
+        except Exception as e: # malformed structured output, fall back to single requests for the whole batch
+            logger.log("Batch summarization failed, falling back to single requests: %s", repr(e))
+            parsed = {}
+
+        missing = [i for email_id, i in pending.items() if email_id not in parsed]
+        if missing:
+            logger.log("Batch response missing %d of %d emails, falling back to single requests", len(missing), len(pending))
+
+        async def finish(email_id: str, i: int):
+            if email_id not in parsed:
+                return i, await self._invoke_with_exp_backoff_retries(lambda: self._summarize_single_email_async(emails[i]), limiter=limiter)
+            structured = await self._apply_critic_async(parsed[email_id], limiter=limiter)
+            if self.summary_cache:
+                self.summary_cache.put(email_strs[i], summary_to_dict(structured))
+            return i, structured
+
+        for i, structured in await asyncio.gather(*(finish(email_id, i) for email_id, i in pending.items())):
+            results[i] = structured
+        return results
+    
+    async def _summarize_emails_stream_async(
+        self,
+        emails: list[Email] | AsyncIterable[Email],
+        concurrency: int | None = None,
+        batch_size: int | None = None,
+        max_buffered: int = DEFAULT_MAX_BUFFERED_EMAILS,
+        on_summary: Callable[[int, EmailSummaryResponseFormat], None] | None = None,
+    ) -> AsyncGenerator[tuple[int, EmailSummaryResponseFormat], None]:
+        """
+        Yields (index of the email in emails, summary) as soon as each summary is ready, in completion order.
+        emails can also be an async stream, in which case workers start on each email as soon as it arrives.
+        With batch_size > 1 (defaults to self.batch_size), up to batch_size emails that fit in the batch token budget
+        share one summarizer request. A partial batch is sent as soon as no more streamed emails are waiting,
+        so a slow stream never holds summaries back.
+        At most max_buffered emails are taken from emails without their summary having been yielded yet,
+        which applies backpressure to the stream when the consumer is slow.
+        Concurrency adapts through self.concurrency_limiter, unless a fixed concurrency is given.
+        on_summary(index, summary) is called as soon as each summary lands, before it waits its turn to be yielded,
+        e.g. to persist it so it survives the consumer dying.
+        """
+        batch_size = batch_size or self.batch_size
+        # limits how many tasks can actively make llm calls at once
+        if concurrency:
+            limiter = AdaptiveConcurrencyLimiter(initial_limit=concurrency, min_limit=concurrency, max_limit=concurrency)
+        else:
+            limiter = self.concurrency_limiter
+        log.log("Summarizing %s emails with concurrency %d and batch size %d...", len(emails) if isinstance(emails, list) else "streamed", limiter.current_limit, batch_size)
+
+        results = asyncio.Queue() # (idx, summary), then None once every email is summarized
+        buffered = asyncio.Semaphore(max(max_buffered, 1))
+        received = []
+        llm_decided = [] # (email, summary) pairs the llm (or the summary cache) decided, timeouts excluded
+        tasks = []
+
+        def land(idx: int, summary: EmailSummaryResponseFormat) -> None:
+            if on_summary:
+                on_summary(idx, summary)
+            results.put_nowait((idx, summary))
+
+        async def worker(batch: list[tuple[int, Email]]):
+            log.debug("Entering critical section for emails %s", [idx for idx, _ in batch])
+            batch_emails = [email for _, email in batch]
+            wait_start = time.perf_counter()
+            async with limiter:
+                llm_queue_wait_seconds.observe(time.perf_counter() - wait_start)
                 try:
-                    result = await asyncio.wait_for(
-                        self._invoke_with_exp_backoff_retries(
-                            lambda: self._summarize_single_email_async(email)
-                        ),
-                        timeout=TIMEOUTS_SECONDS,
-                    )
-                    return idx, result
-                except asyncio.TimeoutError: # if it takes too long, mark as important by default and leave a note in body
-                    log.log(f"TIMEOUT summarizing email {idx}")
-                    email_copy = Email(
-                        subject=f"Timeout for email : {email.subject}",
-                        message_id=email.message_id,
-                        body=email.body
+                    # the timeout is per llm request (see _invoke_agent), waiting for the rate limiter doesn't time out
+                    batch_results = await self._invoke_with_exp_backoff_retries(
+                        lambda: self._summarize_batch_async(batch_emails, limiter=limiter),
+                        limiter=limiter,
                     )
-                    
-                    result = EmailSummaryResponseFormat(
-                        email = email_copy,
-                        is_important = True,
-                        event_time_info = _create_default_event_time_info()
-                    )
-            log.log(f"Left critical section for email {idx}, subject: {email.subject}")
-            return idx, result
-        tasks = [asyncio.create_task(worker(i, e)) for i, e in enumerate(emails)]
-
-        summaries = [None] * len(emails)
+                    llm_decided.extend(zip(batch_emails, batch_results))
+                except asyncio.TimeoutError: # if a request takes too long, mark as important by default and leave a note in body
+                    log.log("TIMEOUT summarizing emails %s", [idx for idx, _ in batch])
+                    llm_timeouts.inc(len(batch))
+                    limiter.on_overload()
+                    batch_results = []
+                    for email in batch_emails:
+                        email_copy = EmailContent(
+                            subject=f"Timeout for email : {email.subject}",
+                            message_id=email.message_id,
+                            body=email.body
+                        )
+
+                        batch_results.append(EmailSummaryResponseFormat(
+                            email = email_copy,
+                            is_important = True,
+                            event_time_info = _create_default_event_time_info(),
+                            confidence = 0.0,
+                        ))
+            log.debug("Left critical section for emails %s", [idx for idx, _ in batch])
+            for (idx, email), result in zip(batch, batch_results):
+                result.email.message_id = email.message_id  # ensure message_id is set correctly
+                land(idx, result)
+
+        # a list is queued up front, so partial batches are only sent at the end. streams are pumped in as they arrive
+        incoming = asyncio.Queue()
+        pump_task = None
+        if isinstance(emails, list):
+            for email in emails:
+                incoming.put_nowait(email)
+            incoming.put_nowait(None)
+        else:
+            incoming = asyncio.Queue(maxsize=max(max_buffered, 1))
+
+            async def pump():
+                async for email in _aiter_emails(emails):
+                    await incoming.put(email)
+                await incoming.put(None)
+            pump_task = asyncio.create_task(pump())
+
+        lookahead = collections.deque() # emails (or the final None) taken from incoming early, to classify them together
+        predictions: dict[int, Prediction] = {}
+
+        def predict_queued(idx: int, email: Email) -> None:
+            """ classifies email along with the emails already queued behind it, up to a chunk (at most max_buffered) """
+            chunk = [email] # the lookahead is empty, its emails were all predicted with the previous chunk
+            while len(chunk) < min(LOCAL_CLASSIFIER_CHUNK_SIZE, max_buffered) and (not lookahead or lookahead[-1] is not None) and not incoming.empty():
+                queued = incoming.get_nowait()
+                lookahead.append(queued)
+                if queued is not None:
+                    chunk.append(queued)
+            predictions.update(enumerate(self.local_classifier.predict(chunk), start=idx))
+
+        async def intake():
+            batch = []
+            batch_tokens = 0
+            waiting = lambda: bool(lookahead) or not incoming.empty()
+            try:
+                while True:
+                    if batch and not waiting():
+                        await asyncio.sleep(0) # let the pump catch up before deciding the stream has stalled
+                    if batch and (not waiting() or buffered.locked()):
+                        tasks.append(asyncio.create_task(worker(batch)))
+                        batch, batch_tokens = [], 0
+                    email = lookahead.popleft() if lookahead else await incoming.get()
+                    if email is None:
+                        break
+                    await buffered.acquire()
+                    idx = len(received)
+                    received.append(email)
+                    if self.local_classifier and idx not in predictions:
+                        predict_queued(idx, email)
+                    local_summary = self._decide_locally(email, predictions.pop(idx, None))
+                    if local_summary is not None:
+                        land(idx, local_summary)
+                        continue
+                    tokens = estimate_tokens(self._email_to_prompt_text(email)) + OUTPUT_TOKENS_PER_SUMMARY if batch_size > 1 else 0
+                    if batch and batch_tokens + tokens > self.batch_token_budget:
+                        tasks.append(asyncio.create_task(worker(batch)))
+                        batch, batch_tokens = [], 0
+                    batch.append((idx, email))
+                    batch_tokens += tokens
+                    if len(batch) >= batch_size:
+                        tasks.append(asyncio.create_task(worker(batch)))
+                        batch, batch_tokens = [], 0
+                if batch:
+                    tasks.append(asyncio.create_task(worker(batch)))
+                await asyncio.gather(*tasks)
+            finally:
+                results.put_nowait(None)
+
+        intake_task = asyncio.create_task(intake())
         done = 0
-        for fut in asyncio.as_completed(tasks):
-            idx, result = await fut
-
-            result.email.message_id = emails[idx].message_id  # ensure message_id is set correctly
-            summaries[idx] = result
-            done += 1
-            
-            log.log(f"Progress: {done/len(emails)*100:.2f}%, ({done}/{len(emails)}) emails summarized.")
-        log.log("Summarization complete.")
-        return summaries
+        try:
+            while (item := await results.get()) is not None:
+                buffered.release()
+                done += 1
+                log.log("Progress: %d/%d emails received so far summarized.", done, len(received))
+                yield item
+            await intake_task # re-raises worker errors
+        finally:
+            for task in [intake_task, pump_task, *tasks]:
+                if task:
+                    task.cancel()
+
+        log.log("Summarization complete. Concurrency limiter stats: %s", limiter.stats())
+        if self.rate_limiter:
+            log.log("Rate limiter stats: %s", self.rate_limiter.stats())
+        if self.summary_cache:
+            log.log("Summary cache stats: %s", self.summary_cache.stats())
+        if self.pre_classifier:
+            log.log("Pre-classifier stats: %s", self.pre_classifier.stats())
+        if self.critic_agent:
+            log.log("Critic stats: %s, batching: %s", self.critic_stats(), self.critic_batcher.stats() if self.critic_batcher else None)
+        if self.local_classifier and llm_decided:
+            self._learn_from_llm([email for email, _ in llm_decided], [summary for _, summary in llm_decided])
+
+    async def _summarize_emails_async(self, emails: list[Email] | AsyncIterable[Email], concurrency: int | None = None, batch_size: int | None = None):
+        """ summaries of all emails, in the order of emails. See _summarize_emails_stream_async. """
+        summaries = {}
+        async for idx, summary in self._summarize_emails_stream_async(emails, concurrency=concurrency, batch_size=batch_size):
+            summaries[idx] = summary
+        return [summaries[idx] for idx in range(len(summaries))]
 
     def _summarize_emails(self, emails : list[Email]) -> list[EmailSummaryResponseFormat]:
         return asyncio.run(self._summarize_emails_async(emails))
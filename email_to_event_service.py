@@ -1,80 +1,307 @@
 
 
-from db import FileDB
+from db import BloomFilteredDB, FileDB, FsyncPolicy, SQLiteDB, migrate
 from calendar_service import CalendarService, CalendarEvent, EventTimeInfo
 from email_summarizer import EmailSummarizer, Timezone, EmailSummaryResponseFormat, init_email_summarizer
 from llm_service import BaseChatModel
 from logger import Logger
 from datetime import datetime, timezone, timedelta
-from email_summarizer import EmailSummaryResponseFormatDebug
+from email_summarizer import EmailSummaryResponseFormatDebug, DEFAULT_BATCH_SIZE, summary_to_dict, summary_from_dict
+from email_state_log import EmailState, EmailStateLog
+from email_service import Email, HistoryExpiredError, KnownIdsLookup
+from rate_limiter import TokenBucketRateLimiter
+from pre_classifier import RuleBasedPreClassifier
+from local_classifier import LocalClassifier
+from pipeline import iterate_in_thread
+from metrics import metrics
+from typing import AsyncGenerator, Callable, Iterator
+import asyncio
+from collections import Counter
+import os
+import time
+
+HISTORY_ID_KEY = "gmail_history_id" # key of the last synced gmail historyId in the sync state db
+FETCH_QUEUE_SIZE = 100 # emails fetched ahead of the summarizer
+EVENT_QUEUE_SIZE = 100 # important summaries waiting for their calendar event
+CALENDAR_BATCH_SIZE = 50 # max events per calendar batch request
+PROCESSED_EMAILS_DB_PATH = "processed_emails.db"
+LEGACY_PROCESSED_EMAILS_DB_PATH = "processed_emails_db.txt" # FileDB log used before PROCESSED_EMAILS_DB_PATH
+PROCESSED_EMAIL_TTL_SECONDS = 30 * 24 * 60 * 60 # well past any lookback window, older emails are never listed again
+EMAIL_STATE_DB_PATH = "email_state.db"
+LEGACY_EMAIL_STATE_DB_PATH = "email_state_db.txt" # FileDB log used before EMAIL_STATE_DB_PATH, it kept finished emails forever
+FETCHED_LOG_BATCH_SIZE = 50 # fetched emails recorded in the state log per commit
+
+pipeline_stage_seconds = metrics.histogram("pipeline_stage_seconds", "Wall time of process_emails (stage=run) and of each of its stages", buckets=(1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600))
+pipeline_emails = metrics.counter("pipeline_emails_total", "Emails finished by process_emails, by outcome: event, unimportant or failed")
+
+async def _timed_stage(stage: str, coro):
+    with pipeline_stage_seconds.time(stage=stage):
+        return await coro
+
 def init_email_to_event_service(
     model : BaseChatModel,
     with_critic: bool = False,
     dry_run : bool = True,
-    response_format=EmailSummaryResponseFormatDebug
+    response_format=EmailSummaryResponseFormatDebug,
+    incremental_sync: bool = False,
+    use_summary_cache: bool = False,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    rate_limiter: TokenBucketRateLimiter | None = None,
+    pre_classifier: RuleBasedPreClassifier | None = None,
+    local_classifier: LocalClassifier | None = None,
+    metrics_path: str | None = None,
+    email_filter: Callable[[Email], bool] | None = None,
 ) -> "EmailToEventService":
     return EmailToEventService(
         calendar_service=CalendarService(),
-        email_summarizer=init_email_summarizer(model = model, with_critic= with_critic, response_format=response_format),
+        email_summarizer=init_email_summarizer(model = model, with_critic= with_critic, response_format=response_format, use_summary_cache=use_summary_cache, batch_size=batch_size, rate_limiter=rate_limiter, pre_classifier=pre_classifier, local_classifier=local_classifier),
         dry_run= dry_run,
+        incremental_sync= incremental_sync,
+        metrics_path= metrics_path,
+        email_filter= email_filter,
     )
 
 log = Logger(context = "EmailToEventService", debug=True)
 from logger import logged_class
 @logged_class
 class EmailToEventService:
-    def __init__(self, calendar_service: CalendarService, email_summarizer : EmailSummarizer, dry_run : bool = True):
+    def __init__(self, calendar_service: CalendarService, email_summarizer : EmailSummarizer, dry_run : bool = True, incremental_sync : bool = False, metrics_path : str | None = None, email_filter : Callable[[Email], bool] | None = None):
         self.calendar_service = calendar_service
         self.email_summarizer = email_summarizer
         self.dry_run = dry_run # if true, don't actually create events in calendar, just print them.
-        self.email_db = FileDB("processed_emails_db.txt")  # to track processed emails
+        self.incremental_sync = incremental_sync # if true, only fetch emails added since the last synced gmail historyId
+        self.metrics_path = metrics_path # if set, the metrics are written here after each run (.prom for prometheus text, else json)
+        # if set, emails are fetched metadata-first and the ones it rejects (seeing headers and labels only, no body)
+        # are recorded as unimportant without downloading their bodies
+        self.email_filter = email_filter
+        # to track processed emails. fsync every commit, _create_events group-commits a whole batch of emails at once.
+        # new mail is mostly not in it, the bloom filter answers those lookups without a query
+        self.email_db = BloomFilteredDB(SQLiteDB(PROCESSED_EMAILS_DB_PATH, default_ttl_seconds=PROCESSED_EMAIL_TTL_SECONDS, fsync_policy=FsyncPolicy.ALWAYS))
+        migrate_legacy = os.path.exists(LEGACY_PROCESSED_EMAILS_DB_PATH) and not os.path.exists(PROCESSED_EMAILS_DB_PATH)
         self.email_db.connect()
+        if migrate_legacy:
+            with FileDB(LEGACY_PROCESSED_EMAILS_DB_PATH) as legacy_db:
+                log.log("Migrated %d processed emails from %s", migrate(legacy_db, self.email_db), LEGACY_PROCESSED_EMAILS_DB_PATH)
+        self.sync_db = FileDB("sync_state_db.txt")  # to track the last synced gmail historyId
+        self.sync_db.connect()
+        # write-ahead log of each email's progress, to resume after a crash. finished emails are deleted from it, and emails
+        # stuck in it (e.g. no longer listed) expire like processed ones. no fsync per commit: sqlite's WAL still survives
+        # a process crash, and after a power loss a lost record only costs a re-summarize or a retried (409) insert
+        self.state_db = SQLiteDB(EMAIL_STATE_DB_PATH, default_ttl_seconds=PROCESSED_EMAIL_TTL_SECONDS, fsync_policy=FsyncPolicy.INTERVAL)
+        migrate_legacy_state = os.path.exists(LEGACY_EMAIL_STATE_DB_PATH) and not os.path.exists(EMAIL_STATE_DB_PATH)
+        self.state_db.connect()
+        self.state_log = EmailStateLog(self.state_db)
+        if migrate_legacy_state:
+            with FileDB(LEGACY_EMAIL_STATE_DB_PATH) as legacy_db:
+                log.log("Migrated %d email states from %s", self.state_log.import_legacy(legacy_db, self.email_db), LEGACY_EMAIL_STATE_DB_PATH)
 
     def __del__(self):
         self.email_db.disconnect()
+        self.sync_db.disconnect()
+        self.state_db.disconnect()
 
     def _email_summary_to_event(self, email: EmailSummaryResponseFormat) -> CalendarEvent | None:
         if not email.is_important:
-            log.log("Email not important, skipping event creation for email with subject: " + (email.email.subject if email.email else "No Subject"))
+            log.log("Email not important, skipping event creation for email with subject: %s", email.email.subject if email.email else "No Subject")
             return None
         # Extract event details from email (this is a placeholder; actual implementation may vary)
 
         return CalendarEvent(
             title= email.email.subject if email.email else "No Subject",
             description= email.email.body if email.email else "No Body",
-            event_time_info= email.event_time_info
+            event_time_info= email.event_time_info,
+            message_id= email.email.message_id if email.email else None,
         )
     
-    async def _summarize_recent_emails(self, lookback_hours = 24):
+    def _get_recent_emails(self, lookback_hours = 24) -> list[Email]:
+        return list(self._iter_recent_emails(lookback_hours=lookback_hours))
+
+    def _iter_recent_emails(self, lookback_hours = 24, rejected: list[str] | None = None) -> Iterator[Email]:
         """
-        Summarizes recent emails that haven't been processed yet in the last lookback_hours.
+        Iterates over emails that haven't been processed yet.
+        In incremental sync mode, fetches only the emails added since the last synced historyId,
+        falling back to a full scan of the last lookback_hours if there is none or it has expired.
+        The ids of the emails self.email_filter rejects are appended to rejected.
         """
+        email_service = self.email_summarizer.email_service
+        # filter out emails we have already made events for, or already summarized, before their bodies are fetched
+        known_ids = KnownIdsLookup(self._known_among)
+        email_filter = None
+        if self.email_filter:
+            def email_filter(email: Email) -> bool:
+                keep = self.email_filter(email)
+                if not keep and rejected is not None:
+                    rejected.append(email.message_id)
+                return keep
+        history_id = self.sync_db.get(HISTORY_ID_KEY) if self.incremental_sync else None
+        if history_id:
+            try:
+                return email_service.get_emails_since_history(history_id, known_ids=known_ids, email_filter=email_filter)
+            except HistoryExpiredError:
+                log.log("History id %s expired, falling back to a full scan of the last %s hours", history_id, lookback_hours)
+
         # get emails from last lookback_hours
         cutoff_time = datetime.now(timezone.utc) - timedelta(hours=lookback_hours)
+        return email_service.get_recent_emails(cutoff_time=cutoff_time, known_ids=known_ids, email_filter=email_filter)
 
-        recent_emails = list(self.email_summarizer.email_service.get_recent_emails(cutoff_time=cutoff_time))
-        unprocessed_emails = list(filter(lambda email: not self.email_db.get(email.message_id), recent_emails)) # filter out emails we have already made events for
+    def _known_among(self, message_ids: list[str]) -> set[str]:
+        """
+        one lookup per db for the whole page. the state log goes first: a finishing email is put in email_db before it
+        leaves the log, so it is found in one or the other even if it finishes between the two lookups
+        """
+        in_flight = self.state_log.summarized_among(message_ids)
+        return in_flight | self.email_db.contains_many(message_ids)
+
+    def _stream_recent_emails(self, lookback_hours = 24, rejected: list[str] | None = None) -> AsyncGenerator[Email, None]:
+        """ _iter_recent_emails, with the blocking gmail calls (body downloads included) in a background thread """
+        return iterate_in_thread(lambda: self._iter_recent_emails(lookback_hours=lookback_hours, rejected=rejected), maxsize=FETCH_QUEUE_SIZE)
+
+    async def _summarize_recent_emails(self, lookback_hours = 24):
+        """
+        Summarizes recent emails that haven't been processed yet in the last lookback_hours.
+        """
+        unprocessed_emails = self._get_recent_emails(lookback_hours=lookback_hours)
 
 
         return await self.email_summarizer._summarize_emails_async(unprocessed_emails)
 
+    async def _log_fetched(self, emails: AsyncGenerator[Email, None], fetched: list[Email]) -> AsyncGenerator[Email, None]:
+        """
+        Records the fetched emails in the state log, FETCHED_LOG_BATCH_SIZE at a time. Nothing resumes from the
+        fetched state, so emails can go on to the summarizer before theirs is written.
+        """
+        unlogged = []
+        try:
+            async for email in emails:
+                fetched.append(email)
+                unlogged.append(email.message_id)
+                if len(unlogged) >= FETCHED_LOG_BATCH_SIZE:
+                    self._mark_fetched(unlogged)
+                    unlogged = []
+                yield email
+        finally:
+            if unlogged:
+                self._mark_fetched(unlogged)
+
+    def _mark_fetched(self, message_ids: list[str]) -> None:
+        # some may have finished (and left the log) while waiting for this write
+        processed = self.email_db.contains_many(message_ids)
+        self.state_log.mark_fetched_many([message_id for message_id in message_ids if message_id not in processed])
+
+    def _mark_processed(self, message_id: str, event_id: str | None = None) -> None:
+        if event_id:
+            self.state_log.mark_event_created(message_id, event_id)
+        # every finished email, important or not, is recorded here, so its state log record can go
+        self.email_db.put(message_id, True)
+        self.state_log.mark_done(message_id)
+
+    async def _create_events(self, events: asyncio.Queue) -> list[str]:
+        """
+        Creates the queued events until a None arrives, with one batch request for whatever is waiting
+        (so events are never held back to fill a batch). Batches run one at a time, the google client isn't thread-safe.
+        Items are (message_id, event), event is None for unimportant emails, which only need marking processed.
+        The unimportant emails of a batch are recorded with one commit, and its events with one more after its request.
+        Events that fail are logged and their emails left unprocessed, so the next run retries them.
+        """
+        created_event_ids = []
+        finished = False
+        while not finished:
+            item = await events.get()
+            if item is None:
+                break
+            batch = [item]
+            while len(batch) < CALENDAR_BATCH_SIZE and not events.empty():
+                item = events.get_nowait()
+                if item is None:
+                    finished = True
+                    break
+                batch.append(item)
+
+            if self.dry_run:
+                for _, event in batch:
+                    if event:
+                        log.log("Created Event: %s", event)
+                continue
+            unimportant = [message_id for message_id, event in batch if event is None]
+            batch = [(message_id, event) for message_id, event in batch if event]
+            with self.state_db.batch(), self.email_db.batch():
+                for message_id in unimportant:
+                    self._mark_processed(message_id)
+            pipeline_emails.inc(len(unimportant), outcome="unimportant")
+            results = await asyncio.to_thread(self.calendar_service.create_events, [event for _, event in batch]) if batch else []
+
+            # mark the whole batch processed with one durable write per db. a crash before this is safe,
+            # the retried insert finds the event by its id
+            with self.state_db.batch(), self.email_db.batch():
+                for (message_id, event), result in zip(batch, results):
+                    if not result.ok:
+                        log.log("Failed to create event for email with subject %s: %s", event.title, repr(result.error))
+                        pipeline_emails.inc(outcome="failed")
+                        continue
+                    self._mark_processed(message_id, result.event_id)
+                    created_event_ids.append(result.event_id)
+                    pipeline_emails.inc(outcome="event")
+        return created_event_ids
+
     async def process_emails(self, lookback_hours = 24) -> list[str]:
-        # TODO: implemenet write-ahead log on db to allow for smoother recovery in case of failure mid-processing
+        """
+        Streams fetch -> summarize -> create event -> mark processed, with bounded queues between the stages,
+        so each event is created as soon as its summary lands. Already processed emails are filtered out
+        by the fetch, before their bodies are downloaded, and so are the emails self.email_filter rejects (recorded as
+        unimportant). Blocking google calls run off the event loop.
+        Each summary is recorded in self.state_log as it lands, so after a crash the next run picks up summarized emails
+        from the log instead of the llm, and never re-inserts events (their ids are deterministic).
+        """
+        run_start = time.perf_counter()
+        email_service = self.email_summarizer.email_service
+        # read the history id before listing, so mail arriving mid-run is picked up by the next sync
+        sync_history_id = await asyncio.to_thread(email_service.get_current_history_id) if self.incremental_sync else None
 
-        # leverages async event loop for llm calls for email summarization
+        events = asyncio.Queue(maxsize=EVENT_QUEUE_SIZE)
         created_event_ids = []
-        email_summaries = await self._summarize_recent_emails(lookback_hours=lookback_hours)
-        for email_summary in email_summaries:
-            event = self._email_summary_to_event(email_summary)
-            if event:
-                if self.dry_run:
-                    log.log(f"Created Event: {event}")
+        pending = self.state_log.pending()
+        if pending:
+            # counted from the records just read, stats() would scan the log again
+            log.log("Resuming %d emails from the state log: %s", len(pending), dict(Counter(record["state"] for _, record in pending)))
+
+        async def summarize():
+            for message_id, record in pending:
+                if record["state"] == EmailState.EVENT_CREATED.value:
+                    if not self.dry_run:
+                        self._mark_processed(message_id, record["event_id"])
+                        created_event_ids.append(record["event_id"])
+                        pipeline_emails.inc(outcome="event")
                     continue
-                event_id = self.calendar_service.create_event(event)
-                # mark email as processed
-                self.email_db.put(email_summary.email.message_id, True)
+                await events.put((message_id, self._email_summary_to_event(summary_from_dict(record["summary"]))))
 
-                created_event_ids.append(event_id)
+            fetched = []
+            rejected = [] # appended to by the fetch thread, complete once the summarizer has taken every email
+            emails = self._log_fetched(self._stream_recent_emails(lookback_hours=lookback_hours, rejected=rejected), fetched)
+            # each summary is recorded as soon as the summarizer has it, even if this stage dies before taking it.
+            # one commit per summary, cheap without an fsync (see state_db), so finished llm work is never redone
+            record = lambda idx, email_summary: self.state_log.mark_summarized(fetched[idx].message_id, summary_to_dict(email_summary))
+            async for idx, email_summary in self.email_summarizer._summarize_emails_stream_async(emails, on_summary=record):
+                await events.put((fetched[idx].message_id, self._email_summary_to_event(email_summary)))
+            if rejected:
+                log.log("Recording %d emails rejected by the email filter as unimportant", len(rejected))
+            for message_id in rejected:
+                await events.put((message_id, None))
+            await events.put(None)
 
+        stages = [
+            asyncio.create_task(_timed_stage("summarize", summarize())),
+            asyncio.create_task(_timed_stage("create_events", self._create_events(events))),
+        ]
+        try:
+            _, new_event_ids = await asyncio.gather(*stages)
+        finally:
+            for stage in stages: # a failing stage cancels the other
+                stage.cancel()
+            pipeline_stage_seconds.observe(time.perf_counter() - run_start, stage="run")
+            if self.metrics_path: # crashed runs too, they are the ones worth looking at
+                metrics.write(self.metrics_path)
 
-        return created_event_ids
+        if sync_history_id and not self.dry_run:
+            self.sync_db.put(HISTORY_ID_KEY, sync_history_id)
+
+        return created_event_ids + new_event_ids
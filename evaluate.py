@@ -1,19 +1,50 @@
 import asyncio
-from email_summarizer import EmailSummarizer, EmailSummaryResponseFormatDebug, init_email_summarizer
+from email_summarizer import EmailSummarizer, EmailSummaryResponseFormatDebug, init_email_summarizer, DEFAULT_CRITIC_CONFIDENCE_THRESHOLD
+from email_summarizer import EmailSummaryResponseFormat, DEFAULT_CONCURRENCY, MAX_CHARS_PER_EMAIL, TOKEN_KINDS, llm_usage
+from email_summarizer import _init_email_summarizer_agent, _init_critic_agent, _get_model_id, _get_prompt_version
 from llm_service import LocalLlamaService
 from email_service import EmailService, Email
 import json
 import random
 from test_email_summarizer import claude_sonnet, haiku, llama
 import argparse
+import time
+from pre_classifier import init_pre_classifier, Verdict
+from local_classifier import LocalClassifier, load_dataset, DEFAULT_CONFIDENCE_THRESHOLD
+from metrics import metrics, prompt_cache_hit_rate
+from rate_limiter import AdaptiveConcurrencyLimiter, TokenBucketRateLimiter, DEFAULT_REQUESTS_PER_MINUTE, DEFAULT_TOKENS_PER_MINUTE
+from summary_cache import SummaryCache
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from db import DB, FileDB
+import itertools
 EVAL_SET_SIZE = 10
 EVAL_SET_PATH = "evaluation_dataset.json"
+EVAL_CACHE_DB_PATH = "eval_cache_db.txt"
+EVAL_CACHE_TTL_SECONDS = 30 * 24 * 60 * 60 # verdicts don't go stale like the relative times in summaries do
+EVAL_CACHE_MAX_ENTRIES = 1_000_000
 
 MODELS = {
     "claude": claude_sonnet,
     "llama": llama,
     "haiku": haiku # cheap but reliable
 }
+MODEL_PROVIDERS = { # models of one provider share its rate limits
+    "claude": "anthropic",
+    "llama": "local",
+    "haiku": "anthropic",
+}
+MODEL_PRICES = { # $ per million (input, output) tokens
+    "claude": (3.00, 15.00),
+    "llama": (0.0, 0.0),
+    "haiku": (0.80, 4.00),
+}
+CACHE_READ_PRICE_FACTOR = 0.1 # of the input price, for anthropic prompt cache reads
+CACHE_WRITE_PRICE_FACTOR = 1.25
+RESPONSE_FORMATS = {
+    "default": EmailSummaryResponseFormat,
+    "debug": EmailSummaryResponseFormatDebug,
+}
 
 
 def from_json_list(json_file_path : str, n : int = 100) -> dict[str, tuple[Email, bool]]:
@@ -32,6 +63,282 @@ def from_json_list(json_file_path : str, n : int = 100) -> dict[str, tuple[Email
                                            ), email_json['is_important']
     
     return email_by_subject
+def compute_confusion(summaries, emails_by_subject, verbose: bool = True) -> tuple[int, int, int, int]:
+    """ returns (tp, fp, tn, fn) of summaries against the labels in emails_by_subject """
+    tp = 0
+    fp = 0
+    tn = 0
+    fn = 0
+
+    for summary_obj in  summaries:
+        subject = summary_obj.email.subject
+
+        eval_email, eval_is_important = emails_by_subject[subject]
+        llm_is_important = summary_obj.is_important
+
+        if eval_is_important and llm_is_important:
+            tp += 1
+        
+        if eval_is_important and not llm_is_important:
+            fn += 1
+            if verbose:
+                print("Missed Important Email:\n", str(eval_email), "\nJustification:", getattr(summary_obj, "justification", None))
+        
+        if not eval_is_important and llm_is_important:
+            fp += 1
+            if verbose:
+                print("Wrongly Labeled Email as Important:\n", str(eval_email), "\nJustification:", getattr(summary_obj, "justification", None))
+        
+        if not eval_is_important and not llm_is_important:
+            tn += 1
+
+    return tp, fp, tn, fn
+
+
+def compute_metrics(tp: int, fp: int, tn: int, fn: int) -> tuple[float, float, float]:
+    """ returns (precision, recall, f1) """
+    # precison = of all the emails labeled as important by our agent, how many were actually important
+    precision = tp / (tp + fp) if (tp + fp) > 0 else 0
+    # recall = of all the actually important emails, how many did our agent label as important
+    recall = tp / (tp + fn) if (tp + fn) > 0 else 0
+    f1 = 2 * (precision * recall) / (precision + recall) if (precision + recall) > 0 else 0
+    return precision, recall, f1
+
+
+def print_metrics(tp: int, fp: int, tn: int, fn: int):
+    print(f"TP: {tp}, FP: {fp}, TN: {tn}, FN: {fn}")
+    precision, recall, f1 = compute_metrics(tp, fp, tn, fn)
+    print(f"Precision: {precision:.2f}, Recall: {recall:.2f}, F1 Score: {f1:.2f}")
+
+
+def sweep_critic_thresholds(model, eval_emails: list[Email], emails_by_subject, thresholds: list[float], batch_size: int = 1, critic_batch_size: int = 1):
+    """
+    Runs the summarizer once per critic confidence threshold, without the summary cache so every run pays
+    for its llm calls, and prints the precision/recall vs latency/critic calls tradeoff.
+    """
+    print(f"{'threshold':>9} | {'precision':>9} | {'recall':>6} | {'f1':>4} | {'seconds':>7} | {'critic reviews':>14} | {'critic requests':>15} | {'flips':>5}")
+    for threshold in thresholds:
+        email_summarizer = init_email_summarizer(
+            model, with_critic=True, response_format=EmailSummaryResponseFormatDebug, use_summary_cache=False,
+            batch_size=batch_size, critic_confidence_threshold=threshold, critic_batch_size=critic_batch_size,
+        )
+        start = time.perf_counter()
+        summaries = asyncio.run(email_summarizer._summarize_emails_async(eval_emails))
+        elapsed = time.perf_counter() - start
+        precision, recall, f1 = compute_metrics(*compute_confusion(summaries, emails_by_subject, verbose=False))
+        stats = email_summarizer.critic_stats()
+        print(f"{threshold:>9.2f} | {precision:>9.2f} | {recall:>6.2f} | {f1:>4.2f} | {elapsed:>7.1f} | {stats['reviews']:>14} | {stats['requests']:>15} | {stats['flips']:>5}")
+
+
+def compare_pre_classifier(email_summarizer: EmailSummarizer, eval_emails: list[Email], summaries, emails_by_subject) -> dict[str, tuple[float, float, float]]:
+    """
+    End-to-end (precision, recall, f1) of summaries, a run with email_summarizer's pre-classifier, and of the same run
+    without it. Only the emails the rules decided would have gone a different way, so only those are sent to the llm again.
+    """
+    # rules are deterministic, so re-running them tells which emails they decided
+    rules = init_pre_classifier()
+    rule_decided = [email for email in eval_emails if rules.classify(email)[0] is not Verdict.ASK_LLM]
+    rule_decided_subjects = {email.subject for email in rule_decided}
+    pre_classifier, email_summarizer.pre_classifier = email_summarizer.pre_classifier, None
+    try:
+        llm_summaries = asyncio.run(email_summarizer._summarize_emails_async(rule_decided)) if rule_decided else []
+    finally:
+        email_summarizer.pre_classifier = pre_classifier
+    without_rules = [summary_obj for summary_obj in summaries if summary_obj.email.subject not in rule_decided_subjects] + llm_summaries
+    return {
+        "with pre-classifier": compute_metrics(*compute_confusion(summaries, emails_by_subject, verbose=False)),
+        "without pre-classifier": compute_metrics(*compute_confusion(without_rules, emails_by_subject, verbose=False)),
+    }
+
+
+@dataclass(frozen=True)
+class EvalConfig:
+    """ a summarizer configuration compared by compare_configs """
+    model: str
+    with_critic: bool = True
+    response_format: str = "debug"
+    max_chars_per_email: int = MAX_CHARS_PER_EMAIL
+    critic_confidence_threshold: float = DEFAULT_CRITIC_CONFIDENCE_THRESHOLD
+
+    def __str__(self) -> str:
+        return f"{self.model} critic={'on' if self.with_critic else 'off'} {self.response_format} {self.max_chars_per_email}ch"
+
+
+@dataclass
+class ConfigResult:
+    config: EvalConfig
+    tp: int = 0
+    fp: int = 0
+    tn: int = 0
+    fn: int = 0
+    latencies: list[float] = field(default_factory=list) # seconds per email, cached verdicts keep the latency they were measured with
+    tokens: dict[str, int] = field(default_factory=lambda: dict.fromkeys(TOKEN_KINDS, 0))
+    cached: int = 0
+    timeouts: int = 0 # counted as important, like the pipeline does
+    errors: int = 0 # left out of the confusion counts
+
+    def add(self, verdict: dict, is_important: bool) -> None:
+        llm_is_important = verdict["is_important"]
+        self.tp += is_important and llm_is_important
+        self.fp += not is_important and llm_is_important
+        self.tn += not is_important and not llm_is_important
+        self.fn += is_important and not llm_is_important
+        self.latencies.append(verdict["seconds"])
+        for kind, count in verdict["tokens"].items():
+            self.tokens[kind] += count
+        self.timeouts += verdict.get("timeout", False)
+
+    def cost(self) -> float:
+        """ dollars for the whole sample, priced from MODEL_PRICES """
+        input_price, output_price = MODEL_PRICES.get(self.config.model, (0.0, 0.0))
+        uncached_input = self.tokens["input"] - self.tokens["cache_read"] - self.tokens["cache_creation"]
+        input_cost = (uncached_input + CACHE_READ_PRICE_FACTOR * self.tokens["cache_read"] + CACHE_WRITE_PRICE_FACTOR * self.tokens["cache_creation"]) * input_price
+        return (input_cost + self.tokens["output"] * output_price) / 1e6
+
+
+# token usage of the email being evaluated in the current task, compare_configs runs each email in its own task
+_email_tokens: ContextVar[dict[str, int] | None] = ContextVar("email_tokens", default=None)
+
+
+class _UsageRecordingAgent:
+    """ wraps an agent, adding the token usage of each response to the email being evaluated """
+
+    def __init__(self, agent):
+        self.agent = agent
+
+    async def ainvoke(self, input: dict, config: dict | None = None) -> dict:
+        resp = await self.agent.ainvoke(input, config=config)
+        tokens = _email_tokens.get()
+        if tokens is not None:
+            for kind, count in llm_usage(resp).items():
+                tokens[kind] += count
+        return resp
+
+
+def _init_agents(config: EvalConfig, model) -> tuple:
+    """ (summarizer agent, critic agent or None) for config """
+    summarizer_agent = _init_email_summarizer_agent(model, response_format=RESPONSE_FORMATS[config.response_format])
+    return summarizer_agent, _init_critic_agent(model) if config.with_critic else None
+
+
+async def _query_verdict(summarizer: EmailSummarizer, email: Email) -> dict | None:
+    """ asks the llm (and critic) about one email, None if it failed for a reason other than a timeout """
+    tokens = dict.fromkeys(TOKEN_KINDS, 0)
+    _email_tokens.set(tokens)
+    limiter = summarizer.concurrency_limiter
+    async with limiter:
+        start = time.perf_counter()
+        try:
+            # times out per llm request, not while waiting for the provider's rate limiter
+            structured = await summarizer._invoke_with_exp_backoff_retries(lambda: summarizer._summarize_single_email_async(email), limiter=limiter)
+        except asyncio.TimeoutError:
+            limiter.on_overload()
+            return {"is_important": True, "seconds": time.perf_counter() - start, "tokens": tokens, "timeout": True}
+        except Exception as e:
+            print(f"Failed to evaluate {email.subject!r}: {e!r}")
+            return None
+    return {"is_important": bool(structured.is_important), "seconds": time.perf_counter() - start, "tokens": tokens}
+
+
+async def _evaluate_email(summarizer: EmailSummarizer, cache: SummaryCache | None, email: Email, is_important: bool, result: ConfigResult) -> None:
+    email_text = summarizer._email_to_prompt_text(email)
+    verdict = cache.get(email_text) if cache else None
+    if verdict is not None:
+        result.cached += 1
+    else:
+        verdict = await _query_verdict(summarizer, email)
+        if verdict is None:
+            result.errors += 1
+            return
+        if cache and not verdict.get("timeout"):
+            cache.put(email_text, verdict)
+    result.add(verdict, is_important)
+
+
+async def compare_configs(
+    configs: list[EvalConfig],
+    emails_by_subject: dict[str, tuple[Email, bool]],
+    models: dict = MODELS,
+    cache_db: DB | None = None,
+    concurrency: int = DEFAULT_CONCURRENCY,
+    requests_per_minute: float | None = None,
+    tokens_per_minute: float | None = None,
+    init_agents=_init_agents,
+    limiters: dict[str, AdaptiveConcurrencyLimiter] | None = None,
+) -> list[ConfigResult]:
+    """
+    Evaluates every config on the same emails at once. Configs of the same provider share one adaptive concurrency
+    limiter (and, with requests/tokens_per_minute, one rate limiter), so a 429 slows them all down together.
+    With cache_db, each config's verdicts are stored per (model, prompt version, email text), where the prompt version
+    hashes the prompts and the config's settings, so re-running an unchanged config costs no llm calls.
+    limiters maps providers to the concurrency limiters to use, the others get one starting at concurrency.
+    """
+    limiters = dict(limiters or {})
+    rate_limiters = {}
+    for provider in {MODEL_PROVIDERS.get(config.model, config.model) for config in configs}:
+        limiters.setdefault(provider, AdaptiveConcurrencyLimiter(initial_limit=concurrency, name=provider))
+        if requests_per_minute or tokens_per_minute:
+            rate_limiters[provider] = TokenBucketRateLimiter(
+                requests_per_minute=requests_per_minute or DEFAULT_REQUESTS_PER_MINUTE,
+                tokens_per_minute=tokens_per_minute or DEFAULT_TOKENS_PER_MINUTE,
+            )
+
+    results = []
+    evaluations = []
+    for config in configs:
+        provider = MODEL_PROVIDERS.get(config.model, config.model)
+        model = models[config.model]
+        response_format = RESPONSE_FORMATS[config.response_format]
+        summarizer_agent, critic_agent = init_agents(config, model)
+        summarizer = EmailSummarizer(
+            _UsageRecordingAgent(summarizer_agent),
+            email_service=None,
+            critic_agent=_UsageRecordingAgent(critic_agent) if critic_agent else None,
+            response_format=response_format,
+            concurrency_limiter=limiters[provider],
+            rate_limiter=rate_limiters.get(provider),
+            critic_confidence_threshold=config.critic_confidence_threshold,
+            max_chars_per_email=config.max_chars_per_email,
+        )
+        cache = SummaryCache(
+            cache_db,
+            model_id=_get_model_id(model),
+            prompt_version=_get_prompt_version(config.with_critic, response_format, config.critic_confidence_threshold, config.max_chars_per_email),
+            max_entries=EVAL_CACHE_MAX_ENTRIES,
+            ttl_seconds=EVAL_CACHE_TTL_SECONDS,
+        ) if cache_db else None
+        result = ConfigResult(config)
+        results.append(result)
+        evaluations += [_evaluate_email(summarizer, cache, email, is_important, result) for email, is_important in emails_by_subject.values()]
+
+    await asyncio.gather(*evaluations)
+    return results
+
+
+def _percentile(values: list[float], q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))] if ordered else 0.0
+
+
+def print_comparison(results: list[ConfigResult]) -> None:
+    """ one row per config, best f1 first """
+    print(f"{'config':<38} | {'precision':>9} | {'recall':>6} | {'f1':>4} | {'p50 s':>6} | {'p95 s':>6} | {'input tok':>9} | {'output tok':>10} | {'cost $':>7} | {'cached':>6} | {'errors':>6}")
+    for result in sorted(results, key=lambda r: compute_metrics(r.tp, r.fp, r.tn, r.fn)[2], reverse=True):
+        precision, recall, f1 = compute_metrics(result.tp, result.fp, result.tn, result.fn)
+        print(
+            f"{str(result.config):<38} | {precision:>9.2f} | {recall:>6.2f} | {f1:>4.2f} | {_percentile(result.latencies, 0.5):>6.2f} | {_percentile(result.latencies, 0.95):>6.2f} | "
+            f"{result.tokens['input']:>9} | {result.tokens['output']:>10} | {result.cost():>7.4f} | {result.cached:>6} | {result.errors + result.timeouts:>6}"
+        )
+
+
+def _parse_list(value: str) -> list[str]:
+    return [part.strip() for part in value.split(",")]
+
+
+def _parse_switches(value: str) -> list[bool]:
+    return [part == "on" for part in _parse_list(value)]
+
+
 if __name__ == "__main__":
 
     parser = argparse.ArgumentParser(description="Evaluate Email Summarizer")
@@ -49,62 +356,194 @@ if __name__ == "__main__":
         help="Number of emails to evaluate on",
     )
 
-    args = parser.parse_args()
+    parser.add_argument(
+        "--no-cache",
+        action='store_true',
+        default=False,
+        help="Disable the summary cache, so every email is sent to the LLM again",
+    )
 
-    model = MODELS[args.model]
-    print("Using model:", args.model)
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=1,
+        help="Number of emails to pack into each summarizer request (1 disables batching)",
+    )
 
+    parser.add_argument(
+        "--pre-classifier",
+        action='store_true',
+        default=False,
+        help="Decide obvious emails with cheap rules instead of the LLM, and report how much LLM traffic that saves",
+    )
 
-    emails_by_subject= from_json_list(EVAL_SET_PATH,n = args.eval_set_size)
+    parser.add_argument(
+        "--local-classifier",
+        action='store_true',
+        default=False,
+        help="Decide emails the local kNN classifier is confident about without the LLM (trained on the dataset minus the eval set)",
+    )
 
+    parser.add_argument(
+        "--local-threshold",
+        type=float,
+        default=DEFAULT_CONFIDENCE_THRESHOLD,
+        help="Confidence below which the local classifier escalates an email to the LLM",
+    )
 
-    eval_emails = [eval_email for eval_email, _ in emails_by_subject.values()]
+    parser.add_argument(
+        "--critic-threshold",
+        type=float,
+        default=DEFAULT_CRITIC_CONFIDENCE_THRESHOLD,
+        help="Summarizer confidence at or above which 'not important' verdicts skip the critic (1.0 reviews them all)",
+    )
 
-    print("Evaluating on", len(eval_emails), "emails")
+    parser.add_argument(
+        "--critic-batch-size",
+        type=int,
+        default=1,
+        help="Number of summaries to pack into each critic request (1 disables batching)",
+    )
 
-    email_summarizer = init_email_summarizer(model, with_critic=True, response_format=EmailSummaryResponseFormatDebug)
+    parser.add_argument(
+        "--critic-thresholds",
+        type=lambda value: [float(t) for t in value.split(",")],
+        default=None,
+        help="Comma separated critic thresholds to sweep, e.g. 0.5,0.7,0.9,1.0. Prints the precision/recall vs latency tradeoff instead of a single evaluation",
+    )
 
+    parser.add_argument(
+        "--compare-models",
+        type=_parse_list,
+        default=None,
+        help="Comma separated models to compare, e.g. haiku,claude. Evaluates every combination with the other --compare-* options concurrently on the same emails and prints a comparison table instead of a single evaluation",
+    )
 
-    summaries = asyncio.run(email_summarizer._summarize_emails_async(eval_emails))
-    
+    parser.add_argument(
+        "--compare-critic",
+        type=_parse_switches,
+        default=[True],
+        help="Comma separated critic settings to compare, on and/or off",
+    )
 
+    parser.add_argument(
+        "--compare-response-formats",
+        type=_parse_list,
+        default=["debug"],
+        help=f"Comma separated response formats to compare, from {', '.join(RESPONSE_FORMATS)}",
+    )
 
+    parser.add_argument(
+        "--compare-max-chars",
+        type=lambda value: [int(n) for n in _parse_list(value)],
+        default=[MAX_CHARS_PER_EMAIL],
+        help="Comma separated lengths emails are truncated to before going to the LLM",
+    )
 
-    tp = 0
-    fp = 0
-    tn = 0
-    fn = 0
+    parser.add_argument(
+        "--provider-concurrency",
+        type=int,
+        default=DEFAULT_CONCURRENCY,
+        help="Initial number of concurrent requests per provider, shared by all compared configs of that provider",
+    )
 
-    subjects_in_summary = set()
+    parser.add_argument(
+        "--requests-per-minute",
+        type=float,
+        default=None,
+        help="Requests per minute allowed per provider when comparing configs, shared by all of its configs",
+    )
 
-    for summary_obj in  summaries:
-        subject = summary_obj.email.subject
+    parser.add_argument(
+        "--tokens-per-minute",
+        type=float,
+        default=None,
+        help="Tokens per minute allowed per provider when comparing configs, shared by all of its configs",
+    )
 
-        eval_email, eval_is_important = emails_by_subject[subject]
-        llm_is_important = summary_obj.is_important
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=None,
+        help="Seed for sampling the eval set, so repeated runs use the same emails and hit the verdict cache",
+    )
 
-        if eval_is_important and llm_is_important:
-            tp += 1
-        
-        if eval_is_important and not llm_is_important:
-            fn += 1
-            print("Missed Important Email:\n", str(eval_email), "\nJustification:", summary_obj.justification)
-        
-        if not eval_is_important and llm_is_important:
-            fp += 1
-            print("Wrongly Labeled Email as Important:\n", str(eval_email), "\nJustification:", summary_obj.justification)
-        
-        if not eval_is_important and not llm_is_important:
-            tn += 1
-    
+    parser.add_argument(
+        "--metrics-path",
+        type=str,
+        default=None,
+        help="Write latency and token metrics here after the run, as Prometheus text for a .prom path or JSON otherwise",
+    )
 
+    args = parser.parse_args()
+
+    if args.seed is not None:
+        random.seed(args.seed)
+    emails_by_subject= from_json_list(EVAL_SET_PATH,n = args.eval_set_size)
+
+
+    eval_emails = [eval_email for eval_email, _ in emails_by_subject.values()]
+
+    print("Evaluating on", len(eval_emails), "emails")
+
+    if args.compare_models:
+        configs = [
+            EvalConfig(model=model_name, with_critic=with_critic, response_format=response_format, max_chars_per_email=max_chars, critic_confidence_threshold=args.critic_threshold)
+            for model_name, with_critic, response_format, max_chars in itertools.product(args.compare_models, args.compare_critic, args.compare_response_formats, args.compare_max_chars)
+        ]
+        cache_db = None
+        if not args.no_cache:
+            cache_db = FileDB(EVAL_CACHE_DB_PATH)
+            cache_db.connect()
+        start = time.perf_counter()
+        results = asyncio.run(compare_configs(
+            configs, emails_by_subject, cache_db=cache_db, concurrency=args.provider_concurrency,
+            requests_per_minute=args.requests_per_minute, tokens_per_minute=args.tokens_per_minute,
+        ))
+        print(f"Compared {len(configs)} configs in {time.perf_counter() - start:.1f}s")
+        print_comparison(results)
+        raise SystemExit(0)
+
+    model = MODELS[args.model]
+    print("Using model:", args.model)
+
+    if args.critic_thresholds:
+        sweep_critic_thresholds(model, eval_emails, emails_by_subject, args.critic_thresholds, batch_size=args.batch_size, critic_batch_size=args.critic_batch_size)
+        raise SystemExit(0)
+
+    local_classifier = None
+    if args.local_classifier:
+        # train on everything but the eval set, and don't persist, so the scores aren't inflated by memorized labels
+        train_emails, train_labels = load_dataset(EVAL_SET_PATH)
+        held_out = [(email, label) for email, label in zip(train_emails, train_labels) if email.subject not in emails_by_subject]
+        local_classifier = LocalClassifier(confidence_threshold=args.local_threshold).fit(*zip(*held_out))
+
+    email_summarizer = init_email_summarizer(model, with_critic=True, response_format=EmailSummaryResponseFormatDebug, use_summary_cache=not args.no_cache, batch_size=args.batch_size, pre_classifier=init_pre_classifier() if args.pre_classifier else None, local_classifier=local_classifier, critic_confidence_threshold=args.critic_threshold, critic_batch_size=args.critic_batch_size)
+
+
+    summaries = asyncio.run(email_summarizer._summarize_emails_async(eval_emails))
+    
 
-    print(f"TP: {tp}, FP: {fp}, TN: {tn}, FN: {fn}")
-    # precison = of all the emails labeled as important by our agent, how many were actually important
-    precision = tp / (tp + fp) if (tp + fp) > 0 else 0
-    # recall = of all the actually important emails, how many did our agent label as important
-    recall = tp / (tp + fn) if (tp + fn) > 0 else 0
-    f1 = 2 * (precision * recall) / (precision + recall) if (precision + recall) > 0 else 0
-    print(f"Precision: {precision:.2f}, Recall: {recall:.2f}, F1 Score: {f1:.2f}")
 
 
+    tp, fp, tn, fn = compute_confusion(summaries, emails_by_subject)
+    print_metrics(tp, fp, tn, fn)
+    print("Critic:", email_summarizer.critic_stats())
+    print(f"Prompt cache hit rate (cached input tokens): summarizer {prompt_cache_hit_rate('summarizer'):.1%}, critic {prompt_cache_hit_rate('critic'):.1%}")
+    if args.metrics_path:
+        metrics.write(args.metrics_path)
+    if email_summarizer.summary_cache:
+        print("Summary cache:", email_summarizer.summary_cache.stats())
+    if email_summarizer.pre_classifier:
+        stats = email_summarizer.pre_classifier.stats()
+        print(f"Pre-classifier bypassed the LLM for {stats['bypassed_llm']}/{stats['emails']} emails ({stats['bypass_rate']*100:.1f}% of LLM traffic saved)")
+        print("Pre-classifier rule hits:", stats["rule_hits"])
+        print(f"{'':<22} | {'precision':>9} | {'recall':>6} | {'f1':>4}")
+        for name, (precision, recall, f1) in compare_pre_classifier(email_summarizer, eval_emails, summaries, emails_by_subject).items():
+            print(f"{name:<22} | {precision:>9.2f} | {recall:>6.2f} | {f1:>4.2f}")
+    if email_summarizer.local_classifier:
+        stats = email_summarizer.local_classifier.stats()
+        print(f"Local classifier decided {stats['decided_locally']}/{stats['predictions']} emails the rules left to it, escalated {stats['escalated']} to the LLM")
+        locally_decided = [summary_obj for summary_obj in summaries if (getattr(summary_obj, "justification", None) or "").startswith("Decided by local classifier")]
+        local_tp, local_fp, local_tn, local_fn = compute_confusion(locally_decided, emails_by_subject, verbose=False)
+        print(f"Locally decided emails: TP: {local_tp}, FP: {local_fp}, TN: {local_tn}, FN: {local_fn}")
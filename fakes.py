@@ -0,0 +1,401 @@
+"""In-memory fakes of the Google API clients, for offline tests and benchmarks"""
+import base64
+import json
+import math
+import random
+import time
+import httplib2
+import httpx
+from googleapiclient.errors import HttpError
+
+
+def make_fake_message(
+    message_id: str,
+    subject: str,
+    body: str,
+    internal_date_ms: int = 0,
+    sender: str | None = None,
+    list_unsubscribe: str | None = None,
+    label_ids: list[str] | None = None,
+) -> dict:
+    """ builds a gmail-shaped full message resource """
+    headers = [{"name": "Subject", "value": subject}]
+    if sender:
+        headers.append({"name": "From", "value": sender})
+    if list_unsubscribe:
+        headers.append({"name": "List-Unsubscribe", "value": list_unsubscribe})
+    return {
+        "id": message_id,
+        "threadId": message_id,
+        "labelIds": list(label_ids or ["INBOX"]),
+        "internalDate": str(internal_date_ms),
+        "snippet": body[:100],
+        "payload": {
+            "headers": headers,
+            "body": {"data": base64.urlsafe_b64encode(body.encode("utf-8")).decode("ascii")},
+        },
+    }
+
+
+def to_metadata_format(message: dict, metadata_headers: list[str] | None = None) -> dict:
+    """ strips a full message resource down to what format=metadata returns """
+    headers = message["payload"]["headers"]
+    if metadata_headers:
+        wanted = {name.lower() for name in metadata_headers}
+        headers = [h for h in headers if h["name"].lower() in wanted]
+    metadata = {k: v for k, v in message.items() if k != "payload"}
+    metadata["payload"] = {"headers": headers}
+    return metadata
+
+
+def make_http_error(status: int, reason: str = "") -> HttpError:
+    content = f'{{"error": {{"code": {status}, "message": "{reason}", "errors": [{{"reason": "{reason}"}}]}}}}'
+    return HttpError(httplib2.Response({"status": status}), content.encode("utf-8"))
+
+
+class FakeRequest:
+    """ mimics googleapiclient.http.HttpRequest, runs fn on execute() """
+
+    def __init__(self, fn):
+        self.fn = fn
+
+    def execute(self):
+        return self.fn()
+
+
+class FakeBatchHttpRequest:
+    """ mimics googleapiclient.http.BatchHttpRequest """
+
+    def __init__(self, service: "FakeGmailService | FakeCalendarClient", callback=None):
+        self.service = service
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request: FakeRequest, callback=None, request_id=None):
+        if request_id is None:
+            request_id = str(len(self.requests))
+        self.requests.append((request_id, request, callback or self.callback))
+
+    def execute(self):
+        self.service.batch_calls += 1
+        for request_id, request, callback in self.requests:
+            try:
+                response, exception = request.execute(), None
+            except HttpError as e:
+                response, exception = None, e
+            if callback:
+                callback(request_id, response, exception)
+
+
+class _FakeMessagesResource:
+    def __init__(self, service: "FakeGmailService"):
+        self.service = service
+
+    def list(self, userId="me", q=None, maxResults=100, pageToken=None, **kwargs):
+        def run():
+            self.service.list_calls += 1
+            messages = self.service.messages
+            if q and q.startswith("after:"):
+                after_ms = int(q[len("after:"):]) * 1000
+                messages = [m for m in messages if int(m["internalDate"]) > after_ms]
+            offset = int(pageToken or 0)
+            page = messages[offset:offset + maxResults]
+            results = {"messages": [{"id": m["id"], "threadId": m["threadId"]} for m in page]}
+            if offset + maxResults < len(messages):
+                results["nextPageToken"] = str(offset + maxResults)
+            return results
+        return FakeRequest(run)
+
+    def get(self, userId="me", id=None, format="full", metadataHeaders=None, **kwargs):
+        def run():
+            self.service.get_calls += 1
+            self.service.fetched_at.setdefault(id, time.perf_counter())
+            self.service.format_counts[format] = self.service.format_counts.get(format, 0) + 1
+            remaining = self.service.throttle.get(id, 0)
+            if remaining:
+                self.service.throttle[id] = remaining - 1
+                raise make_http_error(429, "rateLimitExceeded")
+            if id in self.service.errors:
+                raise self.service.errors[id]
+            message = self.service.messages_by_id[id]
+            if format == "metadata":
+                return to_metadata_format(message, metadataHeaders)
+            return message
+        return FakeRequest(run)
+
+
+class _FakeHistoryResource:
+    def __init__(self, service: "FakeGmailService"):
+        self.service = service
+
+    def list(self, userId="me", startHistoryId=None, historyTypes=None, maxResults=100, pageToken=None, **kwargs):
+        def run():
+            self.service.history_calls += 1
+            start = int(startHistoryId)
+            if start < self.service.oldest_history_id:
+                raise make_http_error(404, "notFound")
+            records = [r for r in self.service.history if int(r["id"]) > start]
+            offset = int(pageToken or 0)
+            results = {"history": records[offset:offset + maxResults], "historyId": str(self.service.history_id)}
+            if offset + maxResults < len(records):
+                results["nextPageToken"] = str(offset + maxResults)
+            return results
+        return FakeRequest(run)
+
+
+class _FakeUsersResource:
+    def __init__(self, service: "FakeGmailService"):
+        self.service = service
+
+    def messages(self):
+        return _FakeMessagesResource(self.service)
+
+    def history(self):
+        return _FakeHistoryResource(self.service)
+
+    def getProfile(self, userId="me"):
+        return FakeRequest(lambda: {"emailAddress": "me@example.com", "historyId": str(self.service.history_id)})
+
+
+class FakeGmailService:
+    """
+    Mimics the subset of the gmail v1 discovery client used by EmailService.
+    messages are ordered newest first, like the real API.
+    throttle maps message id -> number of times its get should fail with a 429 before succeeding.
+    errors maps message id -> an exception to raise on every get.
+    add_message / delete_message record history so incremental sync can be exercised;
+    history ids older than oldest_history_id are treated as expired.
+    fetched_at maps message id -> time.perf_counter() of its first get, for latency benchmarks.
+    """
+
+    def __init__(self, messages: list[dict], throttle: dict[str, int] | None = None, errors: dict[str, Exception] | None = None):
+        self.messages = list(messages)
+        self.messages_by_id = {m["id"]: m for m in messages}
+        self.throttle = dict(throttle or {})
+        self.errors = dict(errors or {})
+        self.list_calls = 0
+        self.get_calls = 0
+        self.batch_calls = 0
+        self.history_calls = 0
+        self.format_counts = {} # format -> number of gets
+        self.fetched_at = {}
+        self.history_id = 1
+        self.oldest_history_id = 1
+        self.history = []
+
+    def _record_history(self, key: str, message: dict):
+        self.history_id += 1
+        self.history.append({
+            "id": str(self.history_id),
+            key: [{"message": {"id": message["id"], "threadId": message["threadId"]}}],
+        })
+
+    def add_message(self, message: dict):
+        self.messages.insert(0, message)
+        self.messages_by_id[message["id"]] = message
+        self._record_history("messagesAdded", message)
+
+    def delete_message(self, message_id: str):
+        message = self.messages_by_id.pop(message_id)
+        self.messages.remove(message)
+        self._record_history("messagesDeleted", message)
+
+    def users(self):
+        return _FakeUsersResource(self)
+
+    def new_batch_http_request(self, callback=None):
+        return FakeBatchHttpRequest(self, callback=callback)
+
+
+class _FakeEventsResource:
+    def __init__(self, client: "FakeCalendarClient"):
+        self.client = client
+
+    def insert(self, calendarId=None, body=None, **kwargs):
+        def run():
+            self.client.insert_calls += 1
+            event_id = body.get("id")
+            remaining = self.client.throttle.get(event_id, 0)
+            if remaining:
+                self.client.throttle[event_id] = remaining - 1
+                raise make_http_error(403, "rateLimitExceeded")
+            if event_id in self.client.errors:
+                raise self.client.errors[event_id]
+            events = self.client.events_by_calendar.setdefault(calendarId, {})
+            if event_id is None:
+                event_id = f"generated{self.client.insert_calls}"
+            elif event_id in events:
+                raise make_http_error(409, "duplicate")
+            events[event_id] = dict(body, id=event_id)
+            self.client.inserted_at[event_id] = time.perf_counter()
+            return events[event_id]
+        return FakeRequest(run)
+
+
+class FakeCalendarClient:
+    """
+    Mimics the subset of the calendar v3 discovery client used by CalendarService.
+    Inserting an event id that already exists fails with a 409, like the real API.
+    throttle maps event id -> number of times its insert should fail with a rate limit before succeeding.
+    errors maps event id -> an exception to raise on every insert.
+    inserted_at maps event id -> time.perf_counter() of its successful insert.
+    """
+
+    def __init__(self, throttle: dict[str, int] | None = None, errors: dict[str, Exception] | None = None):
+        self.throttle = dict(throttle or {})
+        self.errors = dict(errors or {})
+        self.events_by_calendar = {} # calendar id -> event id -> event
+        self.inserted_at = {}
+        self.insert_calls = 0
+        self.batch_calls = 0
+
+    def events(self):
+        return _FakeEventsResource(self)
+
+    def new_batch_http_request(self, callback=None):
+        return FakeBatchHttpRequest(self, callback=callback)
+
+
+def make_gmail_mock_transport(service: FakeGmailService) -> httpx.MockTransport:
+    """ serves the gmail REST endpoints used by AsyncEmailService from a FakeGmailService """
+    messages = service.users().messages()
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        path = request.url.path.rstrip("/").split("/")
+        params = request.url.params
+        try:
+            if path[-1] == "messages":
+                body = messages.list(
+                    q=params.get("q"),
+                    maxResults=int(params.get("maxResults", 100)),
+                    pageToken=params.get("pageToken"),
+                ).execute()
+            else:
+                body = messages.get(id=path[-1]).execute()
+        except HttpError as e:
+            return httpx.Response(e.status_code, content=e.content)
+        return httpx.Response(200, content=json.dumps(body).encode("utf-8"))
+
+    return httpx.MockTransport(handler)
+
+
+def make_rate_limit_error(retry_after: float | None = None):
+    """ an anthropic RateLimitError, optionally carrying a retry-after header """
+    from anthropic import RateLimitError
+
+    headers = {"retry-after": str(retry_after)} if retry_after is not None else {}
+    response = httpx.Response(429, headers=headers, request=httpx.Request("POST", "https://api.anthropic.com/v1/messages"))
+    return RateLimitError("rate limited", response=response, body=None)
+
+
+LATENCY_DISTRIBUTIONS = ("constant", "uniform", "exponential", "lognormal")
+
+
+def make_latency_sampler(distribution: str, median_seconds: float, sigma: float = 0.5, seed: int = 0):
+    """
+    seconds per llm call, drawn from a seeded distribution with the given median:
+    constant, uniform over [0, 2 * median], exponential, or lognormal with shape sigma (heavier tail as it grows)
+    """
+    rng = random.Random(seed)
+    if distribution == "constant":
+        return lambda: median_seconds
+    if distribution == "uniform":
+        return lambda: rng.uniform(0, 2 * median_seconds)
+    if distribution == "exponential":
+        return lambda: rng.expovariate(math.log(2) / median_seconds) if median_seconds else 0.0
+    if distribution == "lognormal":
+        return lambda: rng.lognormvariate(math.log(median_seconds), sigma) if median_seconds else 0.0
+    raise ValueError(f"Unknown latency distribution {distribution}, expected one of {LATENCY_DISTRIBUTIONS}")
+
+
+class FakeSummarizerAgent:
+    """
+    Stands in for the compiled summarizer/critic agent graphs.
+    is_important decides the verdict from the email text the agent receives.
+    latency_seconds is a number, or a function returning the latency of each call (see make_latency_sampler).
+    If batch_response_format (see make_batch_response_format) is given, the agent answers batched requests,
+    leaving out the emails whose id is in drop_ids.
+    The first rate_limited_calls calls raise a RateLimitError with the given retry_after, and after those each call
+    does with probability rate_limit_probability (drawn from a random.Random(seed), so runs are repeatable).
+    confidence is a number, or a function of the email text like is_important.
+    usage_metadata, if given, is reported on a model message in each response, like langchain does.
+    """
+
+    def __init__(
+        self,
+        is_important=lambda text: True,
+        latency_seconds: float = 0.0,
+        batch_response_format: type | None = None,
+        drop_ids=(),
+        rate_limited_calls: int = 0,
+        retry_after: float | None = None,
+        confidence=1.0,
+        usage_metadata: dict | None = None,
+        rate_limit_probability: float = 0.0,
+        seed: int = 0,
+    ):
+        self.is_important = is_important
+        self.latency_seconds = latency_seconds if callable(latency_seconds) else (lambda: latency_seconds)
+        self.batch_response_format = batch_response_format
+        self.drop_ids = set(drop_ids)
+        self.rate_limited_calls = rate_limited_calls
+        self.retry_after = retry_after
+        self.rate_limit_probability = rate_limit_probability
+        self.rng = random.Random(seed)
+        self.rate_limited = 0 # calls that raised a RateLimitError
+        self.confidence = confidence if callable(confidence) else (lambda text: confidence)
+        self.usage_metadata = usage_metadata
+        self.calls = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def _summarize(self, text: str, summary_format: type, **extra):
+        from email_service import EmailContent
+
+        return summary_format(
+            email=EmailContent(subject=text, body=text),
+            is_important=self.is_important(text),
+            event_time_info=None,
+            confidence=self.confidence(text),
+            **extra,
+        )
+
+    async def ainvoke(self, input: dict, config: dict | None = None) -> dict:
+        # imported here so the google fakes stay usable without the langchain stack
+        import asyncio
+        import dataclasses
+        import re
+        import typing
+        from email_summarizer import EmailSummaryResponseFormat
+
+        text = input["messages"][-1]["content"]
+        if self.rate_limited_calls > 0 or (self.rate_limit_probability and self.rng.random() < self.rate_limit_probability):
+            self.rate_limited_calls = max(self.rate_limited_calls - 1, 0)
+            self.rate_limited += 1
+            raise make_rate_limit_error(self.retry_after)
+
+        self.calls.append(text)
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            latency_seconds = self.latency_seconds()
+            if latency_seconds:
+                await asyncio.sleep(latency_seconds)
+        finally:
+            self.in_flight -= 1
+
+        messages = []
+        if self.usage_metadata:
+            from langchain_core.messages import AIMessage
+            messages.append(AIMessage(content="", usage_metadata=self.usage_metadata))
+
+        if self.batch_response_format is None:
+            return {"messages": messages, "structured_response": self._summarize(text, EmailSummaryResponseFormat)}
+
+        item_format = typing.get_args(dataclasses.fields(self.batch_response_format)[0].type)[0]
+        summaries = [
+            self._summarize(email_text, item_format, email_id=email_id)
+            for email_id, email_text in re.findall(r'<email id="([^"]*)">\n(.*?)\n</email>', text, flags=re.DOTALL)
+            if email_id not in self.drop_ids
+        ]
+        return {"messages": messages, "structured_response": self.batch_response_format(summaries=summaries)}
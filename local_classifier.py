@@ -0,0 +1,222 @@
+"""Local CPU-only email classifier (hashed TF-IDF embeddings + kNN), answers with a confidence so only unsure emails reach the LLM"""
+from dataclasses import dataclass
+from typing import Iterable
+import json
+import os
+import re
+import zlib
+import numpy as np
+from email_service import Email
+
+LOCAL_CLASSIFIER_MODEL_PATH = "local_classifier_model.npz"
+EVAL_SET_PATH = "evaluation_dataset.json"
+DEFAULT_DIM = 1024 # embedding size, 4KB per stored example
+IDF_BUCKETS = 2**18 # document frequencies are counted per hash bucket, much finer than the embedding
+DEFAULT_K = 5
+DEFAULT_CONFIDENCE_THRESHOLD = 0.9 # below this the email escalates to the llm
+DEFAULT_MIN_SIMILARITY = 0.3 # with no neighbour at least this close, the classifier knows nothing about the email
+DEFAULT_MAX_EXAMPLES = 5000 # oldest learned examples are dropped past this
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+
+
+def email_to_text(email: Email) -> str:
+    return f"{email.subject}\n{email.body}"
+
+
+def _tokens(email: Email) -> list[str]:
+    """ unigrams and bigrams of the whole text, plus subject words and the sender domain as their own features """
+    words = TOKEN_PATTERN.findall(email_to_text(email).lower())
+    tokens = words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+    tokens += ["subject:" + word for word in TOKEN_PATTERN.findall(email.subject.lower())]
+    if email.sender:
+        tokens.append("domain:" + email.sender.lower().rstrip(">").split("@")[-1])
+    return tokens
+
+
+def _hash(token: str) -> int:
+    # crc32 is stable across processes (unlike hash()), which matters since the model is persisted
+    return zlib.crc32(token.encode("utf-8"))
+
+
+class HashingVectorizer:
+    """
+    Signed feature hashing of TF-IDF weighted tokens into a small dense embedding, L2-normalized so dot products
+    are cosine similarities. transform vectorizes a whole batch of emails with a handful of NumPy calls.
+    """
+
+    def __init__(self, dim: int = DEFAULT_DIM, doc_freqs: np.ndarray | None = None, n_docs: int = 0):
+        self.dim = dim
+        self.doc_freqs = doc_freqs if doc_freqs is not None else np.zeros(IDF_BUCKETS, dtype=np.float32)
+        self.n_docs = n_docs
+
+    def _hashed_counts(self, emails: list[Email]) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """ (row, token hash, count) for every distinct token of every email """
+        hashes = [np.fromiter((_hash(t) for t in _tokens(email)), dtype=np.uint64) for email in emails]
+        rows = np.repeat(np.arange(len(emails), dtype=np.uint64), [len(h) for h in hashes])
+        keys, counts = np.unique((rows << np.uint64(32)) | np.concatenate(hashes or [np.empty(0, np.uint64)]), return_counts=True)
+        return (keys >> np.uint64(32)).astype(np.int64), keys & np.uint64(0xFFFFFFFF), counts
+
+    def fit(self, emails: list[Email]) -> "HashingVectorizer":
+        rows, hashes, _ = self._hashed_counts(emails)
+        buckets = (hashes % IDF_BUCKETS).astype(np.int64)
+        # count each bucket once per document, even if several of its tokens collide there
+        doc_buckets = np.unique(rows * IDF_BUCKETS + buckets) % IDF_BUCKETS
+        self.doc_freqs = np.bincount(doc_buckets, minlength=IDF_BUCKETS).astype(np.float32)
+        self.n_docs = len(emails)
+        return self
+
+    def transform(self, emails: list[Email]) -> np.ndarray:
+        matrix = np.zeros((len(emails), self.dim), dtype=np.float32)
+        if not emails:
+            return matrix
+        rows, hashes, counts = self._hashed_counts(emails)
+        idf = np.log((1 + self.n_docs) / (1 + self.doc_freqs[(hashes % IDF_BUCKETS).astype(np.int64)])) + 1
+        weights = (1 + np.log(counts)) * idf # sublinear tf
+        signs = np.where((hashes >> np.uint64(31)) & np.uint64(1), -1.0, 1.0) # so collisions cancel out on average
+        np.add.at(matrix, (rows, (hashes % self.dim).astype(np.int64)), signs * weights)
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        return matrix / np.maximum(norms, 1e-12)
+
+
+@dataclass
+class Prediction:
+    is_important: bool
+    confidence: float # between 0.5 (no idea) and 1 (all close neighbours agree)
+
+
+from logger import logged_class
+@logged_class
+class LocalClassifier:
+    """
+    k-nearest-neighbour classifier over HashingVectorizer embeddings of labelled emails.
+    Learns from labelled datasets and from the llm's past decisions, and persists to an .npz file so
+    startup only has to load arrays instead of re-vectorizing every example.
+    """
+
+    def __init__(
+        self,
+        k: int = DEFAULT_K,
+        confidence_threshold: float = DEFAULT_CONFIDENCE_THRESHOLD,
+        min_similarity: float = DEFAULT_MIN_SIMILARITY,
+        max_examples: int = DEFAULT_MAX_EXAMPLES,
+        dim: int = DEFAULT_DIM,
+        path: str | None = None,
+    ):
+        self.k = k
+        self.confidence_threshold = confidence_threshold
+        self.min_similarity = min_similarity
+        self.max_examples = max_examples
+        self.path = path # where save() writes to, if set
+        self.vectorizer = HashingVectorizer(dim=dim)
+        self.emails: list[Email] = [] # kept so the embeddings can be recomputed when the idf changes
+        self.labels = np.zeros(0, dtype=bool)
+        self.embeddings = np.zeros((0, dim), dtype=np.float32)
+        self._known_texts: set[str] = set()
+        self.predictions = 0
+        self.confident_predictions = 0
+
+    def fit(self, emails: list[Email], labels: Iterable[bool]) -> "LocalClassifier":
+        self.emails = list(emails)[-self.max_examples:]
+        self.labels = np.array(list(labels), dtype=bool)[-self.max_examples:]
+        self._known_texts = {email_to_text(email) for email in self.emails}
+        self.vectorizer.fit(self.emails)
+        self.embeddings = self.vectorizer.transform(self.emails)
+        return self
+
+    def learn(self, emails: list[Email], labels: Iterable[bool]) -> int:
+        """ adds new labelled examples (e.g. llm decisions) and refits, returns how many were new """
+        new = {}
+        for email, label in zip(emails, labels):
+            if email_to_text(email) not in self._known_texts:
+                new.setdefault(email_to_text(email), (email, label))
+        new = list(new.values())
+        if new:
+            self.fit(self.emails + [email for email, _ in new], list(self.labels) + [label for _, label in new])
+        return len(new)
+
+    def predict(self, emails: list[Email]) -> list[Prediction]:
+        """ classifies a batch of emails with one vectorization and one similarity matrix product """
+        if not emails:
+            return []
+        if not self.emails:
+            return [Prediction(is_important=True, confidence=0.5) for _ in emails]
+
+        similarities = np.clip(self.vectorizer.transform(emails) @ self.embeddings.T, 0, None)
+        k = min(self.k, len(self.emails))
+        neighbours = np.argpartition(-similarities, k - 1, axis=1)[:, :k]
+        weights = np.take_along_axis(similarities, neighbours, axis=1)
+        votes = (weights * self.labels[neighbours]).sum(axis=1)
+        totals = weights.sum(axis=1)
+        p_important = np.divide(votes, totals, out=np.full(len(emails), 0.5), where=totals > 0)
+        confidence = np.where(weights.max(axis=1) >= self.min_similarity, np.maximum(p_important, 1 - p_important), 0.5)
+
+        return [Prediction(is_important=bool(p >= 0.5), confidence=float(c)) for p, c in zip(p_important, confidence)]
+
+    def is_confident(self, prediction: Prediction) -> bool:
+        return prediction.confidence >= self.confidence_threshold
+
+    def decide(self, prediction: Prediction) -> bool:
+        """ whether to act on prediction instead of escalating, counted in stats """
+        self.predictions += 1
+        self.confident_predictions += self.is_confident(prediction)
+        return self.is_confident(prediction)
+
+    def stats(self) -> dict:
+        return {
+            "examples": len(self.emails),
+            "predictions": self.predictions,
+            "decided_locally": self.confident_predictions,
+            "escalated": self.predictions - self.confident_predictions,
+            "local_rate": self.confident_predictions / self.predictions if self.predictions else 0.0,
+        }
+
+    def save(self, path: str | None = None) -> None:
+        path = path or self.path
+        tmp_path = path + ".tmp.npz"
+        np.savez_compressed(
+            tmp_path,
+            embeddings=self.embeddings,
+            labels=self.labels,
+            doc_freqs=self.vectorizer.doc_freqs,
+            n_docs=self.vectorizer.n_docs,
+            emails=np.array([json.dumps([e.subject, e.body, e.sender]) for e in self.emails], dtype=str),
+        )
+        os.replace(tmp_path, path) # a crash mid-save leaves the previous model intact
+
+    @classmethod
+    def load(cls, path: str, **kwargs) -> "LocalClassifier":
+        """ kwargs are LocalClassifier settings, dim comes from the saved embeddings and save() writes back to path """
+        with np.load(path) as data:
+            dim = data["embeddings"].shape[1]
+            if kwargs.setdefault("dim", dim) != dim:
+                raise ValueError(f"{path} holds {dim}-dim embeddings, not {kwargs['dim']}")
+            kwargs["path"] = path
+            classifier = cls(**kwargs)
+            classifier.embeddings = data["embeddings"]
+            classifier.labels = data["labels"]
+            classifier.vectorizer.doc_freqs = data["doc_freqs"]
+            classifier.vectorizer.n_docs = int(data["n_docs"])
+            classifier.emails = [Email(subject=s, body=b, sender=sender) for s, b, sender in map(json.loads, data["emails"])]
+        classifier._known_texts = {email_to_text(email) for email in classifier.emails}
+        return classifier
+
+
+def load_dataset(path: str = EVAL_SET_PATH) -> tuple[list[Email], list[bool]]:
+    """ labelled emails from a json list of {subject, body, is_important} """
+    with open(path) as f:
+        records = json.load(f)
+    return [Email(subject=r["subject"], body=r["body"]) for r in records], [r["is_important"] for r in records]
+
+
+def init_local_classifier(
+    path: str = LOCAL_CLASSIFIER_MODEL_PATH,
+    dataset_path: str = EVAL_SET_PATH,
+    confidence_threshold: float = DEFAULT_CONFIDENCE_THRESHOLD,
+) -> LocalClassifier:
+    """ loads the persisted model, or trains one from the labelled dataset on first use """
+    if os.path.exists(path):
+        return LocalClassifier.load(path, confidence_threshold=confidence_threshold)
+    classifier = LocalClassifier(confidence_threshold=confidence_threshold, path=path).fit(*load_dataset(dataset_path))
+    classifier.save()
+    return classifier
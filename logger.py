@@ -1,55 +1,383 @@
 DEFAULT_LOG_FILE = "logs/debug.log"
-import functools, inspect, logging, time
-from constants import DEBUG
+DEFAULT_QUEUE_SIZE = 10_000 # records waiting for the writer thread, past this new ones are dropped
+DEFAULT_WRITE_BATCH_SIZE = 1000 # records per write
+DEFAULT_MAX_BYTES = 10 * 1024 * 1024 # log file size that triggers a rotation
+DEFAULT_BACKUP_COUNT = 3 # rotated files kept, as debug.log.1 (newest) .. debug.log.3
+DEFAULT_SPAN_BUFFER_SIZE = 10_000 # most recent spans kept in memory
+import atexit, contextvars, fnmatch, functools, inspect, itertools, logging, os, queue, random, reprlib, threading, time
+from collections import deque
+from dataclasses import dataclass
+from enum import Enum
+from constants import DEBUG, LOGGED_CLASS_MODE, TRACE_EXCLUDE, TRACE_INCLUDE, TRACE_SAMPLE_RATE
+
+DEFAULT_LEVEL = logging.DEBUG if DEBUG else logging.INFO
+_IMMUTABLE_TYPES = (str, bytes, int, float, bool, type(None), Enum) # args of these types can be formatted later, on the writer thread
+
+
+def _is_immutable(value) -> bool:
+    if isinstance(value, tuple):
+        return all(_is_immutable(item) for item in value)
+    return isinstance(value, _IMMUTABLE_TYPES)
+
+
+def _format(context: str | None, fmt: str, args: tuple) -> str:
+    try:
+        # if no args, log fmt directly
+        message = fmt % args if args else fmt
+    except Exception as e: # a bad format string or a broken __repr__, don't lose the record
+        message = f"{fmt} <unformattable args: {e!r}>"
+    return f"[{context}] {message}" if context else message
+
+
+class LogWriter:
+    """
+    Appends log records to a file from a background thread, so callers (e.g. asyncio workers) only pay for a queue put.
+    The thread formats records there, writes whatever is queued in one batch and rotates the file by size.
+    The queue is bounded: when the writer falls behind, new records are dropped and counted rather than blocking.
+    """
+
+    def __init__(
+        self,
+        log_file: str,
+        max_queue_size: int = DEFAULT_QUEUE_SIZE,
+        batch_size: int = DEFAULT_WRITE_BATCH_SIZE,
+        max_bytes: int | None = DEFAULT_MAX_BYTES,
+        backup_count: int = DEFAULT_BACKUP_COUNT,
+    ):
+        self.log_file = log_file
+        self.batch_size = batch_size
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.queue = queue.Queue(maxsize=max_queue_size)
+        self.dropped = 0
+        self.written = 0
+        self.rotations = 0
+        self._reported_dropped = 0
+        self._file = None
+        threading.Thread(target=self._run, daemon=True, name=f"LogWriter({log_file})").start()
+
+    def submit(self, context: str | None, fmt: str, args: tuple) -> None:
+        try:
+            self.queue.put_nowait((context, fmt, args))
+        except queue.Full:
+            self.dropped += 1
+
+    def flush(self) -> None:
+        """ blocks until every record submitted so far is written """
+        self.queue.join()
+
+    def _run(self) -> None:
+        while True:
+            records = [self.queue.get()]
+            while len(records) < self.batch_size:
+                try:
+                    records.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._write([_format(*record) for record in records])
+            except Exception:
+                pass # logging must never take the process down, e.g. the log directory was removed
+            finally:
+                for _ in records:
+                    self.queue.task_done()
+
+    def _write(self, lines: list[str]) -> None:
+        if self.dropped > self._reported_dropped:
+            lines.append(f"[LogWriter] dropped {self.dropped - self._reported_dropped} records, the queue was full")
+            self._reported_dropped = self.dropped
+        if self._file is None:
+            os.makedirs(os.path.dirname(self.log_file) or ".", exist_ok=True)
+            self._file = open(self.log_file, 'a')
+        self._file.write("\n".join(lines) + "\n")
+        self._file.flush()
+        self.written += len(lines)
+        if self.max_bytes and self._file.tell() >= self.max_bytes:
+            self._rotate()
+
+    def _rotate(self) -> None:
+        self._file.close()
+        self._file = None
+        for i in range(self.backup_count - 1, 0, -1):
+            if os.path.exists(f"{self.log_file}.{i}"):
+                os.replace(f"{self.log_file}.{i}", f"{self.log_file}.{i + 1}")
+        if self.backup_count:
+            os.replace(self.log_file, f"{self.log_file}.1")
+        else:
+            os.remove(self.log_file)
+        self.rotations += 1
+
+
+_writers: dict[str, LogWriter] = {}
+_writers_lock = threading.Lock()
+_log_directory = None # if set, relative log files resolve against it instead of the working directory
+
+
+def set_log_directory(log_directory: str | None) -> None:
+    """ sends logs with relative paths to log_directory from now on, e.g. a temp dir for benchmarks """
+    global _log_directory
+    _log_directory = log_directory
+
+
+def get_log_writer(log_file: str) -> LogWriter:
+    """ one writer (and thread) per log file, shared by every Logger writing to it """
+    # relative paths follow the working directory, like opening per call did
+    log_file = os.path.abspath(os.path.join(_log_directory, log_file) if _log_directory else log_file)
+    with _writers_lock:
+        if log_file not in _writers:
+            _writers[log_file] = LogWriter(log_file)
+        return _writers[log_file]
+
+
+@atexit.register
+def flush_logs() -> None:
+    for writer in list(_writers.values()):
+        writer.flush()
+
+
 class Logger:
 
-    def __init__(self, log_file: str | None = DEFAULT_LOG_FILE, debug = False, context = None):
+    def __init__(self, log_file: str | None = DEFAULT_LOG_FILE, debug = False, context = None, level: int = DEFAULT_LEVEL):
         self.log_file = log_file
-        self.debug = debug
+        self.debug_enabled = debug
         self.context = context
+        self.level = level
 
-    def _log(self, message: str):
-        if self.context:
-            message = f"[{self.context}] {message}"
-        # if self.debug:
-        #     print(message)
-
-        if self.log_file:
-            with open(self.log_file, 'a') as f:
-                f.write(message + '\n')
+    def is_enabled_for(self, level: int) -> bool:
+        return self.log_file is not None and level >= self.level
 
-    def log(self, fmt: str, *args):
+    def log(self, fmt: str, *args, level: int = logging.INFO):
         """
         Formatted log: log("CALL %s.%s args=%r", cls, name, args)
+        Nothing is formatted if level is disabled, so pass values as args rather than pre-formatting them.
+        Records whose args are all immutable (strings, numbers, enums, tuples of those) are formatted on the writer
+        thread. Any other arg, e.g. a message history or a dict, could be mutated by the caller before the writer gets
+        to it, so those records are formatted right away.
         """
+        if self.is_enabled_for(level):
+            if not _is_immutable(args):
+                fmt, args = _format(None, fmt, args), ()
+            get_log_writer(self.log_file).submit(self.context, fmt, args)
 
-        # if no args, log fmt directly
-        if not args:
-            return self._log(fmt)
+    def debug(self, fmt: str, *args):
+        self.log(fmt, *args, level=logging.DEBUG)
+
+
+@dataclass(slots=True)
+class Span:
+    name: str # "Class.method"
+    span_id: int
+    parent_id: int | None # the span of the traced call this one ran inside, if any
+    start: float # time.perf_counter()
+    duration: float # seconds
+    error: str | None = None # the call's args and exception, repr'd, only when it raised
+
+
+# repr limits for error payloads, so a failing call on a huge email body doesn't produce a huge log line
+_payload_repr = reprlib.Repr()
+_payload_repr.maxstring = _payload_repr.maxother = 500
+_payload_repr.maxlist = _payload_repr.maxdict = _payload_repr.maxtuple = 20
+
+# (span_id, sampled) of the traced call currently running, per thread and per asyncio task
+_current_span: contextvars.ContextVar[tuple[int, bool] | None] = contextvars.ContextVar("current_span", default=None)
+
+
+class Tracer:
+    """
+    Records the timing of method calls as spans (name, duration, parent) in a ring buffer. Nothing is serialized
+    unless a call raises: then its args and exception are repr'd (size-limited) into the span and the log.
+    sample_rate applies to top-level calls, nested calls follow their parent so sampled traces are complete.
+    Calls that raise are always recorded. include/exclude take "Class" or "Class.method" fnmatch patterns.
+    """
+
+    def __init__(
+        self,
+        sample_rate: float = 1.0,
+        include: list[str] | None = None,
+        exclude: list[str] | None = None,
+        capacity: int = DEFAULT_SPAN_BUFFER_SIZE,
+    ):
+        self.spans: deque[Span] = deque(maxlen=capacity)
+        self._ids = itertools.count(1)
+        self.log = Logger(context="Tracer")
+        self.configure(sample_rate, include, exclude)
+
+    def configure(self, sample_rate: float = 1.0, include: list[str] | None = None, exclude: list[str] | None = None) -> None:
+        self.sample_rate = sample_rate
+        self.include = list(include or [])
+        self.exclude = list(exclude or [])
+        self._enabled: dict[str, bool] = {}
+
+    def is_enabled(self, name: str) -> bool:
+        enabled = self._enabled.get(name)
+        if enabled is None: # matched once per method, then cached
+            names = (name, name.split(".")[0])
+            matches = lambda patterns: any(fnmatch.fnmatchcase(n, p) for n in names for p in patterns)
+            enabled = self._enabled[name] = (not self.include or matches(self.include)) and not matches(self.exclude)
+        return enabled
 
+    def open(self, name: str) -> tuple | None:
+        """ a span for a call to name, child of the current one, without making it current (see start) """
+        if not self.is_enabled(name):
+            return None
+        parent = _current_span.get()
+        sampled = parent[1] if parent else random.random() < self.sample_rate
+        return name, next(self._ids), parent[0] if parent else None, sampled, time.perf_counter()
 
-        self.log(fmt % args)
+    def start(self, name: str) -> tuple | None:
+        """ opens a span and makes it current until finish """
+        opened = self.open(name)
+        if opened is None:
+            return None
+        _, span_id, _, sampled, _ = opened
+        return _current_span.set((span_id, sampled)), *opened
 
+    def finish(self, started: tuple | None, error: tuple | None = None) -> None:
+        """ error is (args, kwargs, exception) for a call that raised """
+        if started is None:
+            return
+        _current_span.reset(started[0])
+        self.close(started[1:], error)
 
-import functools
-import inspect
-import time
+    def close(self, opened: tuple | None, error: tuple | None = None) -> None:
+        """ records a span from open, once its call is over """
+        if opened is None:
+            return
+        name, span_id, parent_id, sampled, start = opened
+        duration = time.perf_counter() - start
+        if not sampled and error is None:
+            return
+        span = Span(name, span_id, parent_id, start, duration)
+        if error is not None:
+            args, kwargs, exception = error
+            span.error = f"args={_payload_repr.repr(args)} kwargs={_payload_repr.repr(kwargs)} raised {exception!r}"
+            self.log.log("ERR  %s (%.3fs) %s", name, duration, span.error)
+        self.spans.append(span)
 
-def logged_class(cls):
-    """ class decorator that logs all method calls and their arguments/results/exceptions """
-    if not DEBUG:
+    def summary(self) -> dict[str, dict[str, float]]:
+        """ per method: calls, errors, total and max seconds over the spans in the buffer """
+        summary = {}
+        for span in list(self.spans):
+            stats = summary.setdefault(span.name, {"calls": 0, "errors": 0, "total_seconds": 0.0, "max_seconds": 0.0})
+            stats["calls"] += 1
+            stats["errors"] += span.error is not None
+            stats["total_seconds"] += span.duration
+            stats["max_seconds"] = max(stats["max_seconds"], span.duration)
+        return summary
+
+    def clear(self) -> None:
+        self.spans.clear()
+
+
+tracer = Tracer(sample_rate=TRACE_SAMPLE_RATE, include=TRACE_INCLUDE, exclude=TRACE_EXCLUDE)
+
+
+def _traced_generator(opened: tuple, gen, args: tuple, kwargs: dict):
+    """
+    iterates gen with its span open until it is exhausted or closed. the span is only current while gen's body runs,
+    between items the consumer's code runs in its own context
+    """
+    _, span_id, _, sampled, _ = opened
+    error = None
+    try:
+        while True:
+            token = _current_span.set((span_id, sampled))
+            try:
+                item = next(gen)
+            except StopIteration:
+                return
+            finally:
+                _current_span.reset(token)
+            yield item
+    except Exception as e:
+        error = (args, kwargs, e)
+        raise
+    finally:
+        gen.close()
+        tracer.close(opened, error)
+
+
+async def _traced_async_generator(opened: tuple, gen, args: tuple, kwargs: dict):
+    """ _traced_generator for async generators """
+    _, span_id, _, sampled, _ = opened
+    error = None
+    try:
+        while True:
+            token = _current_span.set((span_id, sampled))
+            try:
+                item = await gen.__anext__()
+            except StopAsyncIteration:
+                return
+            finally:
+                _current_span.reset(token)
+            yield item
+    except Exception as e:
+        error = (args, kwargs, e)
+        raise
+    finally:
+        await gen.aclose()
+        tracer.close(opened, error)
+
+
+def _traced(name: str, f):
+    """ wraps f to record a span on tracer for each call, generators' spans last until they are exhausted or closed """
+    if inspect.isgeneratorfunction(f) or inspect.isasyncgenfunction(f):
+        trace_iteration = _traced_generator if inspect.isgeneratorfunction(f) else _traced_async_generator
+
+        @functools.wraps(f)
+        def wrapped(self, *args, **kwargs):
+            opened = tracer.open(name)
+            gen = f(self, *args, **kwargs)
+            return gen if opened is None else trace_iteration(opened, gen, args, kwargs)
+    elif inspect.iscoroutinefunction(f):
+        @functools.wraps(f)
+        async def wrapped(self, *args, **kwargs):
+            started = tracer.start(name)
+            try:
+                res = await f(self, *args, **kwargs)
+            except Exception as e:
+                tracer.finish(started, (args, kwargs, e))
+                raise
+            tracer.finish(started)
+            return res
+    else:
+        @functools.wraps(f)
+        def wrapped(self, *args, **kwargs):
+            started = tracer.start(name)
+            try:
+                res = f(self, *args, **kwargs)
+            except Exception as e:
+                tracer.finish(started, (args, kwargs, e))
+                raise
+            tracer.finish(started)
+            return res
+    return wrapped
+
+
+def logged_class(cls, mode: str | None = None):
+    """
+    class decorator that traces method calls (mode "trace", see Tracer) or logs all of them with their
+    arguments/results/exceptions (mode "verbose"). mode defaults to constants.LOGGED_CLASS_MODE.
+    """
+    mode = mode or LOGGED_CLASS_MODE
+    if mode == "off":
+        return cls
+    if mode == "trace":
+        for name, attr in list(cls.__dict__.items()):
+            if inspect.isfunction(attr):
+                setattr(cls, name, _traced(f"{cls.__name__}.{name}", attr))
         return cls
 
     log = Logger(context="Logging Middleware for " + cls.__name__, debug=True)
 
     def _log_call(name, args, kwargs):
-        log.log("CALL %s.%s args=%r kwargs=%r", cls.__name__, name, args, kwargs)
+        log.debug("CALL %s.%s args=%r kwargs=%r", cls.__name__, name, args, kwargs)
 
     def _log_ret(name, res, dt):
-        log.log("RET  %s.%s -> %r (%.3fs)", cls.__name__, name, res, dt)
+        log.debug("RET  %s.%s -> %r (%.3fs)", cls.__name__, name, res, dt)
 
     def _log_err(name):
-        log.log("ERR  %s.%s", cls.__name__, name)
+        log.debug("ERR  %s.%s", cls.__name__, name)
 
     for name, attr in list(cls.__dict__.items()):
         if not inspect.isfunction(attr):
@@ -0,0 +1,241 @@
+"""Counters, gauges and histograms for pipeline latency and token usage, exported as Prometheus text or a JSON snapshot"""
+from contextlib import contextmanager
+from typing import Iterator
+import bisect
+import json
+import math
+import threading
+import time
+
+DEFAULT_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0) # seconds
+
+LabelSet = tuple[tuple[str, str], ...]
+
+
+def _label_set(labels: dict) -> LabelSet:
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def _prometheus_labels(label_set: LabelSet, extra: dict[str, str] | None = None) -> str:
+    pairs = list(label_set) + list((extra or {}).items())
+    if not pairs:
+        return ""
+    escape = lambda value: value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return "{" + ",".join(f'{name}="{escape(value)}"' for name, value in pairs) + "}"
+
+
+class Counter:
+    """ a monotonically increasing value per set of labels """
+
+    def __init__(self, name: str, help: str = ""):
+        self.name = name
+        self.help = help
+        self.values: dict[LabelSet, float] = {}
+        self._lock = threading.Lock() # google calls are made from worker threads
+
+    def inc(self, amount: float = 1.0, **labels) -> None:
+        key = _label_set(labels)
+        with self._lock:
+            self.values[key] = self.values.get(key, 0.0) + amount
+
+    def value(self, **labels) -> float:
+        return self.values.get(_label_set(labels), 0.0)
+
+    def total(self) -> float:
+        return sum(self.values.values())
+
+    def reset(self) -> None:
+        with self._lock:
+            self.values.clear()
+
+    def to_prometheus(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        lines += [f"{self.name}{_prometheus_labels(key)} {value:g}" for key, value in sorted(self.values.items())]
+        return lines
+
+    def snapshot(self) -> list[dict]:
+        return [{"labels": dict(key), "value": value} for key, value in sorted(self.values.items())]
+
+
+class Gauge:
+    """ a value per set of labels that can go up and down, e.g. a current limit """
+
+    def __init__(self, name: str, help: str = ""):
+        self.name = name
+        self.help = help
+        self.values: dict[LabelSet, float] = {}
+        self._lock = threading.Lock()
+
+    def set(self, value: float, **labels) -> None:
+        key = _label_set(labels)
+        with self._lock:
+            self.values[key] = float(value)
+
+    def value(self, **labels) -> float:
+        return self.values.get(_label_set(labels), 0.0)
+
+    def reset(self) -> None:
+        with self._lock:
+            self.values.clear()
+
+    def to_prometheus(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge"]
+        lines += [f"{self.name}{_prometheus_labels(key)} {value:g}" for key, value in sorted(self.values.items())]
+        return lines
+
+    def snapshot(self) -> list[dict]:
+        return [{"labels": dict(key), "value": value} for key, value in sorted(self.values.items())]
+
+
+class _HistogramSeries:
+    def __init__(self, n_buckets: int):
+        self.counts = [0] * (n_buckets + 1) # per bucket, not cumulative. the last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+
+class Histogram:
+    """
+    Bucketed distribution of observed values per set of labels. Quantiles are estimated by interpolating
+    within the bucket they fall in, so they are only as precise as the buckets.
+    """
+
+    def __init__(self, name: str, help: str = "", buckets: tuple[float, ...] = DEFAULT_LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(sorted(buckets))
+        self.series: dict[LabelSet, _HistogramSeries] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels) -> None:
+        key = _label_set(labels)
+        with self._lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = _HistogramSeries(len(self.buckets))
+            series.counts[bisect.bisect_left(self.buckets, value)] += 1
+            series.count += 1
+            series.sum += value
+            series.max = max(series.max, value)
+
+    @contextmanager
+    def time(self, **labels) -> Iterator[None]:
+        """ observes the seconds spent in the with block, also when it raises """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def count(self, **labels) -> int:
+        series = self.series.get(_label_set(labels))
+        return series.count if series else 0
+
+    def quantile(self, q: float, **labels) -> float:
+        series = self.series.get(_label_set(labels))
+        if not series or not series.count:
+            return 0.0
+        rank = q * series.count
+        seen = 0
+        for i, count in enumerate(series.counts):
+            if count and seen + count >= rank:
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                upper = self.buckets[i] if i < len(self.buckets) else series.max
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+        return series.max
+
+    def reset(self) -> None:
+        with self._lock:
+            self.series.clear()
+
+    def to_prometheus(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for key, series in sorted(self.series.items()):
+            cumulative = 0
+            for bound, count in zip(list(self.buckets) + [math.inf], series.counts):
+                cumulative += count
+                le = "+Inf" if bound == math.inf else f"{bound:g}"
+                lines.append(f"{self.name}_bucket{_prometheus_labels(key, {'le': le})} {cumulative}")
+            lines.append(f"{self.name}_sum{_prometheus_labels(key)} {series.sum:g}")
+            lines.append(f"{self.name}_count{_prometheus_labels(key)} {series.count}")
+        return lines
+
+    def snapshot(self) -> list[dict]:
+        return [
+            {
+                "labels": dict(key),
+                "count": series.count,
+                "sum": series.sum,
+                "mean": series.sum / series.count if series.count else 0.0,
+                "max": series.max,
+                **{f"p{round(q * 100)}": self.quantile(q, **dict(key)) for q in (0.5, 0.95, 0.99)},
+            }
+            for key, series in sorted(self.series.items())
+        ]
+
+
+class MetricsRegistry:
+    """ named counters, gauges and histograms, created on first use and shared by every module that asks for them """
+
+    def __init__(self):
+        self.metrics: dict[str, Counter | Gauge | Histogram] = {}
+        self._lock = threading.Lock()
+
+    def _get_or_create(self, cls, name: str, **kwargs):
+        with self._lock:
+            if name not in self.metrics:
+                self.metrics[name] = cls(name, **kwargs)
+            metric = self.metrics[name]
+        if not isinstance(metric, cls):
+            raise ValueError(f"Metric {name} is a {type(metric).__name__}, not a {cls.__name__}")
+        return metric
+
+    def counter(self, name: str, help: str = "") -> Counter:
+        return self._get_or_create(Counter, name, help=help)
+
+    def gauge(self, name: str, help: str = "") -> Gauge:
+        return self._get_or_create(Gauge, name, help=help)
+
+    def histogram(self, name: str, help: str = "", buckets: tuple[float, ...] = DEFAULT_LATENCY_BUCKETS) -> Histogram:
+        return self._get_or_create(Histogram, name, help=help, buckets=buckets)
+
+    def reset(self) -> None:
+        """ zeroes every metric, keeping the objects modules hold on to """
+        for metric in self.metrics.values():
+            metric.reset()
+
+    def to_prometheus(self) -> str:
+        return "\n".join(line for _, metric in sorted(self.metrics.items()) for line in metric.to_prometheus()) + "\n"
+
+    def snapshot(self) -> dict:
+        return {
+            "counters": {name: metric.snapshot() for name, metric in sorted(self.metrics.items()) if isinstance(metric, Counter)},
+            "gauges": {name: metric.snapshot() for name, metric in sorted(self.metrics.items()) if isinstance(metric, Gauge)},
+            "histograms": {name: metric.snapshot() for name, metric in sorted(self.metrics.items()) if isinstance(metric, Histogram)},
+            "prompt_cache_hit_rate": {agent: prompt_cache_hit_rate(agent, self) for agent in _llm_agents(self)},
+        }
+
+    def write(self, path: str) -> None:
+        """ Prometheus text format for a .prom path, a JSON snapshot otherwise """
+        with open(path, "w") as f:
+            if path.endswith(".prom"):
+                f.write(self.to_prometheus())
+            else:
+                json.dump(self.snapshot(), f, indent=2)
+
+
+metrics = MetricsRegistry()
+
+
+def _llm_agents(registry: MetricsRegistry) -> list[str]:
+    requests = registry.metrics.get("llm_requests_total")
+    return sorted({dict(key)["agent"] for key in requests.values}) if requests else []
+
+
+def prompt_cache_hit_rate(agent: str = "summarizer", registry: MetricsRegistry = metrics) -> float:
+    """ fraction of the agent's input tokens read from the provider's prompt cache (e.g. the cached system message) """
+    tokens = registry.counter("llm_tokens_total")
+    input_tokens = tokens.value(agent=agent, kind="input")
+    return tokens.value(agent=agent, kind="cache_read") / input_tokens if input_tokens else 0.0
@@ -0,0 +1,74 @@
+"""Groups items submitted by concurrent coroutines into batched calls"""
+from typing import Any, Awaitable, Callable
+import asyncio
+
+DEFAULT_MAX_WAIT_SECONDS = 0.05
+
+
+from logger import logged_class
+@logged_class
+class MicroBatcher:
+    """
+    Collects items from concurrent submit() calls and hands them to process_batch together, once max_batch_size
+    items are pending or max_wait_seconds after the first of them arrived, whichever comes first.
+    process_batch returns one result per item, in order, and each caller gets back the result for its own item
+    (or the exception, if the whole batch failed).
+    """
+
+    def __init__(
+        self,
+        process_batch: Callable[[list[Any]], Awaitable[list[Any]]],
+        max_batch_size: int,
+        max_wait_seconds: float = DEFAULT_MAX_WAIT_SECONDS,
+    ):
+        self.process_batch = process_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait_seconds = max_wait_seconds
+        self.batches = 0
+        self.items = 0
+        self._pending: list[tuple[Any, asyncio.Future]] = []
+        self._timer: asyncio.TimerHandle | None = None
+        self._tasks: set[asyncio.Task] = set() # keeps running batches from being garbage collected
+
+    async def submit(self, item: Any) -> Any:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((item, future))
+        if len(self._pending) >= self.max_batch_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_wait_seconds, self._flush)
+        return await future
+
+    def _flush(self) -> None:
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+        # callers that timed out while waiting have cancelled their futures, no need to send their items
+        pending = [(item, future) for item, future in self._pending if not future.cancelled()]
+        self._pending = []
+        if pending:
+            task = asyncio.ensure_future(self._run(pending))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, pending: list[tuple[Any, asyncio.Future]]) -> None:
+        self.batches += 1
+        self.items += len(pending)
+        try:
+            results = await self.process_batch([item for item, _ in pending])
+        except Exception as e:
+            for _, future in pending:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), result in zip(pending, results):
+            if not future.done():
+                future.set_result(result)
+
+    def stats(self) -> dict[str, float]:
+        return {
+            "batches": self.batches,
+            "items": self.items,
+            "avg_batch_size": self.items / self.batches if self.batches else 0.0,
+        }
@@ -0,0 +1,25 @@
+"""
+Migrates a FileDB log (and its compaction snapshot) into a SQLiteDB.
+usage: python migrate_db.py processed_emails_db.txt processed_emails.db [--ttl-days 30]
+"""
+import argparse
+import os
+from db import FileDB, SQLiteDB, migrate
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Migrate a FileDB log into a SQLiteDB")
+    parser.add_argument("source", help="FileDB log file")
+    parser.add_argument("destination", help="SQLite database file, created if missing")
+    parser.add_argument("--ttl-days", type=float, default=None, help="Expire the migrated keys this long from now (default: never)")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.source):
+        parser.error(f"{args.source} does not exist")
+    ttl_seconds = args.ttl_days * 24 * 60 * 60 if args.ttl_days is not None else None
+    with FileDB(args.source, compaction_garbage_ratio=None) as source, SQLiteDB(args.destination, default_ttl_seconds=ttl_seconds) as destination:
+        print(f"Migrated {migrate(source, destination):,} keys from {args.source} to {args.destination}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,49 @@
+"""Helpers for connecting blocking and async pipeline stages"""
+from typing import AsyncGenerator, Callable, Iterator, TypeVar
+import asyncio
+import threading
+
+DEFAULT_QUEUE_SIZE = 100
+
+T = TypeVar("T")
+_DONE = object()
+
+
+async def iterate_in_thread(make_iterator: Callable[[], Iterator[T]], maxsize: int = DEFAULT_QUEUE_SIZE) -> AsyncGenerator[T, None]:
+    """
+    Runs a blocking iterator (e.g. one paging through a google api) in a background thread and yields its items
+    on the event loop. The thread stays at most maxsize items ahead of the consumer, and errors are re-raised here.
+    A daemon thread rather than the default executor, so a consumer that stops early never waits on a blocked call.
+    """
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue(maxsize=maxsize)
+    stopped = threading.Event()
+
+    def put(item, error=None):
+        asyncio.run_coroutine_threadsafe(queue.put((item, error)), loop).result()
+
+    def produce():
+        try:
+            for item in make_iterator():
+                if stopped.is_set():
+                    return
+                put(item)
+            put(_DONE)
+        except Exception as e:
+            if not stopped.is_set():
+                put(_DONE, e)
+
+    threading.Thread(target=produce, daemon=True).start()
+    try:
+        while True:
+            item, error = await queue.get()
+            if item is _DONE:
+                if error:
+                    raise error
+                return
+            yield item
+    finally:
+        stopped.set()
+        # unblock a put the thread may be waiting on, it notices stopped before producing another item
+        while not queue.empty():
+            queue.get_nowait()
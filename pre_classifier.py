@@ -0,0 +1,132 @@
+"""Cheap rule-based pre-classification of emails, to keep obvious cases away from the LLM"""
+from collections import Counter
+from dataclasses import dataclass
+from enum import Enum
+from typing import Callable, Iterable
+import re
+from email_service import Email
+
+
+class Verdict(Enum):
+    IMPORTANT = "important" # definitely important, skip the LLM
+    UNIMPORTANT = "unimportant" # definitely not important, skip the LLM
+    ASK_LLM = "ask_llm" # not sure, let the LLM decide
+
+
+BULK_CATEGORY_LABELS = ("CATEGORY_PROMOTIONS", "CATEGORY_SOCIAL", "CATEGORY_FORUMS")
+
+# strong signals of something the user must act on, per the summarizer prompt's hard rules. matched on the subject only,
+# and only as whole phrases: single words like "password" or "deadline" show up in promos and policy notices too
+IMPORTANT_SUBJECT_KEYWORDS = (
+    "security alert", "new login", "new sign-in", "suspicious sign-in", "account locked", "verify your account",
+    "verification required", "action needed", "action required", "calendar invite", "interview invitation", "offer letter",
+)
+
+# subjects that are almost always bulk mail
+BULK_SUBJECT_KEYWORDS = ("newsletter", "digest", "mailing list", "coupon", "weekly promotions")
+
+# time-anchored content is important even in bulk mail (e.g. "flash sale ends tonight"), so bulk rules never fire on it.
+# words like "ends", "until" or "only" alone are in nearly every promo, so they only count followed by an actual time
+TIME_ANCHOR_PATTERN = re.compile(
+    r"\b(today|tonight|tomorrow|midnight|deadline|expir\w*|last (day|chance)|(ends|until) \d|this weekend|"
+    r"eod|due (by|on|date)|by \d|\d{1,2}(:\d{2})?\s?(am|pm)|"
+    r"monday|tuesday|wednesday|thursday|friday|saturday|sunday|end of (the )?month)\b",
+    flags=re.IGNORECASE,
+)
+
+
+def _keyword_pattern(keywords: Iterable[str]) -> re.Pattern:
+    return re.compile(r"\b(" + "|".join(re.escape(k) for k in keywords) + r")\b", flags=re.IGNORECASE)
+
+
+def _sender_address(email: Email) -> str:
+    """ lowercased address from a From header like 'Name <addr@domain.com>' """
+    sender = email.sender or ""
+    match = re.search(r"<([^>]+)>", sender)
+    return (match.group(1) if match else sender).strip().lower()
+
+
+def _is_time_anchored(email: Email) -> bool:
+    return bool(TIME_ANCHOR_PATTERN.search(email.subject) or TIME_ANCHOR_PATTERN.search(email.body or ""))
+
+
+@dataclass
+class Rule:
+    name: str # reported in the hit statistics
+    verdict: Verdict # verdict when the rule matches
+    matches: Callable[[Email], bool]
+
+
+def keyword_rule(name: str, verdict: Verdict, keywords: Iterable[str], subject_only: bool = False, unless_time_anchored: bool = False) -> Rule:
+    pattern = _keyword_pattern(keywords) # compiled once, not per email
+
+    def matches(email: Email) -> bool:
+        text = email.subject if subject_only else f"{email.subject}\n{email.body}"
+        if not pattern.search(text):
+            return False
+        return not (unless_time_anchored and _is_time_anchored(email))
+    return Rule(name, verdict, matches)
+
+
+def sender_rule(name: str, verdict: Verdict, senders: Iterable[str]) -> Rule:
+    """ senders are full addresses or @domains """
+    senders = {s.lower() for s in senders}
+
+    def matches(email: Email) -> bool:
+        address = _sender_address(email)
+        return bool(address) and (address in senders or "@" + address.split("@")[-1] in senders)
+    return Rule(name, verdict, matches)
+
+
+def bulk_header_rule(name: str = "bulk_headers") -> Rule:
+    """ List-Unsubscribe header or a gmail promotions/social/forums category, and nothing time-anchored """
+    def matches(email: Email) -> bool:
+        is_bulk = bool(email.list_unsubscribe) or any(label in BULK_CATEGORY_LABELS for label in email.label_ids)
+        return is_bulk and not _is_time_anchored(email)
+    return Rule(name, Verdict.UNIMPORTANT, matches)
+
+
+from logger import logged_class
+@logged_class
+class RuleBasedPreClassifier:
+    """
+    Runs rules in order, the first matching rule decides. Emails no rule matches go to the LLM.
+    Keeps per-rule hit counts so rules that never fire (or fire too often) are easy to spot.
+    """
+
+    def __init__(self, rules: list[Rule]):
+        self.rules = rules
+        self.rule_hits = Counter()
+        self.verdicts = Counter()
+
+    def classify(self, email: Email) -> tuple[Verdict, str | None]:
+        """ returns the verdict and the name of the rule that decided it (None if no rule matched) """
+        for rule in self.rules:
+            if rule.matches(email):
+                self.rule_hits[rule.name] += 1
+                self.verdicts[rule.verdict] += 1
+                return rule.verdict, rule.name
+        self.verdicts[Verdict.ASK_LLM] += 1
+        return Verdict.ASK_LLM, None
+
+    def stats(self) -> dict:
+        total = sum(self.verdicts.values())
+        decided = total - self.verdicts[Verdict.ASK_LLM]
+        return {
+            "emails": total,
+            "bypassed_llm": decided,
+            "bypass_rate": decided / total if total else 0.0,
+            "verdicts": {verdict.value: count for verdict, count in self.verdicts.items()},
+            "rule_hits": dict(self.rule_hits),
+        }
+
+
+def init_pre_classifier(allow_senders: Iterable[str] = (), deny_senders: Iterable[str] = ()) -> RuleBasedPreClassifier:
+    """ default rule set. allow/deny senders are full addresses or @domains. """
+    return RuleBasedPreClassifier([
+        sender_rule("allowed_sender", Verdict.IMPORTANT, allow_senders),
+        sender_rule("denied_sender", Verdict.UNIMPORTANT, deny_senders),
+        keyword_rule("important_keywords", Verdict.IMPORTANT, IMPORTANT_SUBJECT_KEYWORDS, subject_only=True),
+        bulk_header_rule(),
+        keyword_rule("bulk_subject_keywords", Verdict.UNIMPORTANT, BULK_SUBJECT_KEYWORDS, subject_only=True, unless_time_anchored=True),
+    ])
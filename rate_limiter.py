@@ -0,0 +1,198 @@
+"""Client-side limiters for pacing LLM calls"""
+from typing import Any, Callable
+import asyncio
+import time
+
+from metrics import metrics
+
+DEFAULT_INITIAL_LIMIT = 5
+DEFAULT_MIN_LIMIT = 1
+DEFAULT_MAX_LIMIT = 32
+DEFAULT_DECREASE_FACTOR = 0.5
+DEFAULT_DECREASE_COOLDOWN_SECONDS = 1.0 # overloads within this window count as one congestion event
+
+concurrency_limit = metrics.gauge("llm_concurrency_limit", "Current limit of each adaptive concurrency limiter, by limiter name")
+
+
+from logger import logged_class
+@logged_class
+class AdaptiveConcurrencyLimiter:
+    """
+    AIMD concurrency limiter shared by all workers, used like a semaphore (async with limiter: ...).
+    The limit grows by ~1 per limit's worth of successful calls, and is multiplied by decrease_factor
+    on rate limits or timeouts. A retry-after from the provider pauses all new acquisitions until it passes.
+    The current limit is exported as the llm_concurrency_limit gauge, labelled with name.
+    """
+
+    def __init__(
+        self,
+        initial_limit: int = DEFAULT_INITIAL_LIMIT,
+        min_limit: int = DEFAULT_MIN_LIMIT,
+        max_limit: int = DEFAULT_MAX_LIMIT,
+        decrease_factor: float = DEFAULT_DECREASE_FACTOR,
+        decrease_cooldown_seconds: float = DEFAULT_DECREASE_COOLDOWN_SECONDS,
+        clock: Callable[[], float] = time.monotonic,
+        name: str = "llm",
+    ):
+        self.name = name
+        self.limit = float(initial_limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.decrease_factor = decrease_factor
+        self.decrease_cooldown_seconds = decrease_cooldown_seconds
+        self.clock = clock
+        self.in_flight = 0
+        self.successes = 0
+        self.overloads = 0
+        self.decreases = 0
+        self._paused_until = 0.0
+        self._last_decrease = float("-inf")
+        self._cond = None # created lazily so the limiter can be built outside an event loop
+        self._cond_loop = None # the event loop self._cond belongs to
+        concurrency_limit.set(self.current_limit, limiter=self.name)
+
+    @property
+    def current_limit(self) -> int:
+        return int(self.limit)
+
+    def _condition(self) -> asyncio.Condition:
+        """
+        The condition of the running event loop. A limiter outlives asyncio.run calls (the summarizer keeps one across
+        runs), and a condition is bound to the loop it was first used in, so a new loop gets a new one. Slots still
+        held in a previous loop can never be released, they died with it.
+        """
+        loop = asyncio.get_running_loop()
+        if self._cond is None or self._cond_loop is not loop:
+            self._cond = asyncio.Condition()
+            self._cond_loop = loop
+            self.in_flight = 0
+        return self._cond
+
+    async def acquire(self) -> None:
+        cond = self._condition()
+        async with cond:
+            while True:
+                pause = self._paused_until - self.clock()
+                if pause > 0:
+                    try:
+                        await asyncio.wait_for(cond.wait(), timeout=pause)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                if self.in_flight < self.current_limit:
+                    break
+                await cond.wait()
+            self.in_flight += 1
+
+    async def release(self) -> None:
+        cond = self._condition()
+        async with cond:
+            self.in_flight -= 1
+            cond.notify_all()
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.release()
+
+    def on_success(self) -> None:
+        """ additive increase: +1 to the limit for every limit's worth of successes """
+        self.successes += 1
+        self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+        concurrency_limit.set(self.current_limit, limiter=self.name)
+
+    def on_overload(self, retry_after: float | None = None) -> None:
+        """ multiplicative decrease on a rate limit or timeout, and a shared pause if the provider sent retry-after """
+        self.overloads += 1
+        now = self.clock()
+        if now - self._last_decrease >= self.decrease_cooldown_seconds:
+            self.limit = max(self.min_limit, self.limit * self.decrease_factor)
+            self._last_decrease = now
+            self.decreases += 1
+            concurrency_limit.set(self.current_limit, limiter=self.name)
+        if retry_after:
+            self._paused_until = max(self._paused_until, now + retry_after)
+
+    def stats(self) -> dict[str, float]:
+        return {
+            "limit": self.current_limit,
+            "in_flight": self.in_flight,
+            "successes": self.successes,
+            "overloads": self.overloads,
+            "decreases": self.decreases,
+        }
+
+
+DEFAULT_REQUESTS_PER_MINUTE = 50
+DEFAULT_TOKENS_PER_MINUTE = 40_000
+
+
+class TokenBucket:
+    """ classic token bucket: holds up to capacity tokens, refilled continuously at refill_per_second """
+
+    def __init__(self, capacity: float, refill_per_second: float, clock: Callable[[], float] = time.monotonic):
+        self.capacity = capacity
+        self.refill_per_second = refill_per_second
+        self.clock = clock
+        self.tokens = capacity
+        self._last_refill = clock()
+
+    def _refill(self) -> None:
+        now = self.clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self._last_refill) * self.refill_per_second)
+        self._last_refill = now
+
+    def wait_time(self, amount: float) -> float:
+        """ seconds until amount tokens are available (0 if they are now) """
+        self._refill()
+        amount = min(amount, self.capacity) # otherwise oversized requests could never go through
+        return max(0.0, (amount - self.tokens) / self.refill_per_second)
+
+    def take(self, amount: float) -> None:
+        self.tokens -= min(amount, self.capacity)
+
+
+@logged_class
+class TokenBucketRateLimiter:
+    """
+    Paces LLM calls client-side with two token buckets: requests per minute and (estimated) tokens per minute.
+    One instance can be shared by several EmailSummarizers in a process so they split the same provider quota.
+    clock and sleep can be swapped for fakes in tests.
+    """
+
+    def __init__(
+        self,
+        requests_per_minute: float = DEFAULT_REQUESTS_PER_MINUTE,
+        tokens_per_minute: float = DEFAULT_TOKENS_PER_MINUTE,
+        clock: Callable[[], float] = time.monotonic,
+        sleep: Callable[[float], Any] = asyncio.sleep,
+    ):
+        self.requests = TokenBucket(requests_per_minute, requests_per_minute / 60, clock=clock)
+        self.tokens = TokenBucket(tokens_per_minute, tokens_per_minute / 60, clock=clock)
+        self.sleep = sleep
+        self.acquired_requests = 0
+        self.acquired_tokens = 0
+        self.waited_seconds = 0.0
+
+    async def acquire(self, tokens: int) -> None:
+        """ waits until both one request and tokens estimated tokens fit in the budget, then takes them """
+        while True:
+            wait = max(self.requests.wait_time(1), self.tokens.wait_time(tokens))
+            if wait <= 0:
+                break
+            self.waited_seconds += wait
+            await self.sleep(wait)
+        # no await between the check and the take, so concurrent acquirers can't both pass on the same tokens
+        self.requests.take(1)
+        self.tokens.take(tokens)
+        self.acquired_requests += 1
+        self.acquired_tokens += tokens
+
+    def stats(self) -> dict[str, float]:
+        return {
+            "requests": self.acquired_requests,
+            "tokens": self.acquired_tokens,
+            "waited_seconds": self.waited_seconds,
+        }
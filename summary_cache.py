@@ -0,0 +1,102 @@
+"""Persistent content-hash cache for email summaries"""
+from collections import OrderedDict
+from typing import Any, Callable
+import hashlib
+import json
+import re
+import time
+from db import DB
+
+DEFAULT_MAX_ENTRIES = 10_000
+DEFAULT_TTL_SECONDS = 24 * 60 * 60 # summaries contain times relative to when they were made, so don't keep them too long
+
+
+def normalize_email_text(text: str) -> str:
+    """ collapses whitespace and case so trivially different copies of an email share a cache entry """
+    return re.sub(r"\s+", " ", text).strip().lower()
+
+
+from logger import logged_class
+@logged_class
+class SummaryCache:
+    """
+    LRU cache with TTL expiry, keyed by a hash of the normalized email text plus the model id and prompt version.
+    Values are JSON-serializable dicts, persisted through a connected DB so re-runs can reuse them.
+    """
+
+    def __init__(
+        self,
+        db: DB,
+        model_id: str,
+        prompt_version: str,
+        max_entries: int = DEFAULT_MAX_ENTRIES,
+        ttl_seconds: float = DEFAULT_TTL_SECONDS,
+        clock: Callable[[], float] = time.time,
+    ):
+        self.db = db
+        self.model_id = model_id
+        self.prompt_version = prompt_version
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        # key -> (created_at, value), least recently used first
+        self.entries: OrderedDict[str, tuple[float, Any]] = OrderedDict()
+        for key in self.db.keys():
+            record = json.loads(self.db.get(key))
+            self.entries[key] = (record["created_at"], record["value"])
+        self._evict()
+
+    def make_key(self, email_text: str) -> str:
+        content = "\0".join([self.model_id, self.prompt_version, normalize_email_text(email_text)])
+        return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+    def _is_expired(self, created_at: float) -> bool:
+        return self.clock() - created_at > self.ttl_seconds
+
+    def _remove(self, key: str) -> None:
+        del self.entries[key]
+        self.db.delete(key)
+        self.evictions += 1
+
+    def _evict(self) -> None:
+        for key in [key for key, (created_at, _) in self.entries.items() if self._is_expired(created_at)]:
+            self._remove(key)
+        while len(self.entries) > self.max_entries:
+            self._remove(next(iter(self.entries)))
+
+    def get(self, email_text: str) -> Any | None:
+        key = self.make_key(email_text)
+        entry = self.entries.get(key)
+        if entry is None or self._is_expired(entry[0]):
+            if entry is not None:
+                self._remove(key)
+            self.misses += 1
+            return None
+
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, email_text: str, value: Any) -> None:
+        key = self.make_key(email_text)
+        created_at = self.clock()
+        if key in self.entries:
+            del self.entries[key]
+            self.db.delete(key) # re-append so the log keeps entries in recency order
+        self.entries[key] = (created_at, value)
+        self.db.put(key, json.dumps({"created_at": created_at, "value": value}))
+        self._evict()
+
+    def stats(self) -> dict[str, float]:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "entries": len(self.entries),
+        }
@@ -0,0 +1,19 @@
+from bloom_filter import BloomFilter
+
+
+def test_no_false_negatives_and_bounded_false_positives():
+    bloom = BloomFilter(capacity=5000, error_rate=0.01)
+    bloom.add_many(f"m{i}" for i in range(5000))
+
+    assert all(bloom.contains_many(f"m{i}" for i in range(5000)))
+    assert "m42" in bloom
+    false_positives = sum(bloom.contains_many(f"absent{i}" for i in range(50_000)))
+    assert false_positives / 50_000 < 0.02
+    assert not bloom.is_full()
+
+
+def test_empty_batches():
+    bloom = BloomFilter()
+    bloom.add_many([])
+    assert bloom.contains_many([]) == []
+    assert "anything" not in bloom
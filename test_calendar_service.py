@@ -1,8 +1,53 @@
 from datetime import datetime, timedelta, timezone
 from calendar_service import CalendarService, CalendarEvent, EventTimeInfo
 from email_summarizer import Timezone
+from fakes import FakeCalendarClient, make_http_error
+import calendar_service
+import pytest
 CALENDAR_CREDENTIALS_PATH = "secrets/calendar_credentials.json"
 
+
+@pytest.fixture
+def no_sleep(monkeypatch):
+    monkeypatch.setattr(calendar_service.time, "sleep", lambda _: None)
+
+
+def _events(n: int) -> list[CalendarEvent]:
+    return [CalendarEvent(title=f"Event {i}", message_id=f"m{i}") for i in range(n)]
+
+
+def test_create_events_batches_inserts_with_deterministic_ids():
+    client = FakeCalendarClient()
+    results = CalendarService(calendar_client=client).create_events(_events(7), batch_size=3)
+
+    assert [r.event_id for r in results] == [calendar_service.event_id_for_message(f"m{i}") for i in range(7)]
+    assert all(r.ok and r.created for r in results)
+    assert client.batch_calls == 3
+    assert len(client.events_by_calendar[calendar_service.CALENDAR_ID]) == 7
+
+
+def test_retried_inserts_are_idempotent():
+    client = FakeCalendarClient()
+    svc = CalendarService(calendar_client=client)
+    svc.create_events(_events(2))
+
+    # e.g. a run that crashed after inserting but before marking the emails processed
+    results = svc.create_events(_events(3))
+    assert [(r.ok, r.created) for r in results] == [(True, False), (True, False), (True, True)]
+    assert svc.create_event(_events(1)[0]) == results[0].event_id
+    assert len(client.events_by_calendar[calendar_service.CALENDAR_ID]) == 3
+
+
+def test_throttled_inserts_are_retried_and_errors_reported_per_event(no_sleep):
+    event_id = calendar_service.event_id_for_message
+    client = FakeCalendarClient(throttle={event_id("m0"): 2}, errors={event_id("m2"): make_http_error(400, "invalid")})
+    results = CalendarService(calendar_client=client).create_events(_events(3))
+
+    assert [r.ok for r in results] == [True, True, False]
+    assert results[2].error.status_code == 400
+    assert client.batch_calls == 3
+    assert client.insert_calls == 3 + 1 + 1
+
 if __name__ == "__main__":
     svc = CalendarService()
 
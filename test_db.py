@@ -0,0 +1,207 @@
+import os
+import time
+import pytest
+from db import BloomFilteredDB, FileDB, FsyncPolicy, SQLiteDB, migrate
+
+
+def _connect(path, **kwargs) -> FileDB:
+    db = FileDB(str(path), **kwargs)
+    db.connect()
+    return db
+
+
+def _connect_sqlite(path, **kwargs) -> SQLiteDB:
+    db = SQLiteDB(str(path), **kwargs)
+    db.connect()
+    return db
+
+
+class FakeClock:
+    def __init__(self, now: float = 0.0):
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def test_reload_after_compaction_reads_snapshot_and_tail(tmp_path):
+    path = tmp_path / "db.txt"
+    db = _connect(path, compaction_garbage_ratio=None)
+    for i in range(10):
+        db.put(f"k{i}", f"v {i}")
+    db.delete("k3")
+    db.compact()
+    db.put("k0", "new")
+    db.delete("k9")
+
+    assert os.path.exists(str(path) + ".snapshot")
+    assert path.read_text() == "PUT k0 new\nDELETE k9\n"
+    reloaded = _connect(path)
+    assert reloaded.store == {"k0": "new", **{f"k{i}": f"v {i}" for i in (1, 2, 4, 5, 6, 7, 8)}}
+    assert reloaded.keys()[0] == "k0"
+
+
+def test_crash_between_snapshot_and_log_truncation_is_harmless(tmp_path):
+    path = tmp_path / "db.txt"
+    db = _connect(path, compaction_garbage_ratio=None)
+    db.put("a", "1")
+    db.put("a", "2")
+    db.delete("b")
+    db.put("b", "3")
+    db.delete("a")
+    log = path.read_text()
+    db.compact()
+    path.write_text(log) # as if the process died before the log was truncated
+
+    assert _connect(path).store == {"b": "3"}
+
+
+def test_garbage_ratio_triggers_compaction(tmp_path):
+    path = tmp_path / "db.txt"
+    db = _connect(path, compaction_garbage_ratio=0.5, compaction_min_records=10)
+    for i in range(5):
+        db.put(f"k{i}", "v")
+    for i in range(4):
+        db.put("k0", str(i))
+    assert db.compactions == 0
+    db.put("k0", "last") # 10 records on disk, 5 live
+
+    assert db.compactions == 1
+    assert db.garbage_ratio() == 0
+    assert path.read_text() == ""
+    assert _connect(path).store == {"k0": "last", "k1": "v", "k2": "v", "k3": "v", "k4": "v"}
+
+
+def test_batch_is_group_committed_on_exit(tmp_path):
+    path = tmp_path / "db.txt"
+    db = _connect(path, fsync_policy=FsyncPolicy.ALWAYS)
+    with db.batch():
+        db.put("a", "1")
+        db.put_many({"b": "2", "c": "3"})
+        db.delete("a")
+        assert path.read_text() == "" # nothing reaches the file before the commit
+        assert db.get("b") == "2"
+
+    assert (db.commits, db.fsyncs) == (1, 1)
+    assert _connect(path).store == {"b": "2", "c": "3"}
+
+
+def test_compaction_inside_a_batch(tmp_path):
+    path = tmp_path / "db.txt"
+    db = _connect(path, compaction_garbage_ratio=None)
+    with db.batch():
+        db.put("a", "1")
+        db.put("a", "2")
+        db.compact() # commits what the batch had buffered so far
+        db.put("b", "3")
+
+    assert db.compactions == 1
+    assert path.read_text() == "PUT b 3\n"
+    assert _connect(path).store == {"a": "2", "b": "3"}
+
+    with db.batch():
+        db.put("c", "4")
+        db.compact() # nothing left for the batch to commit on exit
+    assert _connect(path).store == {"a": "2", "b": "3", "c": "4"}
+
+
+def test_fsync_policies(tmp_path):
+    always = _connect(tmp_path / "always.txt", fsync_policy=FsyncPolicy.ALWAYS)
+    never = _connect(tmp_path / "never.txt", fsync_policy="never")
+    interval = _connect(tmp_path / "interval.txt", fsync_policy=FsyncPolicy.INTERVAL, fsync_interval_ms=60_000)
+    for db in (always, never, interval):
+        for i in range(3):
+            db.put(f"k{i}", "v")
+
+    assert [db.fsyncs for db in (always, never, interval)] == [3, 0, 0]
+    # committed writes are already with the OS, whatever the policy
+    assert _connect(tmp_path / "never.txt").store == {"k0": "v", "k1": "v", "k2": "v"}
+    never.flush()
+    interval.flush()
+    assert [db.fsyncs for db in (always, never, interval)] == [3, 1, 1]
+
+
+def test_interval_fsyncs_in_the_background_once_idle(tmp_path):
+    db = _connect(tmp_path / "db.txt", fsync_policy=FsyncPolicy.INTERVAL, fsync_interval_ms=100)
+    db.put("a", "1")
+    db.put("b", "2")
+    assert db.fsyncs == 0 # within the interval of the db being opened
+
+    # no commit follows, the timer fsyncs them
+    time.sleep(0.3)
+    assert db.fsyncs == 1
+    db.disconnect()
+    assert db.fsyncs == 1
+
+
+def test_context_manager_and_torn_last_line(tmp_path):
+    path = tmp_path / "db.txt"
+    with FileDB(str(path)) as db:
+        db.put("a", "1 2")
+    with open(path, "a") as f:
+        f.write("PUT b") # the process died mid-write
+
+    with FileDB(str(path)) as db:
+        assert db.store == {"a": "1 2"}
+        db.put("c", "3")
+    assert _connect(path).store == {"a": "1 2", "c": "3"}
+
+
+def test_sqlite_ttl_expiry(tmp_path):
+    clock = FakeClock()
+    db = _connect_sqlite(tmp_path / "db.sqlite", default_ttl_seconds=60, clock=clock)
+    db.put("a", True)
+    db.put("b", "1", ttl_seconds=3600)
+    db.put_many({"c": "2", "d": "3"})
+    clock.now += 61
+
+    assert db.get("a") is None # invisible before any sweep
+    assert db.keys() == ["b"]
+    assert db.expire() == 3
+    clock.now += 3600
+    assert _connect_sqlite(tmp_path / "db.sqlite", clock=clock).keys() == [] # swept on connect
+
+
+def test_sqlite_get_many_overwrites_and_batches(tmp_path):
+    db = _connect_sqlite(tmp_path / "db.sqlite")
+    db.put_many((f"m{i}", True) for i in range(1200))
+    db.put("m0", "again")
+    db.delete("m5")
+
+    found = db.get_many(f"m{i}" for i in range(0, 1300, 5))
+    assert len(found) == 239 # m5 deleted, m1200 and up never stored
+    assert found["m0"] == "again" and found["m10"] == "True"
+    assert db.contains_many(["m0", "m5", "m1200"]) == {"m0"}
+    assert db.keys()[:2] == ["m0", "m1"] # an overwrite keeps the key's place
+
+    with pytest.raises(RuntimeError):
+        with db.batch():
+            db.put("rolled back", "1")
+            raise RuntimeError()
+    assert db.get("rolled back") is None
+
+
+def test_migrate_file_db_to_sqlite(tmp_path):
+    with FileDB(str(tmp_path / "db.txt")) as source:
+        source.put("a", True)
+        source.put("b", "x y")
+        source.delete("a")
+        source.put("c", "z")
+    with FileDB(str(tmp_path / "db.txt")) as source, SQLiteDB(str(tmp_path / "db.sqlite")) as destination:
+        assert migrate(source, destination) == 2
+
+    assert _connect_sqlite(tmp_path / "db.sqlite").get_many(["a", "b", "c"]) == {"b": "x y", "c": "z"}
+
+
+def test_contains_many_through_a_bloom_filter(tmp_path):
+    with FileDB(str(tmp_path / "db.txt")) as source:
+        source.put_many((f"m{i}", True) for i in range(10))
+    db = BloomFilteredDB(_connect(tmp_path / "db.txt"), capacity=4) # rebuilt bigger on connect
+    db.connect()
+    db.put_many((f"m{i}", True) for i in range(10, 30)) # and again once past capacity
+    db.delete("m0")
+
+    assert db.filter.capacity >= 30
+    assert db.contains_many(f"m{i}" for i in range(0, 60, 2)) == {f"m{i}" for i in range(2, 30, 2)}
+    assert db.get("m1") == "True" and db.get("m99") is None
+    assert db.filtered_lookups >= 14 # the deleted m0 is still in the filter, most of the other 16 absent keys aren't
@@ -0,0 +1,204 @@
+import asyncio
+import httpx
+import pytest
+from datetime import datetime, timezone
+import email_service
+from email_service import AsyncEmailService, EmailService
+from fakes import FakeGmailService, make_fake_message, make_gmail_mock_transport, make_http_error
+
+
+def _make_service(n: int, **kwargs) -> FakeGmailService:
+    messages = [make_fake_message(f"m{i}", f"Subject {i}", f"Body {i}") for i in range(n)]
+    return FakeGmailService(messages, **kwargs)
+
+
+@pytest.fixture(autouse=True)
+def no_sleep(monkeypatch):
+    monkeypatch.setattr(email_service.time, "sleep", lambda _: None)
+
+
+def test_batched_fetch_preserves_order():
+    service = _make_service(12)
+    emails = list(EmailService(creds=None, service=service).get_last_n_emails(n=12, batch_size=5))
+
+    assert [e.message_id for e in emails] == [f"m{i}" for i in range(12)]
+    assert [e.subject for e in emails] == [f"Subject {i}" for i in range(12)]
+    assert emails[3].body == "Body 3"
+    assert service.batch_calls == 3
+    assert service.get_calls == 12
+
+
+def test_unbatched_fetch():
+    service = _make_service(4)
+    emails = list(EmailService(creds=None, service=service).get_last_n_emails(n=4, batch_size=None))
+
+    assert [e.message_id for e in emails] == ["m0", "m1", "m2", "m3"]
+    assert service.batch_calls == 0
+
+
+def test_throttled_subrequests_are_retried():
+    service = _make_service(6, throttle={"m1": 2, "m4": 1})
+    emails = list(EmailService(creds=None, service=service).get_last_n_emails(n=6, batch_size=6))
+
+    assert [e.message_id for e in emails] == [f"m{i}" for i in range(6)]
+    # first batch fetches all 6, second retries m1 and m4, third retries m1
+    assert service.batch_calls == 3
+    assert service.get_calls == 6 + 2 + 1
+
+
+def test_throttling_gives_up_after_max_retries():
+    service = _make_service(2, throttle={"m0": email_service.MAX_BATCH_RETRIES})
+    with pytest.raises(Exception, match="Max retries exceeded"):
+        list(EmailService(creds=None, service=service).get_last_n_emails(n=2))
+
+
+def test_non_throttling_errors_are_raised():
+    service = _make_service(3, errors={"m2": make_http_error(404, "notFound")})
+    with pytest.raises(email_service.HttpError):
+        list(EmailService(creds=None, service=service).get_last_n_emails(n=3))
+
+
+def test_recent_emails_follow_page_tokens():
+    service = _make_service(1200)
+    emails = list(EmailService(creds=None, service=service).get_recent_emails(
+        cutoff_time=datetime.fromtimestamp(-1, timezone.utc), page_size=500,
+    ))
+
+    assert len(emails) == 1200
+    assert [e.message_id for e in emails[:3]] == ["m0", "m1", "m2"]
+    assert emails[-1].message_id == "m1199"
+    assert service.list_calls == 3
+
+
+def test_recent_emails_respects_hard_cap():
+    service = _make_service(50)
+    emails = list(EmailService(creds=None, service=service).get_recent_emails(
+        cutoff_time=datetime.fromtimestamp(-1, timezone.utc), page_size=10, max_results=25,
+    ))
+
+    assert [e.message_id for e in emails] == [f"m{i}" for i in range(25)]
+    assert service.get_calls == 25
+
+
+def test_recent_emails_stream_before_listing_finishes():
+    service = _make_service(30)
+    emails = EmailService(creds=None, service=service).get_recent_emails(
+        cutoff_time=datetime.fromtimestamp(-1, timezone.utc), page_size=10,
+    )
+
+    first = next(emails)
+    assert first.message_id == "m0"
+    # at most one page is listed ahead of the page being consumed
+    assert service.list_calls <= 2
+    emails.close()
+
+
+def test_emails_since_history_only_returns_new_mail():
+    service = _make_service(5)
+    email_service_ = EmailService(creds=None, service=service)
+    history_id = email_service_.get_current_history_id()
+
+    service.add_message(make_fake_message("new1", "New 1", "Body"))
+    service.add_message(make_fake_message("new2", "New 2", "Body"))
+    service.add_message(make_fake_message("gone", "Gone", "Body"))
+    service.delete_message("gone")
+
+    emails = list(email_service_.get_emails_since_history(history_id))
+    assert [e.message_id for e in emails] == ["new2", "new1"]
+    assert service.get_calls == 2
+    assert int(email_service_.get_current_history_id()) > int(history_id)
+
+
+def test_expired_history_id_raises_eagerly():
+    service = _make_service(1)
+    service.oldest_history_id = 10
+    with pytest.raises(email_service.HistoryExpiredError):
+        EmailService(creds=None, service=service).get_emails_since_history("3")
+
+
+def test_known_ids_are_skipped_before_fetch():
+    service = _make_service(10)
+    known = {"m1", "m2", "m7"}
+    emails = list(EmailService(creds=None, service=service).get_recent_emails(
+        cutoff_time=datetime.fromtimestamp(-1, timezone.utc), page_size=4, known_ids=known,
+    ))
+
+    assert [e.message_id for e in emails] == ["m0", "m3", "m4", "m5", "m6", "m8", "m9"]
+    assert service.get_calls == 7
+
+
+def test_known_ids_predicate():
+    service = _make_service(4)
+    emails = list(EmailService(creds=None, service=service).get_last_n_emails(
+        n=4, known_ids=lambda message_id: message_id != "m3",
+    ))
+
+    assert [e.message_id for e in emails] == ["m3"]
+    assert service.get_calls == 1
+
+
+def _make_async_service(fake: FakeGmailService, concurrency: int = 4) -> AsyncEmailService:
+    client = httpx.AsyncClient(base_url=email_service.GMAIL_API_BASE_URL, transport=make_gmail_mock_transport(fake))
+    return AsyncEmailService(creds=None, client=client, concurrency=concurrency)
+
+
+async def _collect(agen) -> list:
+    return [item async for item in agen]
+
+
+def test_async_recent_emails_pages_in_order():
+    fake = _make_service(25)
+    service = _make_async_service(fake)
+    emails = asyncio.run(_collect(service.get_recent_emails_async(
+        cutoff_time=datetime.fromtimestamp(-1, timezone.utc), page_size=10, known_ids={"m3"},
+    )))
+
+    assert [e.message_id for e in emails] == [f"m{i}" for i in range(25) if i != 3]
+    assert emails[0].subject == "Subject 0"
+    assert fake.list_calls == 3
+    assert fake.get_calls == 24
+
+
+def test_async_fetch_retries_throttled_requests(monkeypatch):
+    async def no_sleep(_):
+        return None
+    monkeypatch.setattr(email_service.asyncio, "sleep", no_sleep)
+
+    fake = _make_service(3, throttle={"m1": 2})
+    emails = asyncio.run(_collect(_make_async_service(fake).get_last_n_emails_async(n=3)))
+
+    assert [e.message_id for e in emails] == ["m0", "m1", "m2"]
+    assert fake.get_calls == 5
+
+
+def test_metadata_first_only_downloads_bodies_that_pass_filter():
+    messages = [
+        make_fake_message("m0", "Lunch tomorrow?", "Are you free?", sender="friend@example.com"),
+        make_fake_message("m1", "Weekly Promotions", "Deals", list_unsubscribe="<mailto:unsub@shop.com>", label_ids=["CATEGORY_PROMOTIONS"]),
+        make_fake_message("m2", "Security Alert", "New login", sender="no-reply@bank.com"),
+    ]
+    service = FakeGmailService(messages)
+    emails = list(EmailService(creds=None, service=service).get_last_n_emails(
+        n=3, email_filter=lambda email: email.list_unsubscribe is None,
+    ))
+
+    assert [e.message_id for e in emails] == ["m0", "m2"]
+    assert [e.body for e in emails] == ["Are you free?", "New login"]
+    assert emails[0].sender == "friend@example.com"
+    assert service.format_counts == {"metadata": 3, "full": 2}
+
+
+def test_gmail_client_is_built_once_and_reused(monkeypatch):
+    service = _make_service(3)
+    builds = []
+    monkeypatch.setattr(email_service, "build", lambda *args, **kwargs: builds.append(args) or service)
+    gmail = EmailService(creds=None)
+
+    emails = list(gmail.get_last_n_emails(n=3, email_filter=lambda email: True))
+    assert emails[0].body == "Body 0" and emails[1].body == "Body 1"
+    list(gmail.get_last_n_emails(n=3))
+    gmail.get_current_history_id()
+
+    # one client for the lister thread and one for the rest, both reused by the later calls
+    assert len(builds) == 2
+
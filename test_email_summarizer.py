@@ -1,8 +1,17 @@
-from email_summarizer import EmailSummarizer,init_email_summarizer
+from email_summarizer import EmailSummarizer,init_email_summarizer, make_batch_response_format, EmailSummaryResponseFormat, EmailSummaryResponseFormatDebug
 from llm_service import LocalLlamaService, LangchainAdapter
 from email_service import EmailService, Email
 from logger import Logger
 from langchain.chat_models import init_chat_model
+from fakes import FakeSummarizerAgent
+from db import FileDB
+from summary_cache import SummaryCache
+from pre_classifier import init_pre_classifier
+from local_classifier import LocalClassifier
+from metrics import metrics, prompt_cache_hit_rate
+import asyncio
+import json
+from pydantic import TypeAdapter
 
 from constants import TIMEOUTS_SECONDS
 llama = LangchainAdapter(llm = LocalLlamaService())
@@ -19,6 +28,265 @@ haiku = init_chat_model(
     max_tokens=1000
 )
 logger = Logger(context = "TestEmailSummarizer", debug=True)
+
+
+def _make_emails(n: int) -> list[Email]:
+    return [Email(subject=f"Subject {i}", body=f"Body {i}", message_id=f"m{i}") for i in range(n)]
+
+
+def test_summarize_streamed_emails_starts_before_download_finishes():
+    events = []
+    agent = FakeSummarizerAgent(is_important=lambda text: events.append("summarized") or True)
+    summarizer = EmailSummarizer(agent, email_service=None)
+
+    async def stream():
+        for email in _make_emails(3):
+            events.append(f"fetched {email.message_id}")
+            yield email
+            await asyncio.sleep(0.01) # simulated download time
+
+    summaries = asyncio.run(summarizer._summarize_emails_async(stream()))
+
+    assert [s.email.message_id for s in summaries] == ["m0", "m1", "m2"]
+    assert len(agent.calls) == 3
+    # the first email is summarized while the last one is still downloading
+    assert events.index("summarized") < events.index("fetched m2")
+
+
+def test_partial_batch_is_sent_when_the_stream_stalls():
+    events = []
+    batch_agent = FakeSummarizerAgent(batch_response_format=make_batch_response_format(EmailSummaryResponseFormat))
+    summarizer = EmailSummarizer(FakeSummarizerAgent(), email_service=None, batch_summarizer_agent=batch_agent, batch_size=10)
+
+    async def stream():
+        for email in _make_emails(3):
+            events.append(f"fetched {email.message_id}")
+            yield email
+            await asyncio.sleep(0.05) # slow download
+
+    async def main():
+        async for idx, summary in summarizer._summarize_emails_stream_async(stream()):
+            events.append(f"summarized {idx}")
+
+    asyncio.run(main())
+    # time to first summary doesn't wait for the batch of 10 to fill up
+    assert events.index("summarized 0") < events.index("fetched m1")
+    assert len(events) == 6
+
+
+def test_summary_cache_skips_llm_for_repeated_emails(tmp_path):
+    db = FileDB(str(tmp_path / "cache_db.txt"))
+    db.connect()
+    agent = FakeSummarizerAgent(is_important=lambda text: "reminder" in text.lower())
+    summarizer = EmailSummarizer(agent, email_service=None, summary_cache=SummaryCache(db, model_id="fake", prompt_version="v1"))
+    emails = [
+        Email(subject="Standup Reminder", body="9:30am", message_id="a"),
+        Email(subject="standup reminder", body="9:30am ", message_id="b"),
+        Email(subject="Weekly Promotions", body="Deals", message_id="c"),
+    ]
+
+    first = asyncio.run(summarizer._summarize_emails_async(emails[:1]))
+    summaries = asyncio.run(summarizer._summarize_emails_async(emails))
+
+    assert first[0].is_important
+    assert len(agent.calls) == 2
+    assert [s.is_important for s in summaries] == [True, True, False]
+    assert [s.email.message_id for s in summaries] == ["a", "b", "c"]
+    assert summaries[1].email.subject == "standup reminder"
+    assert summarizer.summary_cache.stats()["hits"] == 2
+
+
+def test_batch_mode_packs_emails_into_one_request():
+    single_agent = FakeSummarizerAgent()
+    batch_agent = FakeSummarizerAgent(
+        is_important=lambda text: "promotion" not in text.lower(),
+        batch_response_format=make_batch_response_format(EmailSummaryResponseFormat),
+    )
+    summarizer = EmailSummarizer(single_agent, email_service=None, batch_summarizer_agent=batch_agent, batch_size=4)
+    emails = _make_emails(7) + [Email(subject="Weekly Promotions", body="Deals", message_id="promo")]
+
+    summaries = asyncio.run(summarizer._summarize_emails_async(emails))
+
+    assert len(batch_agent.calls) == 2
+    assert len(single_agent.calls) == 0
+    assert [s.email.message_id for s in summaries] == [e.message_id for e in emails]
+    assert [s.is_important for s in summaries] == [True] * 7 + [False]
+    assert all(type(s) is EmailSummaryResponseFormat for s in summaries)
+
+
+def test_email_metadata_stays_out_of_the_output_schema():
+    schema = json.dumps(TypeAdapter(make_batch_response_format(EmailSummaryResponseFormatDebug)).json_schema())
+
+    assert "message_id" in schema
+    assert not any(name in schema for name in ("sender", "list_unsubscribe", "label_ids"))
+
+
+def test_batch_mode_falls_back_to_single_requests_for_missing_items():
+    single_agent = FakeSummarizerAgent()
+    batch_agent = FakeSummarizerAgent(batch_response_format=make_batch_response_format(EmailSummaryResponseFormat), drop_ids={"1"})
+    summarizer = EmailSummarizer(single_agent, email_service=None, batch_summarizer_agent=batch_agent, batch_size=3)
+
+    summaries = asyncio.run(summarizer._summarize_emails_async(_make_emails(3)))
+
+    assert [s.email.message_id for s in summaries] == ["m0", "m1", "m2"]
+    assert len(batch_agent.calls) == 1
+    assert len(single_agent.calls) == 1
+    assert "Subject 1" in single_agent.calls[0]
+
+
+def test_rate_limited_fallback_is_retried_without_resending_the_batch():
+    single_agent = FakeSummarizerAgent(rate_limited_calls=1, retry_after=0.001)
+    batch_agent = FakeSummarizerAgent(batch_response_format=make_batch_response_format(EmailSummaryResponseFormat), drop_ids={"1"})
+    summarizer = EmailSummarizer(single_agent, email_service=None, batch_summarizer_agent=batch_agent, batch_size=3)
+
+    summaries = asyncio.run(summarizer._summarize_emails_async(_make_emails(3)))
+
+    assert [s.email.message_id for s in summaries] == ["m0", "m1", "m2"]
+    assert len(batch_agent.calls) == 1
+    assert summarizer.concurrency_limiter.stats()["overloads"] == 1
+
+
+def test_batch_mode_respects_token_budget():
+    batch_agent = FakeSummarizerAgent(batch_response_format=make_batch_response_format(EmailSummaryResponseFormat))
+    summarizer = EmailSummarizer(FakeSummarizerAgent(), email_service=None, batch_summarizer_agent=batch_agent, batch_size=10, batch_token_budget=400)
+
+    summaries = asyncio.run(summarizer._summarize_emails_async(_make_emails(6)))
+
+    # each email is estimated at ~155 tokens, so only two fit per request
+    assert len(batch_agent.calls) == 3
+    assert len(summaries) == 6
+
+
+def test_pre_classifier_bypasses_llm_for_obvious_emails():
+    agent = FakeSummarizerAgent()
+    summarizer = EmailSummarizer(agent, email_service=None, pre_classifier=init_pre_classifier(), response_format=EmailSummaryResponseFormatDebug)
+    emails = [
+        Email(subject="Security Alert", body="A new login was detected.", message_id="a"),
+        Email(subject="Gaming Newsletter", body="This week in gaming news.", message_id="b"),
+        Email(subject="Lunch Tomorrow?", body="Want to grab lunch?", message_id="c"),
+    ]
+
+    summaries = asyncio.run(summarizer._summarize_emails_async(emails))
+
+    assert len(agent.calls) == 1
+    assert [s.email.message_id for s in summaries] == ["a", "b", "c"]
+    assert [s.is_important for s in summaries] == [True, False, True]
+    assert "important_keywords" in summaries[0].justification
+    assert summaries[1].email.subject == "Gaming Newsletter"
+
+
+def test_local_classifier_escalates_only_unsure_emails_and_learns_from_llm():
+    local_classifier = LocalClassifier(k=2).fit(
+        [Email("Gaming Newsletter", "New releases and reviews."), Email("Gaming Newsletter Weekly", "Reviews of new releases.")],
+        [False, False],
+    )
+    agent = FakeSummarizerAgent()
+    summarizer = EmailSummarizer(agent, email_service=None, local_classifier=local_classifier)
+    emails = [
+        Email(subject="Gaming Newsletter", body="New releases and reviews this week.", message_id="a"),
+        Email(subject="Lunch Tomorrow?", body="Want to grab lunch?", message_id="b"),
+    ]
+
+    summaries = asyncio.run(summarizer._summarize_emails_async(emails))
+
+    assert len(agent.calls) == 1 and "Lunch" in agent.calls[0]
+    assert [s.is_important for s in summaries] == [False, True]
+    assert local_classifier.stats()["decided_locally"] == 1
+    assert len(local_classifier.emails) == 3 # learned the llm's decision on the lunch email
+
+
+def test_local_classifier_predicts_queued_streamed_emails_together():
+    local_classifier = LocalClassifier(k=2).fit(
+        [Email("Gaming Newsletter", "New releases and reviews."), Email("Gaming Newsletter Weekly", "Reviews of new releases.")],
+        [False, False],
+    )
+    chunk_sizes = []
+    predict = local_classifier.predict
+    local_classifier.predict = lambda emails: chunk_sizes.append(len(emails)) or predict(emails)
+    summarizer = EmailSummarizer(FakeSummarizerAgent(), email_service=None, local_classifier=local_classifier)
+
+    async def stream():
+        for email in _make_emails(6):
+            yield email
+        await asyncio.sleep(0.01) # the next download is still running
+        for email in _make_emails(2):
+            yield email
+
+    summaries = asyncio.run(summarizer._summarize_emails_async(stream()))
+
+    assert len(summaries) == 8
+    assert chunk_sizes == [6, 2]
+
+
+def test_critic_only_reviews_unsure_not_important_verdicts():
+    agent = FakeSummarizerAgent(is_important=lambda text: "sale" not in text.lower(), confidence=lambda text: 0.5 if "flash" in text.lower() else 0.95)
+    critic = FakeSummarizerAgent(is_important=lambda text: True)
+    summarizer = EmailSummarizer(agent, email_service=None, critic_agent=critic, critic_confidence_threshold=0.8)
+    emails = [
+        Email(subject="Flash Sale", body="Ends tonight", message_id="a"),
+        Email(subject="Furniture Sale", body="Always on", message_id="b"),
+        Email(subject="Standup", body="9:30am", message_id="c"),
+    ]
+
+    summaries = asyncio.run(summarizer._summarize_emails_async(emails))
+
+    assert len(critic.calls) == 1 and "Flash Sale" in critic.calls[0]
+    assert [s.is_important for s in summaries] == [True, False, True]
+    assert summarizer.critic_stats() == {"reviews": 1, "skipped": 1, "flips": 1, "requests": 1}
+
+
+def test_critic_reviews_from_concurrent_workers_share_a_request():
+    agent = FakeSummarizerAgent(is_important=lambda text: False, confidence=0.1)
+    batch_critic = FakeSummarizerAgent(is_important=lambda text: "Important" in text, batch_response_format=make_batch_response_format(EmailSummaryResponseFormat))
+    summarizer = EmailSummarizer(
+        agent, email_service=None, critic_agent=FakeSummarizerAgent(), batch_critic_agent=batch_critic, critic_batch_size=4,
+    )
+    emails = [Email(subject=f"Important {i}" if i % 2 else f"Promo {i}", body="", message_id=f"m{i}") for i in range(4)]
+
+    summaries = asyncio.run(summarizer._summarize_emails_async(emails, concurrency=4))
+
+    assert len(batch_critic.calls) == 1
+    assert summarizer.critic_requests == 1
+    assert [s.is_important for s in summaries] == [False, True, False, True]
+    assert [s.email.message_id for s in summaries] == ["m0", "m1", "m2", "m3"]
+
+
+def test_rate_limited_critic_fallbacks_do_not_fail_the_batch():
+    agent = FakeSummarizerAgent(is_important=lambda text: False, confidence=0.1)
+    batch_critic = FakeSummarizerAgent(batch_response_format=make_batch_response_format(EmailSummaryResponseFormat), drop_ids={"1", "2"})
+    critic = FakeSummarizerAgent(rate_limited_calls=1, retry_after=0.01)
+    summarizer = EmailSummarizer(
+        agent, email_service=None, critic_agent=critic, batch_critic_agent=batch_critic, critic_batch_size=4,
+    )
+    emails = [Email(subject=f"Email {i}", body="", message_id=f"m{i}") for i in range(4)]
+
+    summaries = asyncio.run(summarizer._summarize_emails_async(emails, concurrency=4))
+
+    assert len(batch_critic.calls) == 1 # the batch isn't reviewed again
+    assert critic.rate_limited == 1
+    assert [s.is_important for s in summaries] == [True] * 4
+    assert [s.email.message_id for s in summaries] == ["m0", "m1", "m2", "m3"]
+
+
+
+def test_token_usage_and_latency_are_recorded_per_agent():
+    metrics.reset()
+    usage = {"input_tokens": 1000, "output_tokens": 50, "total_tokens": 1050, "input_token_details": {"cache_read": 900}}
+    agent = FakeSummarizerAgent(usage_metadata=usage, is_important=lambda text: "2" not in text, confidence=0.5)
+    critic = FakeSummarizerAgent(usage_metadata={"input_tokens": 400, "output_tokens": 40, "total_tokens": 440})
+    summarizer = EmailSummarizer(agent, email_service=None, critic_agent=critic)
+
+    asyncio.run(summarizer._summarize_emails_async(_make_emails(3)))
+
+    snapshot = metrics.snapshot()
+    tokens = {(item["labels"]["agent"], item["labels"]["kind"]): item["value"] for item in snapshot["counters"]["llm_tokens_total"]}
+    assert tokens[("summarizer", "input")] == 3000 and tokens[("summarizer", "output")] == 150
+    assert tokens[("critic", "input")] == 400 and tokens[("critic", "cache_read")] == 0
+    assert prompt_cache_hit_rate("summarizer") == 0.9
+    assert metrics.histogram("llm_request_seconds").count(agent="summarizer") == 3
+    assert metrics.histogram("llm_queue_wait_seconds").count() == 3
+
+
 if __name__ == "__main__":
     email_summarizer = init_email_summarizer(haiku, with_critic=True)
     summary = email_summarizer.summarize_last_n_emails(n=5)
@@ -3,7 +3,136 @@ from test_email_summarizer import haiku, claude_sonnet
 from evaluate import MODELS
 import argparse
 import asyncio 
-from email_summarizer import EmailSummaryResponseFormatDebug
+from email_summarizer import EmailSummaryResponseFormat, EmailSummaryResponseFormatDebug, EmailSummarizer, summary_to_dict
+from email_service import EmailService
+from fakes import FakeCalendarClient, FakeGmailService, FakeSummarizerAgent, make_fake_message, make_http_error
+from calendar_service import CALENDAR_ID, CalendarEvent, CalendarService, event_id_for_message
+from email_state_log import EmailState
+from db import FileDB
+from rate_limiter import AdaptiveConcurrencyLimiter
+import json
+import time
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def in_tmp_path(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path) # the service keeps its dbs and logs in the working directory
+
+
+class RecordingCalendarClient(FakeCalendarClient):
+    def __init__(self, on_insert=lambda: None, **kwargs):
+        super().__init__(**kwargs)
+        self.on_insert = on_insert
+
+    def new_batch_http_request(self, callback=None):
+        self.on_insert()
+        return super().new_batch_http_request(callback=callback)
+
+
+def _make_service(n: int, calendar_client: FakeCalendarClient, email_filter=None, **summarizer_kwargs) -> EmailToEventService:
+    now_ms = int(time.time() * 1000)
+    gmail = FakeGmailService([make_fake_message(f"m{i}", f"Subject {i}", f"Body {i}", internal_date_ms=now_ms) for i in range(n)])
+    summarizer = EmailSummarizer(email_service=EmailService(creds=None, service=gmail), **summarizer_kwargs)
+    return EmailToEventService(
+        calendar_service=CalendarService(calendar_client=calendar_client), email_summarizer=summarizer, dry_run=False, email_filter=email_filter,
+    )
+
+
+def _calendar_events(client: FakeCalendarClient) -> dict:
+    return client.events_by_calendar.get(CALENDAR_ID, {})
+
+
+def test_events_are_created_as_summaries_land():
+    agent = FakeSummarizerAgent(latency_seconds=0.02)
+    calls_at_first_event = []
+    calendar = RecordingCalendarClient(on_insert=lambda: calls_at_first_event.append(len(agent.calls)))
+    service = _make_service(
+        5, calendar, email_summarizer_agent=agent,
+        concurrency_limiter=AdaptiveConcurrencyLimiter(initial_limit=1, min_limit=1, max_limit=1),
+    )
+
+    created = asyncio.run(service.process_emails())
+
+    assert sorted(created) == sorted(event_id_for_message(f"m{i}") for i in range(5))
+    assert len(_calendar_events(calendar)) == 5
+    # the first event was created while later emails were still waiting for the llm
+    assert calls_at_first_event[0] < 5
+    assert service.email_db.get("m0")
+
+    # processed emails are filtered out before their bodies are fetched on the next run
+    assert asyncio.run(service.process_emails()) == []
+    assert len(agent.calls) == 5
+
+
+def test_rerun_after_failed_inserts_resumes_from_the_state_log():
+    calendar = FakeCalendarClient(errors={event_id_for_message("m2"): make_http_error(400, "invalid")})
+    agent = FakeSummarizerAgent()
+    service = _make_service(3, calendar, email_summarizer_agent=agent)
+
+    assert len(asyncio.run(service.process_emails())) == 2
+    assert not service.email_db.get("m2") # left for the next run to retry
+    assert service.state_log.state("m2") is EmailState.SUMMARIZED
+
+    calendar.errors = {}
+    assert asyncio.run(service.process_emails()) == [event_id_for_message("m2")]
+    assert len(_calendar_events(calendar)) == 3
+    assert all(service.email_db.get(f"m{i}") for i in range(3))
+    assert len(agent.calls) == 3 # the retry didn't need the llm
+
+
+def test_crash_mid_run_never_redoes_llm_or_calendar_work():
+
+    def crash():
+        raise RuntimeError("process killed")
+    agent = FakeSummarizerAgent(is_important=lambda text: "Subject 1" not in text)
+    service = _make_service(4, RecordingCalendarClient(on_insert=crash), email_summarizer_agent=agent)
+    with pytest.raises(RuntimeError, match="process killed"):
+        asyncio.run(service.process_emails())
+    summarized_before_crash = len(agent.calls)
+
+    # restart: a fresh service over the same dbs, and an event that was inserted right before the crash
+    calendar = FakeCalendarClient()
+    restarted = _make_service(4, calendar, email_summarizer_agent=agent)
+    restarted.calendar_service.create_event(CalendarEvent(title="Subject 0", message_id="m0"))
+    created = asyncio.run(restarted.process_emails())
+
+    assert len(agent.calls) == 4
+    assert summarized_before_crash >= 1
+    assert sorted(created) == sorted(event_id_for_message(f"m{i}") for i in (0, 2, 3))
+    assert len(_calendar_events(calendar)) == 3
+    # finished emails leave the state log, they are recorded as processed instead
+    assert restarted.state_db.keys() == []
+    assert restarted.email_db.get_many([f"m{i}" for i in range(4)]).keys() == {f"m{i}" for i in range(4)}
+
+
+def test_processed_emails_are_migrated_from_the_legacy_log(tmp_path):
+    (tmp_path / "processed_emails_db.txt").write_text("PUT m0 True\nPUT m1 True\n")
+    agent = FakeSummarizerAgent()
+    service = _make_service(3, FakeCalendarClient(), email_summarizer_agent=agent)
+
+    assert asyncio.run(service.process_emails()) == [event_id_for_message("m2")]
+    assert len(agent.calls) == 1
+    assert service.email_db.get_many(["m0", "m1", "m2"]).keys() == {"m0", "m1", "m2"}
+
+
+def test_state_log_is_migrated_from_the_legacy_log():
+    # m0 finished (unimportant, so only the old log knew), m1 was summarized when the old version stopped
+    summary = summary_to_dict(FakeSummarizerAgent()._summarize("Subject 1", EmailSummaryResponseFormat))
+    legacy = FileDB("email_state_db.txt")
+    legacy.connect()
+    legacy.put("m0", json.dumps({"state": "done"}))
+    legacy.put("m1", json.dumps({"state": "summarized", "summary": summary}))
+    legacy.disconnect()
+    agent = FakeSummarizerAgent()
+    service = _make_service(3, FakeCalendarClient(), email_summarizer_agent=agent)
+
+    created = asyncio.run(service.process_emails())
+
+    assert len(created) == 2 # m1 resumed from its logged summary, m2 fetched and summarized
+    assert len(agent.calls) == 1 # only m2 needed the llm
+    assert service.state_db.keys() == []
+
 
 if __name__ == "__main__":
     argparser = argparse.ArgumentParser(description="Test Email to Event Service")
@@ -28,9 +157,30 @@ if __name__ == "__main__":
         help="Number of hours to look back for emails to process.",
     )
 
+    argparser.add_argument(
+        "--incremental",
+        action='store_true',
+        help="If set, only fetch emails added since the last synced gmail history id.",
+        default=False
+    )
+
     args = argparser.parse_args()
     model = MODELS[args.model]
     print("Using model:", args.model)
-    email_to_event_service = init_email_to_event_service(model=model, with_critic=False, dry_run = not args.real_run, response_format= EmailSummaryResponseFormatDebug)
+    email_to_event_service = init_email_to_event_service(model=model, with_critic=False, dry_run = not args.real_run, response_format= EmailSummaryResponseFormatDebug, incremental_sync=args.incremental)
     created_event_ids = asyncio.run(email_to_event_service.process_emails(lookback_hours=args.hours_lookback))
     print("Created event IDs:", created_event_ids)
+
+
+def test_emails_rejected_by_the_email_filter_are_recorded_without_their_bodies():
+    agent = FakeSummarizerAgent()
+    calendar = FakeCalendarClient()
+    service = _make_service(4, calendar, email_filter=lambda email: email.subject in ("Subject 0", "Subject 2"), email_summarizer_agent=agent)
+
+    created = asyncio.run(service.process_emails())
+
+    assert sorted(created) == sorted(event_id_for_message(message_id) for message_id in ("m0", "m2"))
+    assert len(agent.calls) == 2
+    assert service.email_summarizer.email_service.service.format_counts == {"metadata": 4, "full": 2}
+    assert service.email_db.contains_many(["m1", "m3"]) == {"m1", "m3"}
+    assert asyncio.run(service.process_emails()) == [] # rejected emails aren't fetched again
@@ -0,0 +1,92 @@
+from evaluate import EvalConfig, compare_configs, compare_pre_classifier
+from email_summarizer import EmailSummarizer
+from pre_classifier import init_pre_classifier
+from email_service import Email
+from fakes import FakeSummarizerAgent
+from db import FileDB
+from rate_limiter import AdaptiveConcurrencyLimiter
+import asyncio
+
+
+def _emails_by_subject(n: int) -> dict[str, tuple[Email, bool]]:
+    return {f"Subject {i}": (Email(subject=f"Subject {i}", body=f"Body {i}", message_id=f"m{i}"), i % 2 == 0) for i in range(n)}
+
+
+def test_compared_configs_share_provider_limits_and_reuse_cached_verdicts(tmp_path):
+    usage = {"input_tokens": 100, "output_tokens": 10, "total_tokens": 110}
+    in_flight = {"now": 0, "max": 0}
+    agents = {}
+
+    class SharedCountingAgent(FakeSummarizerAgent):
+        async def ainvoke(self, input, config=None):
+            in_flight["now"] += 1
+            in_flight["max"] = max(in_flight["max"], in_flight["now"])
+            try:
+                return await super().ainvoke(input, config)
+            finally:
+                in_flight["now"] -= 1
+
+    def init_agents(config, model):
+        # haiku gets every other email right, claude all of them
+        is_important = (lambda text: True) if config.model == "haiku" else (lambda text: int(text.split("Subject ")[1].split()[0]) % 2 == 0)
+        agents[config] = SharedCountingAgent(is_important=is_important, latency_seconds=0.01, usage_metadata=usage)
+        return agents[config], None
+
+    configs = [EvalConfig(model="haiku", with_critic=False), EvalConfig(model="claude", with_critic=False)]
+    models = {"haiku": object(), "claude": object()}
+    db = FileDB(str(tmp_path / "eval_cache_db.txt"))
+    db.connect()
+
+    limiter = AdaptiveConcurrencyLimiter(initial_limit=2, min_limit=2, max_limit=2)
+
+    def run(configs):
+        return asyncio.run(compare_configs(configs, _emails_by_subject(6), models=models, cache_db=db, init_agents=init_agents, limiters={"anthropic": limiter}))
+
+    haiku, claude = run(configs)
+    assert (haiku.tp, haiku.fp, haiku.tn, haiku.fn) == (3, 3, 0, 0)
+    assert (claude.tp, claude.fp, claude.tn, claude.fn) == (3, 0, 3, 0)
+    assert claude.tokens["input"] == 600 and claude.tokens["output"] == 60
+    assert claude.cost() > 0 and len(claude.latencies) == 6
+    # both models are anthropic's, so they share its limit of 2 requests in flight
+    assert in_flight["max"] == 2
+    assert limiter.stats()["successes"] == 12
+
+    # unchanged configs are answered from the cache, with the latency and tokens they were measured with
+    haiku, claude = run(configs)
+    assert len(agents[configs[0]].calls) == 0 and len(agents[configs[1]].calls) == 0
+    assert (claude.cached, claude.tokens["input"], claude.tp, claude.tn) == (6, 600, 3, 3)
+
+    # a different truncation length is a different prompt version
+    [truncated] = run([EvalConfig(model="claude", with_critic=False, max_chars_per_email=500)])
+    assert truncated.cached == 0
+
+
+class SubjectEchoingAgent(FakeSummarizerAgent):
+    """ echoes the email's subject like the llm does, compute_confusion matches summaries to labels by it """
+
+    def _summarize(self, text, summary_format, **extra):
+        summary = super()._summarize(text, summary_format, **extra)
+        summary.email.subject = text.split("Subject: ", 1)[1].split(" Body: ", 1)[0]
+        return summary
+
+
+def test_pre_classifier_is_compared_end_to_end():
+    emails = [
+        Email(subject="Security Alert", body="New login from an unknown device", message_id="m0"),
+        Email(subject="Weekly Newsletter", body="Our favourite recipes", message_id="m1"),
+        Email(subject="Lunch?", body="Free tomorrow?", message_id="m2"),
+    ]
+    # the newsletter is actually important to this user, the llm knows and the rules don't
+    emails_by_subject = {email.subject: (email, True) for email in emails}
+    agent = SubjectEchoingAgent()
+    summarizer = EmailSummarizer(agent, email_service=None, pre_classifier=init_pre_classifier())
+    summaries = asyncio.run(summarizer._summarize_emails_async(emails))
+    assert len(agent.calls) == 1
+
+    results = compare_pre_classifier(summarizer, emails, summaries, emails_by_subject)
+
+    assert results["with pre-classifier"][1] == 2 / 3
+    assert results["without pre-classifier"][1] == 1.0
+    assert len(agent.calls) == 3 # only the two rule-decided emails were sent again
+    assert summarizer.pre_classifier is not None
+
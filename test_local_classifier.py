@@ -0,0 +1,71 @@
+from email_service import Email
+import pytest
+from local_classifier import LocalClassifier, init_local_classifier, load_dataset
+
+TRAIN = [
+    (Email("Weekly Gaming Newsletter", "This week in gaming: new releases and reviews."), False),
+    (Email("Gaming Newsletter Issue 12", "New releases and reviews from the gaming world."), False),
+    (Email("Your Gaming Newsletter", "Reviews of the new releases this week."), False),
+    (Email("Security Alert: new sign-in", "A new sign-in to your account was detected from a new device."), True),
+    (Email("Security Alert", "We detected a new sign-in to your account from an unknown device."), True),
+    (Email("New sign-in detected", "Your account had a new sign-in from a new device."), True),
+]
+
+
+def _fit(**kwargs) -> LocalClassifier:
+    emails, labels = zip(*TRAIN)
+    return LocalClassifier(k=3, **kwargs).fit(list(emails), labels)
+
+
+def test_confident_on_near_duplicates_and_unsure_on_unrelated_mail():
+    classifier = _fit()
+    newsletter, alert, unrelated = classifier.predict([
+        Email("Gaming Newsletter", "New releases and reviews this week in gaming."),
+        Email("Security Alert", "New sign-in to your account from a new device."),
+        Email("Dinner plans", "Are we still on for pasta at Luigi's?"),
+    ])
+
+    assert not newsletter.is_important and classifier.is_confident(newsletter)
+    assert alert.is_important and classifier.is_confident(alert)
+    assert unrelated.confidence == 0.5 and not classifier.is_confident(unrelated)
+
+
+def test_learns_new_decisions_once():
+    classifier = _fit()
+    lunch = Email("Lunch with the team on Friday", "Team lunch at noon on Friday, please RSVP.")
+    similar = Email("Team lunch on Friday", "Lunch with the team at noon on Friday.")
+    before = classifier.predict([similar])[0]
+
+    assert classifier.learn([lunch, lunch], [True, True]) == 1
+    assert classifier.learn([lunch], [True]) == 0
+    assert len(classifier.emails) == len(TRAIN) + 1
+    after = classifier.predict([similar])[0]
+    assert not classifier.is_confident(before)
+    assert after.is_important and after.confidence > before.confidence
+
+
+def test_oldest_examples_are_dropped_past_max_examples():
+    classifier = _fit(max_examples=4)
+    assert [email.subject for email in classifier.emails] == [email.subject for email, _ in TRAIN[2:]]
+
+
+def test_persisted_model_gives_the_same_predictions(tmp_path):
+    path = str(tmp_path / "model.npz")
+    classifier = init_local_classifier(path=path)
+    emails, _ = load_dataset()
+
+    loaded = init_local_classifier(path=path)
+    assert len(loaded.emails) == len(emails)
+    assert loaded.predict(emails) == classifier.predict(emails)
+
+
+def test_load_takes_settings_that_load_also_sets(tmp_path):
+    path = str(tmp_path / "model.npz")
+    classifier = _fit()
+    classifier.save(path)
+
+    loaded = LocalClassifier.load(path, k=3, dim=classifier.vectorizer.dim, confidence_threshold=0.9)
+    assert (loaded.path, loaded.confidence_threshold) == (path, 0.9)
+    with pytest.raises(ValueError):
+        LocalClassifier.load(path, dim=classifier.vectorizer.dim * 2)
+
@@ -0,0 +1,171 @@
+import asyncio
+import logging
+import threading
+import time
+import pytest
+from logger import Logger, LogWriter, get_log_writer, logged_class, set_log_directory, tracer
+
+
+class CountingRepr:
+    def __init__(self, block: threading.Event | None = None):
+        self.calls = 0
+        self.block = block
+
+    def __str__(self):
+        self.calls += 1
+        if self.block:
+            self.block.wait()
+        return "rendered"
+
+
+def test_records_are_written_lazily_by_the_writer_thread(tmp_path):
+    path = str(tmp_path / "logs" / "debug.log")
+    logger = Logger(log_file=path, context="Test", level=logging.INFO)
+    disabled, enabled = CountingRepr(), CountingRepr()
+    logger.debug("history %s", disabled)
+    logger.log("value %s", enabled)
+    logger.log("no args, so 100% is kept as is")
+    get_log_writer(path).flush()
+
+    assert disabled.calls == 0
+    assert enabled.calls == 1
+    assert open(path).read().splitlines() == ["[Test] value rendered", "[Test] no args, so 100% is kept as is"]
+
+
+def test_mutable_args_are_logged_as_they_were_at_the_call(tmp_path):
+    path = str(tmp_path / "debug.log")
+    logger = Logger(log_file=path, level=logging.INFO)
+    writer = get_log_writer(path)
+    block = threading.Event()
+    writer.submit(None, "%s", (CountingRepr(block),)) # holds the writer thread until the history has moved on
+    history = ["first"]
+    logger.log("history %s, attempt %d", history, 1)
+    history.append("second")
+    block.set()
+    writer.flush()
+
+    assert open(path).read().splitlines() == ["rendered", "history ['first'], attempt 1"]
+
+
+def test_relative_log_files_follow_the_log_directory(tmp_path):
+    set_log_directory(str(tmp_path))
+    try:
+        Logger(log_file="logs/bench.log", context="Bench").log("kept out of the repo")
+        get_log_writer("logs/bench.log").flush()
+    finally:
+        set_log_directory(None)
+
+    assert (tmp_path / "logs" / "bench.log").read_text() == "[Bench] kept out of the repo\n"
+
+
+def test_full_queue_drops_instead_of_blocking(tmp_path):
+    path = str(tmp_path / "debug.log")
+    writer = LogWriter(path, max_queue_size=2)
+    block = threading.Event()
+    writer.submit(None, "%s", (CountingRepr(block),)) # the writer thread waits on this one
+    for i in range(10):
+        writer.submit(None, "record %d", (i,))
+    block.set()
+    writer.flush()
+
+    assert writer.dropped >= 7
+    lines = open(path).read().splitlines()
+    assert lines[0] == "rendered"
+    assert lines[-1] == f"[LogWriter] dropped {writer.dropped} records, the queue was full"
+
+
+def test_rotation_by_size(tmp_path):
+    path = str(tmp_path / "debug.log")
+    writer = LogWriter(path, max_bytes=100, backup_count=2)
+    for i in range(5):
+        writer.submit(None, "%s", ("x" * 60,))
+        writer.flush()
+
+    assert writer.rotations >= 2
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["debug.log", "debug.log.1", "debug.log.2"]
+
+
+class Pipeline:
+    def run(self, body: str) -> int:
+        return asyncio.run(self.step(body))
+
+    async def step(self, body: str) -> int:
+        return self.count(body)
+
+    def count(self, body: str) -> int:
+        if body == "bad":
+            raise ValueError("bad body")
+        return len(body)
+
+    def skipped(self) -> None:
+        pass
+
+Pipeline = logged_class(Pipeline, mode="trace")
+
+
+class Stream:
+    def bodies(self, n: int):
+        for i in range(n):
+            time.sleep(0.01)
+            yield self.count(str(i))
+
+    async def abodies(self, n: int):
+        for i in range(n):
+            await asyncio.sleep(0.01)
+            yield self.count(str(i))
+
+    def count(self, body: str) -> int:
+        return len(body)
+
+Stream = logged_class(Stream, mode="trace")
+
+
+@pytest.fixture
+def clean_tracer():
+    tracer.clear()
+    yield tracer
+    tracer.configure()
+    tracer.clear()
+
+
+def test_trace_mode_records_nested_spans(clean_tracer):
+    clean_tracer.configure(exclude=["Pipeline.skipped"])
+    Pipeline().run("x" * 10_000)
+    Pipeline().skipped()
+
+    run, step, count = sorted(clean_tracer.spans, key=lambda span: span.start)
+    assert [span.name for span in (run, step, count)] == ["Pipeline.run", "Pipeline.step", "Pipeline.count"]
+    assert (run.parent_id, step.parent_id, count.parent_id) == (None, run.span_id, step.span_id)
+    assert run.duration >= step.duration >= count.duration
+    assert all(span.error is None for span in clean_tracer.spans) # no payloads for calls that succeed
+    assert clean_tracer.summary()["Pipeline.run"]["calls"] == 1
+
+
+def test_generator_spans_last_until_exhausted(clean_tracer):
+    stream = Stream()
+    for _ in stream.bodies(2):
+        stream.count("consumer") # runs between items, so it isn't part of the generator's span
+
+    async def consume():
+        return [body async for body in stream.abodies(2)]
+    asyncio.run(consume())
+
+    spans = {span.span_id: span for span in clean_tracer.spans}
+    for name in ("Stream.bodies", "Stream.abodies"):
+        [gen_span] = [span for span in spans.values() if span.name == name]
+        children = [span for span in spans.values() if span.parent_id == gen_span.span_id]
+        assert [span.name for span in children] == ["Stream.count"] * 2
+        assert gen_span.duration >= 0.02
+    # the consumer's own calls
+    assert sum(span.name == "Stream.count" and span.parent_id is None for span in spans.values()) == 2
+
+
+def test_unsampled_calls_are_only_recorded_when_they_raise(clean_tracer):
+    clean_tracer.configure(sample_rate=0.0, include=["Pipeline.count"])
+    Pipeline().run("fine")
+    with pytest.raises(ValueError):
+        Pipeline().run("bad")
+
+    [span] = clean_tracer.spans
+    assert span.name == "Pipeline.count"
+    assert span.error == "args=('bad',) kwargs={} raised ValueError('bad body')"
@@ -0,0 +1,47 @@
+import json
+import pytest
+from metrics import MetricsRegistry, prompt_cache_hit_rate
+
+
+def test_counters_and_histograms_export(tmp_path):
+    registry = MetricsRegistry()
+    requests = registry.counter("llm_requests_total", "LLM requests")
+    requests.inc(agent="summarizer")
+    requests.inc(2, agent="critic")
+    latency = registry.histogram("gmail_request_seconds", "Gmail latency", buckets=(0.1, 1.0))
+    for value in (0.05, 0.5, 0.5, 2.0):
+        latency.observe(value, call="list")
+    with latency.time(call="get"):
+        pass
+
+    assert registry.counter("llm_requests_total") is requests
+    assert requests.value(agent="critic") == 2 and requests.total() == 3
+    assert latency.count(call="list") == 4
+    assert latency.quantile(0.5, call="list") == pytest.approx(0.55) # 2nd of 4 values, half way through (0.1, 1]
+    assert latency.quantile(0.99, call="list") <= 2.0
+
+    text = registry.to_prometheus()
+    assert '# TYPE gmail_request_seconds histogram' in text
+    assert 'gmail_request_seconds_bucket{call="list",le="1"} 3' in text
+    assert 'gmail_request_seconds_bucket{call="list",le="+Inf"} 4' in text
+    assert 'llm_requests_total{agent="critic"} 2' in text
+
+    path = tmp_path / "metrics.json"
+    registry.write(str(path))
+    snapshot = json.loads(path.read_text())
+    assert snapshot["counters"]["llm_requests_total"][0] == {"labels": {"agent": "critic"}, "value": 2}
+    assert snapshot["histograms"]["gmail_request_seconds"][1]["count"] == 4
+    with pytest.raises(ValueError):
+        registry.histogram("llm_requests_total")
+
+
+def test_prompt_cache_hit_rate():
+    registry = MetricsRegistry()
+    tokens = registry.counter("llm_tokens_total")
+    registry.counter("llm_requests_total").inc(agent="summarizer")
+    tokens.inc(1000, agent="summarizer", kind="input")
+    tokens.inc(800, agent="summarizer", kind="cache_read")
+
+    assert prompt_cache_hit_rate("summarizer", registry) == 0.8
+    assert prompt_cache_hit_rate("critic", registry) == 0.0
+    assert registry.snapshot()["prompt_cache_hit_rate"] == {"summarizer": 0.8}
@@ -0,0 +1,50 @@
+import asyncio
+import pytest
+from micro_batcher import MicroBatcher
+
+
+def test_concurrent_submits_share_a_batch():
+    batches = []
+
+    async def double(items):
+        batches.append(items)
+        return [item * 2 for item in items]
+
+    async def main():
+        batcher = MicroBatcher(double, max_batch_size=3, max_wait_seconds=0.01)
+        return await asyncio.gather(*(batcher.submit(i) for i in range(5))), batcher
+
+    results, batcher = asyncio.run(main())
+    assert results == [0, 2, 4, 6, 8]
+    # full batches flush right away, the remainder after max_wait_seconds
+    assert batches == [[0, 1, 2], [3, 4]]
+    assert batcher.stats()["batches"] == 2
+
+
+def test_batch_failure_reaches_every_caller():
+    async def fail(items):
+        raise ValueError("boom")
+
+    async def main():
+        batcher = MicroBatcher(fail, max_batch_size=2)
+        return await asyncio.gather(batcher.submit(1), batcher.submit(2), return_exceptions=True)
+
+    results = asyncio.run(main())
+    assert [type(r) for r in results] == [ValueError, ValueError]
+
+
+def test_cancelled_callers_are_left_out_of_the_batch():
+    batches = []
+
+    async def echo(items):
+        batches.append(items)
+        return items
+
+    async def main():
+        batcher = MicroBatcher(echo, max_batch_size=10, max_wait_seconds=0.05)
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(batcher.submit("slow"), timeout=0.01)
+        return await batcher.submit("kept")
+
+    assert asyncio.run(main()) == "kept"
+    assert batches == [["kept"]]
@@ -0,0 +1,39 @@
+import asyncio
+import pytest
+from pipeline import iterate_in_thread
+
+
+async def _collect(agen) -> list:
+    return [item async for item in agen]
+
+
+def test_items_arrive_in_order():
+    assert asyncio.run(_collect(iterate_in_thread(lambda: iter(range(250)), maxsize=10))) == list(range(250))
+
+
+def test_errors_are_raised_in_the_consumer():
+    def failing():
+        yield 1
+        raise ValueError("gmail down")
+
+    with pytest.raises(ValueError, match="gmail down"):
+        asyncio.run(_collect(iterate_in_thread(failing)))
+
+
+def test_thread_stays_bounded_ahead_of_a_consumer_that_stops():
+    produced = []
+
+    def numbers():
+        for i in range(1000):
+            produced.append(i)
+            yield i
+
+    async def main():
+        agen = iterate_in_thread(numbers, maxsize=5)
+        first = await agen.__anext__()
+        await asyncio.sleep(0.05)
+        await agen.aclose()
+        return first
+
+    assert asyncio.run(main()) == 0
+    assert len(produced) <= 8
@@ -0,0 +1,55 @@
+from email_service import Email
+from pre_classifier import Verdict, init_pre_classifier
+
+
+def _email(subject: str, body: str = "", **kwargs) -> Email:
+    return Email(subject=subject, body=body, **kwargs)
+
+
+def test_important_keywords():
+    classifier = init_pre_classifier()
+    assert classifier.classify(_email("Security Alert", "A new login was detected")) == (Verdict.IMPORTANT, "important_keywords")
+    assert classifier.classify(_email("Lunch?", "Want to grab lunch?")) == (Verdict.ASK_LLM, None)
+    # generic words, or important phrases only in the body, are left to the llm
+    assert classifier.classify(_email("Your rewards are waiting", "Reset your password to keep earning points")) == (Verdict.ASK_LLM, None)
+    assert classifier.classify(_email("Beat the deadline stress", "Our planner keeps you on track")) == (Verdict.ASK_LLM, None)
+
+
+def test_bulk_headers_unless_time_anchored():
+    classifier = init_pre_classifier()
+    promo = _email("Big savings", "Save on everything", list_unsubscribe="<mailto:unsub@shop.com>")
+    social = _email("You have new followers", "See who followed you", label_ids=["INBOX", "CATEGORY_SOCIAL"])
+    flash_sale = _email("Flash Sale", "Flash sale ends tonight!", label_ids=["CATEGORY_PROMOTIONS"])
+
+    assert classifier.classify(promo) == (Verdict.UNIMPORTANT, "bulk_headers")
+    assert classifier.classify(social) == (Verdict.UNIMPORTANT, "bulk_headers")
+    assert classifier.classify(flash_sale) == (Verdict.ASK_LLM, None)
+    # "ends", "until" and "only" without a time are everyday promo copy
+    everyday_promo = _email("Only for members", "Offer ends soon, valid until stocks last", label_ids=["CATEGORY_PROMOTIONS"])
+    assert classifier.classify(everyday_promo) == (Verdict.UNIMPORTANT, "bulk_headers")
+
+
+def test_bulk_subject_keywords():
+    classifier = init_pre_classifier()
+    assert classifier.classify(_email("Gaming Newsletter", "This week in gaming news."))[0] is Verdict.UNIMPORTANT
+    assert classifier.classify(_email("Daily News Digest", "Top headlines for today."))[0] is Verdict.ASK_LLM
+
+
+def test_sender_allow_and_deny_lists():
+    classifier = init_pre_classifier(allow_senders=["boss@work.com"], deny_senders=["@spam.com"])
+    newsletter_from_boss = _email("Team newsletter", "", sender="Boss <boss@work.com>", list_unsubscribe="x")
+
+    assert classifier.classify(newsletter_from_boss) == (Verdict.IMPORTANT, "allowed_sender")
+    assert classifier.classify(_email("Hi", "", sender="deals@spam.com")) == (Verdict.UNIMPORTANT, "denied_sender")
+    assert classifier.classify(_email("Hi", "", sender="friend@example.com")) == (Verdict.ASK_LLM, None)
+
+
+def test_stats():
+    classifier = init_pre_classifier()
+    for email in [_email("Security Alert"), _email("Coupon Inside"), _email("Hello")]:
+        classifier.classify(email)
+
+    stats = classifier.stats()
+    assert stats["emails"] == 3
+    assert stats["bypassed_llm"] == 2
+    assert stats["rule_hits"] == {"important_keywords": 1, "bulk_subject_keywords": 1}
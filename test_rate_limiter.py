@@ -0,0 +1,229 @@
+import asyncio
+import pytest
+from email_service import Email
+from email_summarizer import EmailSummarizer
+from fakes import FakeSummarizerAgent, make_latency_sampler
+from metrics import metrics
+from rate_limiter import AdaptiveConcurrencyLimiter, TokenBucketRateLimiter, concurrency_limit
+
+
+class FakeClock:
+    def __init__(self, now: float = 0.0):
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def test_additive_increase_multiplicative_decrease():
+    clock = FakeClock()
+    limiter = AdaptiveConcurrencyLimiter(initial_limit=4, max_limit=6, clock=clock)
+
+    # +1/limit per success, so a little over one window's worth of successes
+    for _ in range(5):
+        limiter.on_success()
+    assert limiter.current_limit == 5
+
+    limiter.on_overload()
+    assert limiter.current_limit == 2
+    # overloads within the cooldown are one congestion event
+    limiter.on_overload()
+    assert limiter.current_limit == 2
+
+    clock.now = 10
+    limiter.on_overload()
+    assert limiter.current_limit == 1
+    limiter.on_overload()
+    clock.now = 20
+    limiter.on_overload()
+    assert limiter.current_limit == 1
+
+    for _ in range(100):
+        limiter.on_success()
+    assert limiter.current_limit == 6
+
+
+def test_current_limit_is_exported_as_a_gauge():
+    clock = FakeClock()
+    limiter = AdaptiveConcurrencyLimiter(initial_limit=4, clock=clock, name="anthropic")
+    assert concurrency_limit.value(limiter="anthropic") == 4
+
+    for _ in range(5):
+        limiter.on_success()
+    assert concurrency_limit.value(limiter="anthropic") == 5
+    limiter.on_overload()
+    assert concurrency_limit.value(limiter="anthropic") == 2
+    assert 'llm_concurrency_limit{limiter="anthropic"} 2' in metrics.to_prometheus()
+
+
+def test_limits_in_flight_calls():
+    limiter = AdaptiveConcurrencyLimiter(initial_limit=3)
+    in_flight = 0
+    max_in_flight = 0
+
+    async def call():
+        nonlocal in_flight, max_in_flight
+        async with limiter:
+            in_flight += 1
+            max_in_flight = max(max_in_flight, in_flight)
+            await asyncio.sleep(0.01)
+            in_flight -= 1
+
+    async def run():
+        await asyncio.gather(*(call() for _ in range(10)))
+
+    asyncio.run(run())
+    assert max_in_flight == 3
+    assert limiter.in_flight == 0
+
+
+def test_limiter_can_be_reused_across_event_loops():
+    limiter = AdaptiveConcurrencyLimiter(initial_limit=1, min_limit=1, max_limit=1)
+
+    async def call():
+        async with limiter:
+            await asyncio.sleep(0.01)
+
+    async def run():
+        await asyncio.gather(*(call() for _ in range(3)))
+
+    # contention makes waiters wait on the condition, which used to stay bound to the first loop
+    asyncio.run(run())
+    asyncio.run(run())
+    assert limiter.in_flight == 0
+
+
+def test_summarizer_can_run_twice():
+    summarizer = EmailSummarizer(FakeSummarizerAgent(latency_seconds=0.01), email_service=None)
+    emails = [Email(subject=f"Subject {i}", body="Body", message_id=f"m{i}") for i in range(8)]
+
+    for _ in range(2):
+        summaries = summarizer._summarize_emails(emails)
+        assert [s.email.message_id for s in summaries] == [e.message_id for e in emails]
+
+
+def test_retry_after_pauses_new_acquisitions():
+    limiter = AdaptiveConcurrencyLimiter(initial_limit=2)
+
+    async def run():
+        loop = asyncio.get_running_loop()
+        limiter.on_overload(retry_after=0.05)
+        start = loop.time()
+        async with limiter:
+            return loop.time() - start
+
+    assert asyncio.run(run()) >= 0.04
+
+
+def test_summarizer_workers_share_rate_limit_signal():
+    agent = FakeSummarizerAgent(latency_seconds=0.01, rate_limited_calls=1, retry_after=0.01)
+    limiter = AdaptiveConcurrencyLimiter(initial_limit=4)
+    summarizer = EmailSummarizer(agent, email_service=None, concurrency_limiter=limiter)
+    emails = [Email(subject=f"Subject {i}", body="Body", message_id=f"m{i}") for i in range(8)]
+
+    summaries = asyncio.run(summarizer._summarize_emails_async(emails))
+
+    assert [s.email.message_id for s in summaries] == [e.message_id for e in emails]
+    assert limiter.stats()["overloads"] == 1
+    assert limiter.stats()["successes"] == 8
+    assert agent.max_in_flight <= 4
+
+
+def test_injected_rate_limits_are_retried_and_repeatable():
+    def run():
+        agent = FakeSummarizerAgent(
+            latency_seconds=make_latency_sampler("lognormal", 0.002, seed=1),
+            rate_limit_probability=0.2, retry_after=0.001, seed=1,
+        )
+        summarizer = EmailSummarizer(agent, email_service=None, concurrency_limiter=AdaptiveConcurrencyLimiter(initial_limit=4))
+        emails = [Email(subject=f"Subject {i}", body="Body", message_id=f"m{i}") for i in range(20)]
+        summaries = asyncio.run(summarizer._summarize_emails_async(emails))
+        assert [s.email.message_id for s in summaries] == [e.message_id for e in emails]
+        return agent.rate_limited
+
+    rate_limited = run()
+    assert rate_limited > 0
+    assert run() == rate_limited # same seed, same injected failures
+
+
+class FakeSleep:
+    """ advances the fake clock instead of sleeping """
+
+    def __init__(self, clock: FakeClock):
+        self.clock = clock
+        self.sleeps = []
+
+    async def __call__(self, seconds: float) -> None:
+        self.sleeps.append(seconds)
+        self.clock.now += seconds
+
+
+def test_token_bucket_paces_requests_per_minute():
+    clock = FakeClock()
+    sleep = FakeSleep(clock)
+    limiter = TokenBucketRateLimiter(requests_per_minute=60, tokens_per_minute=1_000_000, clock=clock, sleep=sleep)
+
+    async def run():
+        for _ in range(62):
+            await limiter.acquire(10)
+
+    asyncio.run(run())
+    # the first 60 use up the burst capacity, then one request per second
+    assert clock.now == pytest.approx(2.0)
+    assert limiter.stats()["requests"] == 62
+
+
+def test_token_bucket_paces_tokens_per_minute():
+    clock = FakeClock()
+    sleep = FakeSleep(clock)
+    limiter = TokenBucketRateLimiter(requests_per_minute=1000, tokens_per_minute=6000, clock=clock, sleep=sleep)
+
+    async def run():
+        await limiter.acquire(6000)
+        await limiter.acquire(3000)
+        # larger than the bucket, capped so it can still go through
+        await limiter.acquire(10_000)
+
+    asyncio.run(run())
+    assert clock.now == pytest.approx(30.0 + 60.0)
+
+
+def test_waiting_for_the_rate_limiter_does_not_time_out():
+    limiter = TokenBucketRateLimiter(requests_per_minute=600, tokens_per_minute=1_000_000)
+    limiter.requests.take(600) # drained, the next requests go out every 0.1s
+    agent = FakeSummarizerAgent()
+    summarizer = EmailSummarizer(
+        agent, email_service=None, rate_limiter=limiter, request_timeout_seconds=0.2,
+        concurrency_limiter=AdaptiveConcurrencyLimiter(initial_limit=8, min_limit=8, max_limit=8),
+    )
+    emails = [Email(subject=f"Subject {i}", body="Body", message_id=f"m{i}") for i in range(8)]
+
+    summaries = asyncio.run(summarizer._summarize_emails_async(emails))
+
+    assert not any(s.email.subject.startswith("Timeout") for s in summaries)
+    assert len(agent.calls) == 8
+    assert summarizer.concurrency_limiter.stats()["overloads"] == 0
+
+
+def test_slow_requests_still_time_out():
+    summarizer = EmailSummarizer(FakeSummarizerAgent(latency_seconds=0.2), email_service=None, request_timeout_seconds=0.01)
+
+    [summary] = asyncio.run(summarizer._summarize_emails_async([Email(subject="Subject", body="Body", message_id="m0")]))
+
+    assert summary.email.subject == "Timeout for email : Subject"
+    assert summary.is_important
+
+
+def test_rate_limiter_is_shared_across_summarizers():
+    clock = FakeClock()
+    limiter = TokenBucketRateLimiter(requests_per_minute=2, tokens_per_minute=1_000_000, clock=clock, sleep=FakeSleep(clock))
+    summarizers = [EmailSummarizer(FakeSummarizerAgent(), email_service=None, rate_limiter=limiter) for _ in range(2)]
+    emails = [Email(subject=f"Subject {i}", body="Body", message_id=f"m{i}") for i in range(2)]
+
+    async def run():
+        await asyncio.gather(*(summarizer._summarize_emails_async(emails) for summarizer in summarizers))
+
+    asyncio.run(run())
+    assert limiter.stats()["requests"] == 4
+    # 2 requests of burst, then 30s per request
+    assert clock.now == pytest.approx(60.0)
@@ -0,0 +1,72 @@
+from datetime import datetime, timezone
+from db import FileDB
+from summary_cache import SummaryCache
+
+
+class FakeClock:
+    def __init__(self, now: float = 0.0):
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def _make_db(tmp_path) -> FileDB:
+    db = FileDB(str(tmp_path / "cache_db.txt"))
+    db.connect()
+    return db
+
+
+def test_hits_ignore_whitespace_and_case(tmp_path):
+    cache = SummaryCache(_make_db(tmp_path), model_id="haiku", prompt_version="v1")
+    cache.put("Subject: Sale  Body: 10% OFF", {"is_important": False})
+
+    assert cache.get("subject: sale body: 10% off") == {"is_important": False}
+    assert cache.get("Subject: Other") is None
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 1
+
+
+def test_key_includes_model_and_prompt_version(tmp_path):
+    db = _make_db(tmp_path)
+    SummaryCache(db, model_id="haiku", prompt_version="v1").put("text", {"a": 1})
+
+    assert SummaryCache(db, model_id="sonnet", prompt_version="v1").get("text") is None
+    assert SummaryCache(db, model_id="haiku", prompt_version="v2").get("text") is None
+    assert SummaryCache(db, model_id="haiku", prompt_version="v1").get("text") == {"a": 1}
+
+
+def test_ttl_expiry(tmp_path):
+    clock = FakeClock()
+    cache = SummaryCache(_make_db(tmp_path), model_id="m", prompt_version="v", ttl_seconds=10, clock=clock)
+    cache.put("text", {"a": 1})
+
+    clock.now = 5
+    assert cache.get("text") == {"a": 1}
+    clock.now = 11
+    assert cache.get("text") is None
+    assert cache.stats()["entries"] == 0
+
+
+def test_lru_eviction(tmp_path):
+    cache = SummaryCache(_make_db(tmp_path), model_id="m", prompt_version="v", max_entries=2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    cache.get("a") # a is now most recently used
+    cache.put("c", 3)
+
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    assert cache.stats()["evictions"] == 1
+
+
+def test_entries_persist_across_reloads(tmp_path):
+    cache = SummaryCache(_make_db(tmp_path), model_id="m", prompt_version="v", max_entries=2)
+    for key in ["a", "b", "c"]:
+        cache.put(key, key.upper())
+
+    reloaded = SummaryCache(_make_db(tmp_path), model_id="m", prompt_version="v", max_entries=2)
+    assert reloaded.get("a") is None
+    assert reloaded.get("b") == "B"
+    assert reloaded.get("c") == "C"